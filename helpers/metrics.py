@@ -0,0 +1,217 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# seconds, from quick cache reads to full rebalances of big fleets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+# sink gets every recorded value: metric type, name, value, labels
+Sink = Callable[[str, str, float, Dict[str, str]], None]
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for key, value in labels
+    ) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of metrics, values are kept per label values"""
+
+    type_ = ''
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str,
+                 labels: Sequence[str] = ()) -> None:
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        if set(labels) != set(self.labels):
+            raise ValueError('{} expects labels {}, got {}'.format(
+                self.name, self.labels, tuple(labels)))
+        return tuple((label, labels[label]) for label in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type_),
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Gauge(Metric):
+    type_ = 'gauge'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values = {}  # type: Dict[Labels, float]
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+        self.registry.emit(self.type_, self.name, value, labels)
+
+    def _samples(self) -> List[str]:
+        return ['{}{} {}'.format(self.name, _format_labels(key), _format_value(value))
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(Gauge):
+    type_ = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.emit(self.type_, self.name, amount, labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        raise TypeError('Counter can only be increased')
+
+
+class Histogram(Metric):
+    type_ = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # label values: (count per bucket, [sum]), count is the last cumulative bucket
+        self._values = {}  # type: Dict[Labels, Tuple[List[int], List[float]]]
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            try:
+                bucket_counts, total = self._values[key]
+            except KeyError:
+                bucket_counts, total = self._values[key] = [0] * len(self.buckets), [0.0]
+            bucket_counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+        self.registry.emit(self.type_, self.name, value, labels)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes duration of with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        samples = []  # type: List[str]
+        for key, (bucket_counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, bucket_counts):
+                cumulative += count
+                samples.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(key, (('le', _format_value(bucket)),)),
+                    cumulative))
+            samples.append('{}_sum{} {}'.format(
+                self.name, _format_labels(key), _format_value(total[0])))
+            samples.append('{}_count{} {}'.format(self.name, _format_labels(key), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Keeps metrics in memory for Prometheus scraping and forwards values to sinks
+
+    Recording is a lock and a few dict operations, so metrics can stay on in production
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}  # type: Dict[str, Metric]
+        self._sinks = []  # type: List[Sink]
+        self._server = None  # type: Optional[HTTPServer]
+
+    def _register(self, metric: Metric) -> Metric:
+        # modules can be reloaded, same metric is returned for same name
+        registered = self._metrics.setdefault(metric.name, metric)
+        if type(registered) is not type(metric) or registered.labels != metric.labels:
+            raise ValueError('{} is already registered as {} with labels {}'.format(
+                metric.name, registered.type_, registered.labels))
+        return registered
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(self, name, documentation, labels))
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self, name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labels, buckets=buckets))
+
+    def add_sink(self, sink: Sink) -> None:
+        """Sink is called with every recorded value, e.g. to push it to StatsD"""
+        self._sinks.append(sink)
+
+    def emit(self, type_: str, name: str, value: float, labels: Dict[str, str]) -> None:
+        for sink in self._sinks:
+            sink(type_, name, value, labels)
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format"""
+        lines = []  # type: List[str]
+        for _, metric in sorted(self._metrics.items()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, address: str = '127.0.0.1') -> HTTPServer:
+        """Serves metrics for Prometheus on http://address:port/metrics in daemon thread"""
+
+        if self._server is not None:
+            return self._server
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self._server = HTTPServer((address, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+METRICS = MetricsRegistry()  # default registry of the process
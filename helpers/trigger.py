@@ -0,0 +1,55 @@
+import threading
+import time
+from typing import Optional, Set
+
+
+class Trigger:
+    """Wakes waiting thread on events, coalescing bursts of events into single wakeup
+
+    :param debounce: (float) seconds without new events before waiting thread is woken
+    :param max_delay: (float) max seconds between first event and wakeup,
+        so steady stream of events can't postpone it forever
+    """
+
+    def __init__(self, debounce: float = 0.5, max_delay: float = 5.0) -> None:
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._condition = threading.Condition()
+        self._reasons = set()  # type: Set[str]
+        self._first_event = 0.0
+        self._last_event = 0.0
+
+    def notify(self, reason: str) -> None:
+        """Records event, can be called from any thread"""
+        with self._condition:
+            now = time.monotonic()
+            if not self._reasons:
+                self._first_event = now
+            self._last_event = now
+            self._reasons.add(reason)
+            self._condition.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """Blocks until burst of events settles or timeout passes
+
+        Returns reasons of all events since last wait, empty set on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._reasons:
+                    wake_at = min(self._last_event + self.debounce,
+                                  self._first_event + self.max_delay)
+                elif deadline is not None:
+                    wake_at = deadline
+                else:
+                    wake_at = None
+
+                if wake_at is not None and now >= wake_at:
+                    break
+                self._condition.wait(None if wake_at is None else wake_at - now)
+
+            reasons, self._reasons = self._reasons, set()
+            return reasons
@@ -1,4 +1,12 @@
-from typing import Any, Dict, Tuple
+import atexit
+import logging
+import threading
+import weakref
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .codec import device_key
+
+LOG = logging.getLogger(__name__)
 
 REDIS = {
     'host': 'localhost',
@@ -15,6 +23,8 @@ class Cache:
     PROC_TIME_FIELD = 'proc_time'
     RESET_VALUE = 0
     SYSTEM_FIELD = 'system'
+    LAG_FIELD = 'lag'  # messages waiting to be processed for device, set by workers
+    BATCH_SIZE = 1000  # number of keys read and reset in single round trip
 
     def __init__(self) -> None:
         try:
@@ -33,8 +43,10 @@ class Cache:
     def end_transaction(self) -> None:
         """Ends transaction and commits all accummulated data"""
 
-        self._submitter.execute()
-        self._submitter = self._redis
+        try:
+            self._submitter.execute()
+        finally:
+            self._submitter = self._redis
 
     def set_field_values(self, _key: str, _dict: Dict[Any, Any]) -> None:
         """Set hash fields to Redis, can also be used to update single field"""
@@ -51,3 +63,200 @@ class Cache:
     def update_field(self, _key: str, _field: str, value: Any) -> None:
         """Update single field, without dict need"""
         self._submitter.hset(_key, _field, value)
+
+    def fetch_and_reset_fields(
+            self, keys: Iterable[str], fields: Sequence[str],
+            batch_size: Optional[int] = None) -> List[Tuple]:
+        """Return values of fields for every key and reset them to RESET_VALUE
+
+        Keys are processed in batches of batch_size, BATCH_SIZE by default, each batch
+        is single MULTI/EXEC round trip so increments can't land between read and reset
+        """
+        keys = list(keys)
+        batch_size = batch_size or self.BATCH_SIZE
+        reset_values = {field: self.RESET_VALUE for field in fields}
+        values = []  # type: List[Tuple]
+
+        for start in range(0, len(keys), batch_size):
+            pipeline = self._redis.pipeline(transaction=True)
+            for _key in keys[start:start + batch_size]:
+                pipeline.hmget(_key, *fields)
+                pipeline.hmset(_key, reset_values)
+            # every second result is hmset status
+            values.extend(tuple(result) for result in pipeline.execute()[::2])
+
+        return values
+
+    def increment_many_fields(self, increments: Iterable[Tuple[str, str, float]]) -> None:
+        """Increases (key, field) by amount for every item in single MULTI/EXEC round trip
+
+        Uses own pipeline, unlike start_transaction, so it's safe from other threads
+        """
+        pipeline = self._redis.pipeline(transaction=True)
+        for _key, _field, amount in increments:
+            pipeline.hincrbyfloat(_key, _field, amount)
+        pipeline.execute()
+
+    def get_many_field_values(
+            self, keys: Iterable[str], fields: Sequence[str],
+            batch_size: Optional[int] = None) -> List[Tuple]:
+        """Return values of fields for every key, batch of keys per round trip,
+        BATCH_SIZE keys if batch_size is not given
+        """
+        keys = list(keys)
+        batch_size = batch_size or self.BATCH_SIZE
+        values = []  # type: List[Tuple]
+
+        for start in range(0, len(keys), batch_size):
+            pipeline = self._redis.pipeline(transaction=False)
+            for _key in keys[start:start + batch_size]:
+                pipeline.hmget(_key, *fields)
+            values.extend(tuple(result) for result in pipeline.execute())
+
+        return values
+
+
+class AggregatingStatsWriter:
+    """Collects device message stats in process and writes them to cache in batches
+
+    Instead of three increments per message, every flush does one increment per device
+    and field plus one for system, all in single transaction. Flushes from background
+    thread every flush_interval seconds or sooner once max_pending devices have stats,
+    and on close. Writers not closed are closed on interpreter exit, unless they were
+    garbage collected, then their pending stats are lost. Works with Cache
+    and CacheSimulator
+
+    Recording never touches the cache, while cache is down stats of devices over
+    max_buffered are dropped and counted in `dropped`
+
+    :param flush_interval: (float) max seconds stats wait in process
+    :param max_pending: (int) number of devices with stats that triggers flush
+    :param max_buffered: (int) max devices with stats kept while flushes fail
+    """
+
+    FLUSH_INTERVAL = 1.0
+    MAX_PENDING = 1000
+    MAX_BUFFERED = 100000
+
+    def __init__(self, cache: Cache, flush_interval: float = FLUSH_INTERVAL,
+                 max_pending: int = MAX_PENDING, max_buffered: int = MAX_BUFFERED) -> None:
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_buffered = max_buffered
+        self.dropped = 0  # messages whose stats were dropped
+        self._reported_dropped = 0
+
+        # device id: [msg count, processing time]
+        self._pending = {}  # type: Dict[int, List]
+        self._lock = threading.Lock()
+        # only one flush writes to cache at a time, records don't wait for it
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+
+        # thread holds writer weakly, so unreferenced writer can be collected
+        self._thread = threading.Thread(
+            target=_flush_periodically,
+            args=(weakref.ref(self), self._closed, self._wake, flush_interval), daemon=True)
+        self._thread.start()
+        # collected writer wakes the thread, which then finds it gone
+        weakref.finalize(self, self._wake.set)
+        _WRITERS.add(self)
+
+    def __enter__(self) -> 'AggregatingStatsWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def record(self, device_id: int, proc_time: float, msg_count: int = 1) -> None:
+        """Adds processed message(s) of device to pending stats,
+        partitions of split devices record under their partition id
+        """
+
+        with self._lock:
+            self._add(device_id, msg_count, proc_time)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def _add(self, device_id: int, msg_count: int, proc_time: float) -> None:
+        try:
+            stats = self._pending[device_id]
+        except KeyError:
+            if len(self._pending) >= self.max_buffered:
+                self.dropped += msg_count
+                return
+            stats = self._pending[device_id] = [0, 0.0]
+        stats[0] += msg_count
+        stats[1] += proc_time
+
+    def flush(self) -> None:
+        """Writes pending stats to cache, on failure they are kept for next flush"""
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                dropped = self.dropped - self._reported_dropped
+                self._reported_dropped = self.dropped
+            if dropped:
+                LOG.warning('Stats of %s messages dropped, cache was unavailable', dropped)
+            if not pending:
+                return
+
+            increments = []  # type: List[Tuple[str, str, float]]
+            for device_id, (msg_count, proc_time) in pending.items():
+                _key = device_key(device_id)
+                increments.append((_key, self.cache.COUNT_FIELD, msg_count))
+                increments.append((_key, self.cache.PROC_TIME_FIELD, proc_time))
+            increments.append((
+                self.cache.SYSTEM_FIELD, self.cache.COUNT_FIELD,
+                sum(msg_count for msg_count, _ in pending.values())))
+            try:
+                self.cache.increment_many_fields(increments)
+            except Exception:
+                with self._lock:
+                    for device_id, (msg_count, proc_time) in pending.items():
+                        self._add(device_id, msg_count, proc_time)
+                raise
+
+    def close(self) -> None:
+        """Stops background flushing and writes remaining stats"""
+
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._wake.set()
+        _WRITERS.discard(self)
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+
+def _flush_periodically(
+        writer_ref: 'weakref.ReferenceType[AggregatingStatsWriter]',
+        closed: threading.Event, wake: threading.Event, flush_interval: float) -> None:
+    """Background flushing of AggregatingStatsWriter, ends once writer is closed or gone"""
+
+    while not closed.is_set():
+        wake.wait(flush_interval)
+        wake.clear()
+        writer = writer_ref()
+        if writer is None or closed.is_set():
+            return
+        try:
+            writer.flush()
+        except Exception:
+            LOG.exception('Flushing device stats failed, retrying in next flush')
+        del writer
+
+
+# writers still open on interpreter exit, held weakly
+_WRITERS = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+@atexit.register
+def _close_writers() -> None:
+    for writer in list(_WRITERS):
+        writer.close()
@@ -0,0 +1,154 @@
+import pickle
+import struct
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+from typing import Iterable, List, Tuple, Union
+
+# header: magic, format version, flags
+HEADER = struct.Struct('<2sBB')
+MAGIC = b'DV'
+VERSION = 1
+# payload ends with partition section, written only if there are partitions, so readers
+# of VERSION keep reading assignments without them
+PARTITIONS_VERSION = 2
+PLAIN_COUNT = struct.Struct('<I')  # number of plain device ids in PARTITIONS_VERSION
+
+FLAG_COMPRESSED = 0b01
+FLAG_WIDE = 0b10  # deltas don't fit 32 bits
+
+COMPRESS_MIN_SIZE = 256  # bytes, smaller payloads are not worth compressing
+COMPRESS_LEVEL = 1  # deltas compress well already on fastest level
+
+# partitions of split devices get ids with device id, partition index and count packed
+# under flag bit, so they are encoded, handed off and stored like device ids
+PARTITION_FLAG = 1 << 62
+PARTITION_BITS = 8  # bits of partition index and of partition count
+MAX_PARTITIONS = (1 << PARTITION_BITS) - 1
+_PARTITION_MASK = (1 << PARTITION_BITS) - 1
+
+
+def _deltas(ids: List[int]) -> List[int]:
+    return [current - previous for previous, current in zip([0] + ids, ids)]
+
+
+def encode_device_ids(device_ids: Iterable[int], compress: bool = True) -> bytes:
+    """Encodes device ids as sorted deltas packed in unsigned int array
+
+    Deltas of sorted ids are small so payload compresses well with zlib,
+    compressed form is kept only if it is smaller. Partition ids would force 64 bit
+    deltas, so they go to own section: plain id count, plain id deltas, deltas of
+    device ids of partitions, partition indexes and partition counts as bytes
+    """
+    ids = sorted(set(device_ids))
+    plain_ids = [device_id for device_id in ids if not device_id & PARTITION_FLAG]
+    partitions = [decode_partition_id(device_id) for device_id in ids[len(plain_ids):]]
+    deltas = _deltas(plain_ids) + _deltas([device_id for device_id, _, _ in partitions])
+
+    version = VERSION
+    flags = 0
+    typecode = 'I'
+    if deltas and max(deltas) > 0xFFFFFFFF:
+        flags |= FLAG_WIDE
+        typecode = 'Q'
+
+    packed = array(typecode, deltas)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    payload = packed.tobytes()
+    if partitions:
+        version = PARTITIONS_VERSION
+        payload = b''.join((
+            PLAIN_COUNT.pack(len(plain_ids)), payload,
+            bytes(index for _, index, _ in partitions),
+            bytes(count for _, _, count in partitions),
+        ))
+
+    if compress and len(payload) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(payload, COMPRESS_LEVEL)
+        if len(compressed) < len(payload):
+            flags |= FLAG_COMPRESSED
+            payload = compressed
+
+    return HEADER.pack(MAGIC, version, flags) + payload
+
+
+def decode_device_ids(value: bytes) -> List[int]:
+    """Decodes device ids, also reads legacy pickled lists written before encoding existed"""
+
+    if not value:
+        return []
+
+    if not value.startswith(MAGIC):
+        return list(pickle.loads(value) or [])
+
+    _, version, flags = HEADER.unpack_from(value)
+    if version not in (VERSION, PARTITIONS_VERSION):
+        raise ValueError('Unsupported device ids encoding version: {}'.format(version))
+
+    payload = value[HEADER.size:]
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+
+    packed = array('Q' if flags & FLAG_WIDE else 'I')
+    if version == VERSION:
+        packed.frombytes(payload)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        return list(accumulate(packed))
+
+    plain_count, = PLAIN_COUNT.unpack_from(payload)
+    payload = payload[PLAIN_COUNT.size:]
+    # every partition takes delta, index and count byte
+    partition_count = (len(payload) - plain_count * packed.itemsize) // (packed.itemsize + 2)
+    delta_size = (plain_count + partition_count) * packed.itemsize
+    packed.frombytes(payload[:delta_size])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    indexes = payload[delta_size:delta_size + partition_count]
+    counts = payload[delta_size + partition_count:]
+
+    return list(accumulate(packed[:plain_count])) + [
+        encode_partition_id(device_id, index, count)
+        for device_id, index, count in zip(accumulate(packed[plain_count:]), indexes, counts)
+    ]
+
+
+def encode_partition_id(device_id: int, index: int, count: int) -> int:
+    """Id of partition index of device split to count partitions"""
+
+    if not 0 <= index < count <= MAX_PARTITIONS:
+        raise ValueError('Invalid partition {}/{}'.format(index, count))
+    if not 0 <= device_id < PARTITION_FLAG >> 2 * PARTITION_BITS:
+        raise ValueError('Device id {} too big for partition id'.format(device_id))
+    return PARTITION_FLAG | device_id << 2 * PARTITION_BITS | index << PARTITION_BITS | count
+
+
+def decode_partition_id(device_id: int) -> Tuple[int, int, int]:
+    """Returns device id, partition index and partition count, whole device is 0 of 1"""
+
+    if not device_id & PARTITION_FLAG:
+        return device_id, 0, 1
+    return (
+        (device_id & ~PARTITION_FLAG) >> 2 * PARTITION_BITS,
+        device_id >> PARTITION_BITS & _PARTITION_MASK,
+        device_id & _PARTITION_MASK,
+    )
+
+
+def device_key(device_id: int) -> str:
+    """Cache key of device stats, 'device:<id>' or 'device:<id>:<index>/<count>'"""
+
+    parent_id, index, count = decode_partition_id(device_id)
+    if count == 1:
+        return 'device:{}'.format(parent_id)
+    return 'device:{}:{}/{}'.format(parent_id, index, count)
+
+
+def message_partition(message_key: Union[bytes, str], count: int) -> int:
+    """Partition index of message by its key, same in every process unlike hash()"""
+
+    if isinstance(message_key, str):
+        message_key = message_key.encode()
+    return zlib.crc32(message_key) % count
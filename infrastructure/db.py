@@ -1,41 +1,184 @@
-from typing import Iterable
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
 
 from ..helpers.db_connector import DbConnector
 from ..helpers.interval_decorator import ExecutionInterval
 from ..service.entities import Device
 
+LOG = logging.getLogger(__name__)
+
 
 class DeviceStorage:
-    """Keeps state of current enabled devices"""
+    """Keeps state of current enabled devices
+
+    After initial load only rows changed since last sync are fetched, by `updated_at` column.
+    Every sync that changes devices bumps `generation`, exposes the change as
+    `added` and `removed` devices and calls listeners
+    """
 
     UPDATE_INTERVAL = 30
+    FULL_SYNC_INTERVAL = 3600  # rows deleted from table are noticed only on full sync
+    SYNC_OVERLAP = timedelta(seconds=5)  # rows committed late with older updated_at
+    # database device data is read from, selected only with_databases,
+    # settings.DEVICE_DATABASE_COLUMN overrides it
+    DATABASE_COLUMN = 'source_database'
 
-    def __init__(self) -> None:
-        self._devices = set()  # type: Set[Device]
+    def __init__(self, connector: DbConnector = DbConnector,
+                 domain: Optional[int] = None, domain_count: int = 1,
+                 with_databases: bool = False) -> None:
+        """
+        :param domain: (int) scheduling domain, only devices with id modulo domain_count
+            equal to domain are kept, see `domain_of`
+        :param with_databases: (bool) read DATABASE_COLUMN into `Device.database`, for
+            DatabaseAwareStrategy, devices are read without databases if table lacks
+            the column
+        """
+        self._connector = connector
+        self.domain = domain
+        self.domain_count = domain_count
+        self.with_databases = with_databases
+        self._devices = {}  # type: Dict[int, Device]
+        self._last_change = None  # type: Optional[datetime]
+        self._last_full_sync = 0.0
+        self.generation = 0
+        self.added = set()  # type: Set[Device]
+        self.removed = set()  # type: Set[Device]
+        self._listeners = []  # type: List[Callable[[], None]]
         self._fetch_devices()
 
     @property
     def devices(self) -> Iterable[Device]:
         """Return state devices as iterable"""
 
-        for device in self._devices:
+        for device in self._devices.values():
             yield device
 
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """Registers function called from syncing thread on every device change"""
+        self._listeners.append(listener)
+
     @ExecutionInterval(seconds=UPDATE_INTERVAL)
     def update_devices(self) -> None:
         """Periodically updates devices for specified update interval"""
         self._fetch_devices()
 
-    def _fetch_devices(self):
+    def sync_devices(self) -> None:
+        """Updates devices now, for callers that keep their own schedule"""
+        self._fetch_devices()
+
+    def _fetch_devices(self) -> None:
         """True device fetcher, does DB query, but can't put ExecutionInterval directly"""
 
+        try:
+            self._fetch_device_changes()
+        except Exception:
+            if not self.with_databases:
+                raise
+            # query without the column failing too means the column is not the problem
+            self.with_databases = False
+            self._fetch_device_changes()
+            LOG.warning('Column %s not readable, devices are read without databases',
+                        self._database_column_name, exc_info=True)
+
+    def _fetch_device_changes(self) -> None:
+        if (self._last_change is None or
+                time.monotonic() - self._last_full_sync >= self.FULL_SYNC_INTERVAL):
+            added, removed = self._fetch_all_devices()
+        else:
+            added, removed = self._fetch_changed_devices()
+
+        if added or removed:
+            self.added, self.removed = added, removed
+            self.generation += 1
+            for listener in self._listeners:
+                listener()
+
+    def _fetch_all_devices(self) -> Tuple[Set[Device], Set[Device]]:
+        """Loads all enabled devices, returns added and removed devices"""
+
+        # taken before devices, so rows changed meanwhile are fetched again on next sync
+        last_change_query = """
+            SELECT updated_at
+            FROM m_controldata_device
+            ORDER BY updated_at DESC
+            LIMIT 1
+        """
         device_query = """
-            SELECT id
+            SELECT id, {}
             FROM m_controldata_device
-            WHERE enabled = true AND processable = true
+            WHERE enabled = true AND processable = true {}
             ORDER BY id
-        """
+        """.format(self._database_column, self._domain_filter)
+
+        last_change, *_ = next(iter(self._connector.execute_sql(last_change_query)), (None,))
+        device_databases = dict(
+            self._connector.execute_sql(device_query, self._domain_params))
 
-        self._devices = {
-            Device(device_id) for device_id, *_ in DbConnector.execute_sql(device_query)
+        added = {
+            Device(device_id) for device_id in device_databases if device_id not in self._devices
         }
+        removed = {
+            device for device_id, device in self._devices.items()
+            if device_id not in device_databases
+        }
+        self._apply_changes(added, removed)
+        for device_id, device in self._devices.items():
+            device.database = device_databases[device_id]
+
+        self._last_change = last_change
+        self._last_full_sync = time.monotonic()
+        return added, removed
+
+    def _fetch_changed_devices(self) -> Tuple[Set[Device], Set[Device]]:
+        """Loads only rows changed since last sync, returns added and removed devices"""
+
+        changed_device_query = """
+            SELECT id, enabled AND processable, updated_at, {}
+            FROM m_controldata_device
+            WHERE updated_at > %s {}
+            ORDER BY updated_at
+        """.format(self._database_column, self._domain_filter)
+
+        added = set()  # type: Set[Device]
+        removed = set()  # type: Set[Device]
+        for device_id, active, updated_at, database in self._connector.execute_sql(
+                changed_device_query,
+                (self._last_change - self.SYNC_OVERLAP,) + self._domain_params):
+            self._last_change = max(self._last_change, updated_at)
+            device = self._devices.get(device_id)
+            if active and device is None:
+                device = Device(device_id)
+                added.add(device)
+            elif not active and device is not None:
+                removed.add(device)
+            if active:
+                device.database = database
+
+        self._apply_changes(added, removed)
+        return added, removed
+
+    @property
+    def _database_column_name(self) -> str:
+        return getattr(settings, 'DEVICE_DATABASE_COLUMN', self.DATABASE_COLUMN)
+
+    @property
+    def _database_column(self) -> str:
+        return self._database_column_name if self.with_databases else 'NULL'
+
+    @property
+    def _domain_filter(self) -> str:
+        return 'AND MOD(id, %s) = %s' if self.domain is not None else ''
+
+    @property
+    def _domain_params(self) -> Tuple:
+        return (self.domain_count, self.domain) if self.domain is not None else ()
+
+    def _apply_changes(self, added: Set[Device], removed: Set[Device]) -> None:
+        for device in removed:
+            del self._devices[device.id_]
+        for device in added:
+            self._devices[device.id_] = device
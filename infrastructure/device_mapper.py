@@ -1,67 +1,420 @@
-from typing import List, Set
+import logging
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 
+from kazoo.client import KazooClient
 from kazoo.exceptions import NoNodeError
-from kazoo.recipe.watchers import ChildrenWatch
 
-from .. import ZooKeeper
 from ..entities import Device, Worker
+from .codec import (
+    PARTITION_FLAG, decode_device_ids, decode_partition_id, encode_device_ids
+)
+from .registry import ChildDataCache, WorkerRegistry
 
+LOG = logging.getLogger(__name__)
 
-class WorkerDeviceMapper(ZooKeeper):
+# device move waiting for source worker to drain it, deadline is time.monotonic() based
+Handoff = namedtuple('Handoff', ('source', 'target', 'deadline'))
+
+
+class WorkerDeviceMapper(WorkerRegistry):
     """Scheduler's coordination service
 
     Listens for node updates and updates it's state which is passed to Scheduler service
     Does all the work on infrastructure update handling
     """
 
-    WORKERS_DEVICES_PATH = '/*/processing/worker_dev'
-    WORKER_PATH = '/*/processing/workers'
+    HANDOFF_TIMEOUT = 30  # seconds after which device is activated on target without ack
+    HANDOFF_WAVE_SIZE = 500  # max devices being handed off at the same time
+    PUBLISH_ATTEMPTS = 3  # commits rolled back by diverged Zookeeper state before giving up
 
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, client: Optional[KazooClient] = None,
+                 domain: Optional[int] = None) -> None:
+        """
+        :param domain: (int) scheduling domain, mapper then sees only workers of domain
+            and publishes to subtrees of WORKERS_DEVICES_PATH and HANDOFF_PATH
+        """
+        super().__init__(client)
         self.__workers = set()  # type: Set[Worker]
 
+        self.domain = domain
+        if domain is not None:
+            self.WORKERS_DEVICES_PATH = '{}/{}'.format(self.WORKERS_DEVICES_PATH, domain)
+            self.HANDOFF_PATH = '{}/{}'.format(self.HANDOFF_PATH, domain)
+        # identities of live workers and of workers in domain, None without domain
+        self._live_workers = []  # type: List[str]
+        self._domain_workers = None  # type: Optional[FrozenSet[str]]
+
         self._create_node(path=self.WORKER_PATH)
+        self._create_node(path=self.WORKERS_DEVICES_PATH)
+        self._create_node(path=self.HANDOFF_PATH)
+
+        # last assignment written to Zookeeper, worker identity: device ids
+        self._published = self._get_published_assignment()  # type: Dict[str, FrozenSet[int]]
+        # assignment scheduler wants, published once handoffs are done
+        self._target = None  # type: Optional[Dict[str, FrozenSet[int]]]
+        self._handoffs = self._get_handoffs()  # type: Dict[int, Handoff]
+        # device ids with handoff node in Zookeeper not acknowledged yet
+        self._handoff_nodes = set(self._handoffs)  # type: Set[int]
+        # handoff and mirror watches fire from watch thread, publishes must not interleave
+        self._lock = threading.RLock()
+        self._publishing = False
+        self._republish = False
+        # devices moved between workers by publishes so far, handoffs count when started
+        self.moves = 0
+        # worker devices read from Zookeeper, worker identity: devices
+        self._worker_devices = ChildDataCache(
+            self._zk, self.WORKERS_DEVICES_PATH, self._decode_devices,
+            listener=self._worker_devices_changed)
+        self._listeners = []  # type: List[Callable[[], None]]
+        # standby schedulers follow assignment published by the leader
+        self._mirroring = False
+
+        if domain is not None:
+            self._domain_workers = frozenset()
+            self._create_node(path=self._domain_path(domain))
+
+            @self._zk.DataWatch(self._domain_path(domain))
+            def domain_watch_func(data: Optional[bytes], stat: Any) -> None:
+                """Zoo listener for workers moved between domains"""
+
+                worker_ids = self._deserialize(data) if data else None
+                self._domain_workers = frozenset(worker_ids or ())
+                self._update_workers()
 
-        @ChildrenWatch(self._zk, self.WORKER_PATH)
+        @self._zk.ChildrenWatch(self.WORKER_PATH)
         def child_watch_func(children: List[str]) -> None:
             """Zoo listener for updating worker state (adding/remowing worker)"""
 
-            self.__workers = {Worker(worker_id) for worker_id in children}
-            self._get_worker_state_from_zookeeper()
+            self._live_workers = children
+            self._update_workers()
+
+        @self._zk.ChildrenWatch(self.HANDOFF_PATH)
+        def handoff_watch_func(children: List[str]) -> None:
+            """Activates devices on their target once source workers acknowledge drain"""
+
+            with self._lock:
+                if self._target is None:
+                    return
+                if self._publishing:
+                    # publish from this thread is in progress, it checks acks once done
+                    self._republish = True
+                elif self._check_acknowledged({int(device_id) for device_id in children}):
+                    self._publish()
+
+    def _update_workers(self) -> None:
+        worker_ids = [
+            worker_id for worker_id in self._live_workers
+            if self._domain_workers is None or worker_id in self._domain_workers
+        ]
+        capacities = self._get_worker_capacities(worker_ids)
+        self.__workers = {
+            Worker(worker_id, capacities.get(worker_id)) for worker_id in worker_ids
+        }
+        self._get_worker_state_from_zookeeper()
+
+        for listener in self._listeners:
+            listener()
 
     @property
     def workers(self) -> Set[Worker]:
         """Return existing workers and their assigned devices"""
         return self.__workers
 
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """Registers function called from watch thread on every worker change"""
+        self._listeners.append(listener)
+
+    def mirror_assignment(self) -> None:
+        """Keeps worker devices in sync with assignment published by other scheduler
+
+        Leader touches WORKERS_DEVICES_PATH in every publish transaction, its data watch
+        picks up added and removed nodes, changed nodes are read by their own data watch
+        """
+        with self._lock:
+            if self._mirroring:
+                return
+            self._mirroring = True
+
+        @self._zk.DataWatch(self.WORKERS_DEVICES_PATH)
+        def data_watch_func(data: Optional[bytes], stat: Any) -> Optional[bool]:
+            # stop_mirroring holds the lock, so no read lands after this scheduler publishes
+            with self._lock:
+                if not self._mirroring:
+                    return False  # removes the watch
+
+                self._get_worker_state_from_zookeeper()
+                try:
+                    worker_ids = self._get_children(path=self.WORKERS_DEVICES_PATH)
+                except NoNodeError:
+                    worker_ids = []
+                # nodes of dead workers are not watched, empty set gets them deleted on publish
+                worker_devices = self._worker_devices.values
+                self._published = {
+                    worker_id: frozenset(
+                        device.id_ for device in worker_devices.get(worker_id, ()))
+                    for worker_id in worker_ids
+                }
+            return None
+
+    def stop_mirroring(self) -> None:
+        """Stops following published assignment, this scheduler publishes from now on"""
+        with self._lock:
+            self._mirroring = False
+            # previous leader may have left moves in progress
+            self._handoffs = self._get_handoffs()
+            self._handoff_nodes = set(self._handoffs)
+
+    @property
+    def handoff_deadline(self) -> Optional[float]:
+        """Earliest time.monotonic() at which pending handoff times out"""
+        with self._lock:
+            return min((handoff.deadline for handoff in self._handoffs.values()), default=None)
+
     def update_worker_devices(self, workers: Set[Worker]) -> None:
-        """Clean current zoo wrker_dev path and assign new devices"""
+        """Write only changed worker devices to Zookeeper, in single transaction
 
-        self._remove_worker_device_map_and_children()
-        for worker in workers:
-            self._set_workers_devices(worker.identity, worker.devices)
+        Devices moved between live workers are handed off in two phases, first they
+        are removed from source worker and get a handoff node, only after source worker
+        deletes the node (or HANDOFF_TIMEOUT passes) they are added to target worker.
+        At most HANDOFF_WAVE_SIZE devices are in handoff, other moves wait for next wave
+        on their source worker
+        """
 
-    def _get_worker_state_from_zookeeper(self) -> None:
-        """Fetches old worker state and their assigned devices from Zookeeper"""
+        target = {
+            worker.identity: frozenset(device.id_ for device in worker.devices)
+            for worker in workers
+        }
+        with self._lock:
+            self._target = target
+            self._publish()
+
+    def advance_handoffs(self) -> None:
+        """Publishes devices whose handoff timed out and starts next wave of moves"""
+        with self._lock:
+            deadline = self.handoff_deadline
+            if self._target is not None and deadline is not None and \
+                    deadline <= time.monotonic():
+                self._publish()
+
+    def _publish(self) -> None:
+        self._publishing = True
+        try:
+            self._republish = False
+            while True:
+                self._commit_synced()
+                if not self._republish or not self._check_acknowledged():
+                    break
+                self._republish = False
+        finally:
+            self._publishing = False
+
+    def _commit_synced(self) -> None:
+        """Commits staged assignment, syncs with Zookeeper after every rollback
+
+        Raises RuntimeError once PUBLISH_ATTEMPTS commits were rolled back, state is
+        synced by then, so next publish starts from what Zookeeper holds
+        """
+        for _ in range(self.PUBLISH_ATTEMPTS):
+            if self._zk.retry(self._commit_assignment):
+                return
+            # Zookeeper state diverged from what we published, sync and try again
+            self._published = self._get_published_assignment()
+            self._handoffs = self._get_handoffs()
+            self._handoff_nodes = set(self._handoffs)
+
+        LOG.error('Assignment commit rolled back %s times, other scheduler may be publishing',
+                  self.PUBLISH_ATTEMPTS)
+        raise RuntimeError('Worker devices assignment not published')
+
+    def _check_acknowledged(self, children: Optional[Set[int]] = None) -> bool:
+        """Marks handoffs whose nodes source workers deleted, returns True if any
+
+        Watch can pass children read before our last publish, so missing nodes
+        are checked again
+        """
+        requests = [
+            (device_id, self._zk.exists_async(self._handoff_path(device_id)))
+            for device_id in self._handoff_nodes & self._handoffs.keys()
+            if children is None or device_id not in children
+        ]
+        acknowledged = {device_id for device_id, request in requests if request.get() is None}
+        self._handoff_nodes -= acknowledged
+        return bool(acknowledged)
+
+    def _stage_assignment(self, time_now: float) -> Tuple[
+            Dict[str, FrozenSet[int]], Dict[int, Handoff], Set[int]]:
+        """Splits target assignment to devices workers process now and handoffs
+
+        Returns assignment to publish, handoffs in progress and device ids
+        whose handoff nodes are to be deleted
+        """
+        target = self._target
+        owners = {}  # type: Dict[int, str]
+        for worker_id, device_ids in self._published.items():
+            for device_id in device_ids:
+                owners[device_id] = worker_id
+                if device_id & PARTITION_FLAG:
+                    # device merged from partitions is drained from one of their workers
+                    owners.setdefault(decode_partition_id(device_id)[0], worker_id)
+        assignment = {worker_id: set() for worker_id in target}  # type: Dict[str, Set[int]]
+        handoffs = {}  # type: Dict[int, Handoff]
+
+        def is_done(handoff: Handoff, device_id: int) -> bool:
+            return (device_id not in self._handoff_nodes or handoff.deadline <= time_now or
+                    handoff.source not in target)
+
+        wave = self.HANDOFF_WAVE_SIZE - sum(
+            1 for device_id, handoff in self._handoffs.items()
+            if not is_done(handoff, device_id)
+        )
+        for worker_id, device_ids in target.items():
+            for device_id in device_ids:
+                handoff = self._handoffs.get(device_id)
+                owner = owners.get(device_id)
+                if owner is None and device_id & PARTITION_FLAG:
+                    # partition of split device is drained from worker of whole device
+                    owner = owners.get(decode_partition_id(device_id)[0])
+                if handoff is not None:
+                    if is_done(handoff, device_id):
+                        assignment[worker_id].add(device_id)
+                    else:
+                        handoffs[device_id] = handoff._replace(target=worker_id)
+                elif owner is None or owner == worker_id or owner not in target:
+                    # new devices and devices of dead workers have nothing to drain
+                    assignment[worker_id].add(device_id)
+                elif wave > 0:
+                    handoffs[device_id] = Handoff(
+                        owner, worker_id, time_now + self.HANDOFF_TIMEOUT)
+                    wave -= 1
+                else:
+                    assignment[owner].add(device_id)
+
+        deleted = (self._handoffs.keys() - handoffs.keys()) & self._handoff_nodes
+        return (
+            {worker_id: frozenset(device_ids) for worker_id, device_ids in assignment.items()},
+            handoffs, deleted
+        )
+
+    def _commit_assignment(self) -> bool:
+        """Commits difference between published and staged target assignment
+        and handoff nodes as single transaction
+
+        Returns False if transaction was rolled back
+        """
+        assignment, handoffs, deleted_handoffs = self._stage_assignment(time.monotonic())
+        created_handoffs = handoffs.keys() - self._handoffs.keys()
+        transaction = self._zk.transaction()
+        # devices taken from and given to changed workers, both are moved without handoff
+        taken, given = set(), set()  # type: Set[int], Set[int]
+
+        for worker_id in self._published.keys() - assignment.keys():
+            transaction.delete(self._worker_devices_path(worker_id))
+            taken |= self._published[worker_id]
+
+        for worker_id, device_ids in assignment.items():
+            if worker_id not in self._published:
+                transaction.create(
+                    self._worker_devices_path(worker_id), encode_device_ids(device_ids))
+                given |= device_ids
+            elif self._published[worker_id] != device_ids:
+                transaction.set_data(
+                    self._worker_devices_path(worker_id), encode_device_ids(device_ids))
+                taken |= self._published[worker_id] - device_ids
+                given |= device_ids - self._published[worker_id]
+
+        for device_id in created_handoffs:
+            handoff = handoffs[device_id]
+            transaction.create(
+                self._handoff_path(device_id),
+                self._serialize((handoff.source, handoff.target)))
+        for device_id in deleted_handoffs:
+            transaction.delete(self._handoff_path(device_id))
+
+        if not transaction.operations:
+            self._handoffs = handoffs
+            return True
+        # wakes standby schedulers mirroring the assignment
+        transaction.set_data(self.WORKERS_DEVICES_PATH, b'')
+
+        if any(isinstance(result, Exception) for result in transaction.commit()):
+            return False
+
+        self._published = assignment
+        self._handoffs = handoffs
+        self._handoff_nodes = (self._handoff_nodes - deleted_handoffs) | created_handoffs
+        self.moves += len(taken & given) + len(created_handoffs)
+        return True
+
+    def _get_published_assignment(self) -> Dict[str, FrozenSet[int]]:
+        """Reads worker devices currently written in Zookeeper"""
+        assignment = {}  # type: Dict[str, FrozenSet[int]]
         try:
             for worker_id in self._get_children(path=self.WORKERS_DEVICES_PATH):
-                value = self._get_node(path='{}/{}'.format(self.WORKERS_DEVICES_PATH, worker_id))
-                for worker in self.__workers:  # type: Worker
-                    if worker == worker_id:
-                        worker.devices = set(Device(id) for id in value)
+                value = self._get_node_data(path=self._worker_devices_path(worker_id))
+                assignment[worker_id] = frozenset(decode_device_ids(value))
         except NoNodeError:
             pass
+        return assignment
 
-    def _set_workers_devices(self, worker: str, devices: Set[Device]) -> None:
-        """Sets devices for worker assigned in Scheduler service"""
-        worker_path = '{}/{}'.format(self.WORKERS_DEVICES_PATH, worker)
-        self._create_node(
-            path='{}'.format(worker_path),
-            value=[device.id_ for device in devices]
-        )
+    def _get_handoffs(self) -> Dict[int, Handoff]:
+        """Reads handoffs in progress from Zookeeper, their timeout starts now"""
+        handoffs = {}  # type: Dict[int, Handoff]
+        deadline = time.monotonic() + self.HANDOFF_TIMEOUT
+        try:
+            device_ids = self._get_children(path=self.HANDOFF_PATH)
+        except NoNodeError:
+            return handoffs
+        requests = [
+            (device_id, self._zk.get_async(self._handoff_path(device_id)))
+            for device_id in device_ids
+        ]
+        for device_id, request in requests:
+            try:
+                value, _ = request.get()
+            except NoNodeError:
+                continue
+            source, target = self._deserialize(value)
+            handoffs[int(device_id)] = Handoff(source, target, deadline)
+        return handoffs
+
+    def _get_worker_state_from_zookeeper(self) -> None:
+        """Sets old worker state and their assigned devices from Zookeeper
+
+        Worker nodes have data watch each, so only changed ones are read and decoded
+        """
+        worker_devices = self._worker_devices.watch(worker.identity for worker in self.__workers)
+        for worker in self.__workers:
+            worker.devices = set(worker_devices.get(worker.identity, ()))
+
+    def _worker_devices_changed(
+            self, worker_id: str, devices: Optional[FrozenSet[Device]]) -> None:
+        """Follows nodes leader changed after mirror watch fired"""
+        with self._lock:
+            if not self._mirroring or worker_id not in self._published:
+                return
+            self._published[worker_id] = frozenset(device.id_ for device in devices or ())
+            for worker in self.__workers:
+                if worker.identity == worker_id:
+                    worker.devices = set(devices or ())
+
+    @staticmethod
+    def _decode_devices(value: bytes) -> FrozenSet[Device]:
+        return frozenset(Device(id) for id in decode_device_ids(value))
+
+    def update_domain_state(self, load: float, device_count: int) -> None:
+        """Publishes aggregate load of domain, processing seconds per second,
+        DomainCoordinator moves workers between domains by it
+        """
+        if self.domain is None:
+            return
+        self._set_node(
+            self._domain_state_path(self.domain), {'load': load, 'devices': device_count})
 
-    def _remove_worker_device_map_and_children(self) -> None:
-        """Remove a worker_device_map path for clean Zookeeper state"""
+    def _worker_devices_path(self, worker: str) -> str:
+        return '{}/{}'.format(self.WORKERS_DEVICES_PATH, worker)
 
-        self._delete_node(path=self.WORKERS_DEVICES_PATH)
+    def _handoff_path(self, device_id: Any) -> str:
+        return '{}/{}'.format(self.HANDOFF_PATH, device_id)
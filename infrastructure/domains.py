@@ -0,0 +1,188 @@
+import logging
+import math
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
+
+from ..helpers.trigger import Trigger
+from .registry import WorkerRegistry
+
+LOG = logging.getLogger(__name__)
+
+
+def domain_of(device_id: int, domain_count: int) -> int:
+    """Scheduling domain of device, same as DeviceStorage domain filter"""
+    return device_id % domain_count
+
+
+class DomainCoordinator(WorkerRegistry):
+    """Coarse balancing of workers between scheduling domains
+
+    Devices are split to domains by id, each domain has own Scheduler leader balancing
+    its devices over its workers. Coordinator only decides which workers belong to which
+    domain, by aggregate domain loads the leaders publish, and writes identities of domain
+    workers to DOMAINS_PATH/<domain>. Runs in SchedulerElector like Scheduler
+    """
+
+    ELECTION = 'coordinator'  # election name under SchedulerElector.SCHEDULER_ELECTION_PATH
+    UPDATE_INTERVAl = 60  # time in seconds
+    DOMAIN_DEVIATION = 0.2  # index 1 how much % load per worker capacity domains can differ
+    MAX_WORKER_MOVES = 2  # workers moved between domains per pass, each one rebalances two
+    DEBOUNCE = 0.5  # seconds without worker changes before we assign new workers
+    MAX_DEBOUNCE_DELAY = 5  # max seconds assignment waits for worker changes to settle
+
+    WORKERS_TRIGGER = 'workers'
+
+    def __init__(self, domain_count: int, client: Optional[KazooClient] = None) -> None:
+        super().__init__(client)
+
+        self.domains = list(range(domain_count))
+        self.last_update_time = time.monotonic()
+        self.trigger = Trigger(debounce=self.DEBOUNCE, max_delay=self.MAX_DEBOUNCE_DELAY)
+        self._live_workers = []  # type: List[str]
+
+        self._create_node(path=self.WORKER_PATH)
+        for domain in self.domains:
+            self._create_node(path=self._domain_path(domain))
+
+        self._zk.ChildrenWatch(self.WORKER_PATH)(self._set_live_workers)
+
+    def _set_live_workers(self, children: List[str]) -> None:
+        self._live_workers = children
+        self.trigger.notify(self.WORKERS_TRIGGER)
+
+    def refresh_standby(self) -> None:
+        """Coordinator reads all its state on every run, nothing to keep warm,
+        standby only restarts the timer its wait blocks on
+        """
+        self.last_update_time = time.monotonic()
+
+    def take_over(self) -> None:
+        self.run()
+
+    def wait(self) -> Set[str]:
+        """Blocks until workers change or coarse pass is due"""
+
+        timeout = self.last_update_time + self.UPDATE_INTERVAl - time.monotonic()
+        return self.trigger.wait(max(timeout, 0))
+
+    def run(self) -> None:
+        """Assigns new workers and moves workers between domains with diverged load"""
+
+        time_now = time.monotonic()
+        update_time = time_now - self.last_update_time >= self.UPDATE_INTERVAl
+
+        live_workers = list(self._live_workers)
+        capacities = self._get_worker_capacities(live_workers)
+        domain_nodes = {domain: self._get_domain_workers(domain) for domain in self.domains}
+        memberships = {domain: worker_ids for domain, (worker_ids, _) in domain_nodes.items()}
+        loads = {domain: self._get_domain_load(domain) for domain in self.domains}
+
+        new_memberships = self.balance_domains(
+            {worker_id: capacities[worker_id].weight
+             for worker_id in live_workers if worker_id in capacities},
+            memberships, loads, max_moves=self.MAX_WORKER_MOVES if update_time else 0
+        )
+
+        transaction = self._zk.transaction()
+        for domain, worker_ids in new_memberships.items():
+            if worker_ids != set(memberships[domain]):
+                transaction.set_data(
+                    self._domain_path(domain), self._serialize(sorted(worker_ids)),
+                    version=domain_nodes[domain][1])
+        if transaction.operations and \
+                any(isinstance(result, Exception) for result in transaction.commit()):
+            # domain nodes changed since we read them, next pass reads them again
+            LOG.warning('Domain workers not published, transaction rolled back')
+            self.trigger.notify(self.WORKERS_TRIGGER)
+            return
+
+        if update_time:
+            self.last_update_time = time_now
+
+    @classmethod
+    def balance_domains(
+            cls, workers: Dict[str, float], memberships: Dict[int, List[str]],
+            loads: Dict[int, Optional[float]], max_moves: int) -> Dict[int, Set[str]]:
+        """Return worker identities per domain
+
+        Dead workers are dropped, new ones join domain with highest load per capacity,
+        domains without workers get one. Then up to max_moves workers move from domain
+        with lowest to domain with highest load per capacity, while they differ more than
+        DOMAIN_DEVIATION and move lowers the highest one
+
+        :param workers: capacity weight per live worker identity
+        :param loads: aggregate load per domain, None if domain didn't publish it yet
+        """
+
+        domains = {domain: set() for domain in memberships}  # type: Dict[int, Set[str]]
+        assigned = set()  # type: Set[str]
+        for domain, worker_ids in sorted(memberships.items()):
+            for worker_id in worker_ids:
+                if worker_id in workers and worker_id not in assigned:
+                    domains[domain].add(worker_id)
+                    assigned.add(worker_id)
+
+        def weight(domain: int) -> float:
+            return math.fsum(workers[worker_id] for worker_id in domains[domain])
+
+        def pressure(domain: int) -> float:
+            domain_weight = weight(domain)
+            if not domain_weight:
+                return math.inf
+            return (loads.get(domain) or 0.0) / domain_weight
+
+        def move(worker_id: str, source: Optional[int], target: int) -> None:
+            if source is not None:
+                domains[source].discard(worker_id)
+            domains[target].add(worker_id)
+            LOG.info('Worker %s moved from domain %s to %s', worker_id, source, target)
+
+        for worker_id in sorted(set(workers) - assigned):
+            move(worker_id, None, max(
+                domains, key=lambda domain: (pressure(domain), -len(domains[domain]))))
+
+        for domain in sorted(domains):
+            if domains[domain]:
+                continue
+            source = max(domains, key=lambda other: len(domains[other]))
+            if len(domains[source]) > 1:
+                move(min(domains[source], key=lambda worker_id: (workers[worker_id], worker_id)),
+                     source, domain)
+
+        # domains without published load can't be compared yet
+        known_domains = [domain for domain in domains if loads.get(domain) is not None]
+        for _ in range(max_moves):
+            donors = [domain for domain in known_domains if len(domains[domain]) > 1]
+            if not donors or len(known_domains) < 2:
+                break
+            source = min(donors, key=pressure)
+            target = max(known_domains, key=pressure)
+            if source == target or \
+                    pressure(target) <= pressure(source) * (1 + cls.DOMAIN_DEVIATION):
+                break
+
+            worker_id = min(domains[source], key=lambda worker_id: (workers[worker_id], worker_id))
+            source_load, source_weight = loads[source] or 0.0, weight(source)
+            if source_load / (source_weight - workers[worker_id]) >= pressure(target):
+                break  # source would become the busiest domain
+            move(worker_id, source, target)
+
+        return domains
+
+    def _get_domain_workers(self, domain: int) -> Tuple[List[str], int]:
+        """Return identities of domain workers and version of domain node"""
+        try:
+            value, stat = self._zk.retry(self._zk.get, self._domain_path(domain))
+        except NoNodeError:
+            return [], -1
+        return list((self._deserialize(value) if value else None) or ()), stat.version
+
+    def _get_domain_load(self, domain: int) -> Optional[float]:
+        try:
+            state = self._get_node(self._domain_state_path(domain))
+        except NoNodeError:
+            return None
+        return state.get('load') if isinstance(state, dict) else None
@@ -1,34 +1,60 @@
-import time
+import threading
+from typing import Optional
 
 from .. import ZooKeeper
 
 
 class SchedulerElector(ZooKeeper):
     SCHEDULER_ELECTION_PATH = '/*/processing/election'
+    ELECTED_TRIGGER = 'elected'  # wakes standby thread waiting on runnable trigger
 
-    def __init__(self, identity: str, runnable) -> None:
+    def __init__(self, identity: str, runnable, election: Optional[str] = None) -> None:
+        """
+        :param election: (str) election under SCHEDULER_ELECTION_PATH, each scheduling
+            domain and DomainCoordinator elect their leader separately
+        """
         super().__init__()
 
         self.runnable = runnable
         self.identity = identity
+        self.election_path = self.SCHEDULER_ELECTION_PATH
+        if election is not None:
+            self.election_path = '{}/{}'.format(self.SCHEDULER_ELECTION_PATH, election)
+        self._elected = threading.Event()
 
         self._election()
 
     def _election(self):
         print('Running:', self.identity)
-        election = self._zk.Election(self.SCHEDULER_ELECTION_PATH, identifier=self.identity)
+        election = self._zk.Election(self.election_path, identifier=self.identity)
+
+        # standby keeps runnable state warm while waiting, so it can take over right away
+        standby = threading.Thread(target=self._standby, daemon=True)
+        standby.start()
 
         # call will block until this scheduler has won the election (raises as the next leader)
         # once this process is the leader we can start our 'normal' thread loop
-        election.run(self.run)
+        election.run(self.run, standby)
+
+    def _standby(self):
+        # runnable wakes on its own watches and timers, same as leader loop below
+        while not self._elected.is_set():
+            self.runnable.wait()
+            if not self._elected.is_set():
+                self.runnable.refresh_standby()
 
-    def run(self):
+    def run(self, standby: threading.Thread):
         print('Elected:', self.identity)
+        self._elected.set()
+        self.runnable.trigger.notify(self.ELECTED_TRIGGER)
+        standby.join()
+        self.runnable.take_over()
+
         while True:
             try:
+                # blocks until there is something to do, so idle leader doesn't poll
+                self.runnable.wait()
                 self.runnable.run()
             # TODO: this should be a custom exception that stops the infinite loop
             except Exception as e:
                 raise
-
-            time.sleep(1)
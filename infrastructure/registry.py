@@ -0,0 +1,109 @@
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from kazoo.client import KazooClient
+
+from .. import ZooKeeper
+from ..entities import Capacity
+
+
+class ChildDataCache:
+    """Decoded data of chosen children of node, kept up to date by data watch per child
+
+    Only children whose data changed are read and decoded again, watch of child
+    that is no longer chosen is removed on its next event
+    """
+
+    def __init__(self, client: KazooClient, path: str, decode: Callable[[bytes], Any],
+                 listener: Optional[Callable[[str, Any], None]] = None) -> None:
+        """
+        :param listener: called from watch thread with child name and its value, None if
+            child doesn't exist, when data of chosen child changes after it was chosen
+        """
+        self._zk = client
+        self._path = path
+        self._decode = decode
+        self._listener = listener
+        self._lock = threading.RLock()
+        # child name: token of its current watch, watches of replaced tokens remove themselves
+        self._watches = {}  # type: Dict[str, object]
+        self._values = {}  # type: Dict[str, Any]
+
+    @property
+    def values(self) -> Dict[str, Any]:
+        """Decoded data of existing chosen children"""
+        with self._lock:
+            return dict(self._values)
+
+    def watch(self, names: Iterable[str]) -> Dict[str, Any]:
+        """Chooses children to follow, returns their values"""
+        names = set(names)
+        with self._lock:
+            for name in self._watches.keys() - names:
+                del self._watches[name]
+                self._values.pop(name, None)
+            for name in names - self._watches.keys():
+                self._watch(name)
+            return dict(self._values)
+
+    def _watch(self, name: str) -> None:
+        token = self._watches[name] = object()
+        registered = False
+
+        @self._zk.DataWatch('{}/{}'.format(self._path, name))
+        def data_watch_func(data: Optional[bytes], stat: Any) -> Optional[bool]:
+            with self._lock:
+                if self._watches.get(name) is not token:
+                    return False  # removes the watch
+                value = None if stat is None else self._decode(data)
+                if value is None:
+                    self._values.pop(name, None)
+                else:
+                    self._values[name] = value
+            if registered and self._listener is not None:
+                self._listener(name, value)
+            return None
+
+        registered = True
+
+
+class WorkerRegistry(ZooKeeper):
+    """Nodes shared by scheduler, domain coordinator and workers
+
+    Workers register under WORKER_PATH with their capacity, scheduling domains
+    are numbered from 0 and have node under DOMAINS_PATH
+    """
+
+    WORKERS_DEVICES_PATH = '/*/processing/worker_dev'
+    WORKER_PATH = '/*/processing/workers'
+    # node per moved device, source worker deletes it once device is drained
+    HANDOFF_PATH = '/*/processing/handoff'
+    # node per scheduling domain with identities of its workers, written by DomainCoordinator
+    DOMAINS_PATH = '/*/processing/domains'
+
+    def __init__(self, client: Optional[KazooClient] = None) -> None:
+        super().__init__(client)
+
+        # capacity workers advertised in their nodes, worker identity: capacity
+        self._capacities = ChildDataCache(self._zk, self.WORKER_PATH, self._decode_capacity)
+
+    def _get_worker_capacities(self, worker_ids: Iterable[str]) -> Dict[str, Capacity]:
+        """Return capacity of registered workers of given ones
+
+        Worker nodes are watched, so only new and re-registered workers are read
+        """
+        return self._capacities.watch(worker_ids)
+
+    @classmethod
+    def _decode_capacity(cls, value: bytes) -> Capacity:
+        try:
+            return Capacity.from_dict(cls._deserialize(value))
+        except Exception:
+            # workers that don't advertise capacity get the default one
+            return Capacity()
+
+    def _domain_path(self, domain: int) -> str:
+        return '{}/{}'.format(self.DOMAINS_PATH, domain)
+
+    def _domain_state_path(self, domain: int) -> str:
+        return '{}/{}/state'.format(self.DOMAINS_PATH, domain)
@@ -0,0 +1,221 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from kazoo.client import KazooClient, KazooState
+from kazoo.exceptions import NoNodeError
+
+from ..entities import Capacity
+from .codec import decode_device_ids, decode_partition_id
+from .registry import WorkerRegistry
+
+LOG = logging.getLogger(__name__)
+
+# gets device ids added to or removed from worker
+DevicesCallback = Callable[[FrozenSet[int]], None]
+
+
+class WorkerAssignmentClient(WorkerRegistry):
+    """Worker's side of WorkerDeviceMapper
+
+    Registers worker's ephemeral node with its capacity, watches worker's assignment node
+    and keeps assigned device ids in memory. Callbacks get only devices added or removed
+    since last change, node versions already applied are not even decoded, so reconnects
+    don't replay the whole assignment. Change is applied only once callbacks return, if one
+    raises the change is applied again on next node change.
+
+    Devices moved away are acknowledged to scheduler once `on_removed` returns, so it has
+    to stop processing them before returning. Worker moved to other domain keeps devices
+    of previous domain until its scheduler moves them away and deletes worker's node there
+    """
+
+    def __init__(self,
+                 identity: str,
+                 on_added: DevicesCallback,
+                 on_removed: DevicesCallback,
+                 capacity: Optional[Capacity] = None,
+                 client: Optional[KazooClient] = None,
+                 domains: bool = False) -> None:
+        """
+        :param domains: (bool) scheduling is sharded to domains, worker follows the domain
+            DomainCoordinator puts it in
+        """
+        super().__init__(client)
+
+        self.identity = identity
+        self.capacity = capacity or Capacity()
+        self._on_added = on_added
+        self._on_removed = on_removed
+        self._devices = frozenset()  # type: FrozenSet[int]
+        # devices and (czxid, version) of last applied assignment node per followed domain
+        self._domain_devices = {}  # type: Dict[Optional[int], FrozenSet[int]]
+        self._versions = {}  # type: Dict[Optional[int], Tuple[int, int]]
+        self._domain = None  # type: Optional[int]
+        self._domain_watches = set()  # type: Set[int]
+        # domains whose assignment node is watched
+        self._assignment_watches = set()  # type: Set[Optional[int]]
+        # assignment and domain watches and reconnects don't interleave
+        self._lock = threading.RLock()
+        self._session_lost = False
+
+        self._zk.add_listener(self._state_listener)
+        self._register()
+
+        if domains:
+            self._create_node(path=self.DOMAINS_PATH)
+            self._zk.ChildrenWatch(self.DOMAINS_PATH)(self._watch_domains)
+        else:
+            self._watch_assignment(None)
+
+    @property
+    def devices(self) -> FrozenSet[int]:
+        """Device ids assigned to worker"""
+        return self._devices
+
+    def close(self) -> None:
+        """Leaves the fleet, scheduler moves devices of worker to others"""
+        self._zk.remove_listener(self._state_listener)
+        try:
+            self._delete_node(self._worker_path, recursive=False)
+        except NoNodeError:
+            pass
+
+    def _register(self) -> None:
+        """Creates ephemeral worker node with capacity of worker"""
+
+        if not self._create_node(self._worker_path, self.capacity.to_dict(), ephemeral=True):
+            # left by previous session, it would disappear once that session expires
+            try:
+                self._delete_node(self._worker_path, recursive=False)
+            except NoNodeError:
+                pass
+            self._create_node(self._worker_path, self.capacity.to_dict(), ephemeral=True)
+
+    def _state_listener(self, state: str) -> None:
+        """Registers worker again after session loss, watches are restored by kazoo"""
+
+        if state == KazooState.LOST:
+            self._session_lost = True
+        elif state == KazooState.CONNECTED and self._session_lost:
+            self._session_lost = False
+            # listener runs in connection thread, Zookeeper calls would block it
+            threading.Thread(target=self._register, daemon=True).start()
+
+    def _watch_domains(self, domains: List[str]) -> None:
+        with self._lock:
+            for domain in map(int, domains):
+                if domain not in self._domain_watches:
+                    self._domain_watches.add(domain)
+                    self._watch_domain(domain)
+
+    def _watch_domain(self, domain: int) -> None:
+        @self._zk.DataWatch(self._domain_path(domain))
+        def domain_watch_func(data: Optional[bytes], stat: Any) -> None:
+            """Follows worker moved to domain by DomainCoordinator"""
+
+            worker_ids = self._deserialize(data) if data else None
+            with self._lock:
+                if self.identity in (worker_ids or ()) and domain != self._domain:
+                    self._watch_assignment(domain)
+
+    def _watch_assignment(self, domain: Optional[int]) -> None:
+        path = self._worker_devices_path(domain)
+        with self._lock:
+            self._domain = domain
+            LOG.info('Worker %s follows assignment in %s', self.identity, path)
+            if domain in self._assignment_watches:
+                # worker came back before previous domain watch stopped
+                return
+            self._assignment_watches.add(domain)
+
+        @self._zk.DataWatch(path)
+        def assignment_watch_func(data: Optional[bytes], stat: Any) -> Optional[bool]:
+            """Applies changed assignment of domain, stops once worker follows
+            other domain and its node there is gone
+            """
+
+            with self._lock:
+                self._apply_assignment(domain, data, stat)
+                if stat is None and domain != self._domain:
+                    self._assignment_watches.discard(domain)
+                    return False  # removes the watch
+            return None
+
+    def _apply_assignment(self, domain: Optional[int], data: Optional[bytes],
+                          stat: Any) -> None:
+        """Calls callbacks with assignment changes of domain, removed devices first,
+        state is updated after each callback returns
+        """
+
+        version = (stat.czxid, stat.version) if stat is not None else None
+        if version == self._versions.get(domain):
+            # also node of newly followed domain that is not written yet
+            return
+
+        current = self._domain_devices.get(domain, frozenset())
+        devices = frozenset(decode_device_ids(data)) if data else frozenset()
+        removed_devices = current - devices
+        added_devices = devices - current
+
+        if removed_devices:
+            self._on_removed(removed_devices)
+            self._set_domain_devices(domain, current - removed_devices)
+            self._acknowledge_handoffs(removed_devices, domain)
+        if added_devices:
+            self._on_added(added_devices)
+            self._set_domain_devices(domain, devices)
+
+        if version is None:
+            self._versions.pop(domain, None)
+        else:
+            self._versions[domain] = version
+
+    def _set_domain_devices(self, domain: Optional[int], devices: FrozenSet[int]) -> None:
+        if devices:
+            self._domain_devices[domain] = devices
+        else:
+            self._domain_devices.pop(domain, None)
+        self._devices = frozenset().union(*self._domain_devices.values())
+
+    def _acknowledge_handoffs(self, device_ids: FrozenSet[int], domain: Optional[int]) -> None:
+        """Deletes handoff nodes of drained devices, their partitions and merged devices,
+        in domain devices came from, so scheduler activates them on their new worker
+        """
+
+        handoff_path = self._handoff_path(domain)
+        try:
+            children = self._get_children(path=handoff_path)
+        except NoNodeError:
+            return
+
+        parent_ids = {decode_partition_id(device_id)[0] for device_id in device_ids}
+        requests = []
+        for child in children:
+            handoff_id = int(child)
+            if (handoff_id in device_ids or handoff_id in parent_ids or
+                    decode_partition_id(handoff_id)[0] in device_ids):
+                path = '{}/{}'.format(handoff_path, child)
+                requests.append((path, self._zk.get_async(path)))
+
+        for path, request in requests:
+            try:
+                source, _ = self._deserialize(request.get()[0])
+                if source == self.identity:
+                    self._zk.retry(self._zk.delete, path)
+            except NoNodeError:
+                # handoff timed out meanwhile
+                continue
+
+    @property
+    def _worker_path(self) -> str:
+        return '{}/{}'.format(self.WORKER_PATH, self.identity)
+
+    def _worker_devices_path(self, domain: Optional[int]) -> str:
+        if domain is None:
+            return '{}/{}'.format(self.WORKERS_DEVICES_PATH, self.identity)
+        return '{}/{}/{}'.format(self.WORKERS_DEVICES_PATH, domain, self.identity)
+
+    def _handoff_path(self, domain: Optional[int]) -> str:
+        if domain is None:
+            return self.HANDOFF_PATH
+        return '{}/{}'.format(self.HANDOFF_PATH, domain)
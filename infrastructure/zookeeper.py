@@ -17,33 +17,46 @@ class ZooKeeper:
     """Helper ZooKeeper function that handles connection and node updates"""
 
     @Retry(exception_list=[ConnectionLoss, SessionExpiredError, KazooTimeoutError])
-    def __init__(self) -> None:
-        hosts = settings.ZOO_HOSTS
-        retry = KazooRetry(max_tries=-1, max_delay=60)
-        self._zk = KazooClient(hosts, connection_retry=retry, command_retry=retry)
+    def __init__(self, client: Optional[KazooClient] = None) -> None:
+        if client is None:
+            hosts = settings.ZOO_HOSTS
+            retry = KazooRetry(max_tries=-1, max_delay=60)
+            client = KazooClient(hosts, connection_retry=retry, command_retry=retry)
+        self._zk = client
 
         # establish the connection
         self._zk.start()
 
+    @staticmethod
+    def _serialize(value: Any) -> bytes:
+        return pickle.dumps(value)
+
+    @staticmethod
+    def _deserialize(value: bytes) -> Any:
+        return pickle.loads(value)
+
     def _set_node(
             self, path: str, value: Optional[Any] = None, ephemeral: bool = False) -> None:
         try:
             self._zk.retry(
                 self._zk.set,
                 path=path,
-                value=pickle.dumps(value) or None
+                value=self._serialize(value)
             )
         except NoNodeError:
             self._create_node(path, value, ephemeral)
 
     def _get_node(self, path: str) -> Any:
+        return self._deserialize(self._get_node_data(path))
+
+    def _get_node_data(self, path: str) -> bytes:
         # NoNodeError needs to be handled differently, so we dont handle it here
         value, *_ = self._zk.retry(
             self._zk.get,
             path=path,
             watch=False
         )
-        return pickle.loads(value)
+        return value
 
     def _get_children(self, path: str) -> Any:
         # NoNodeError needs to be handled differently, so we dont handle it here
@@ -71,7 +84,7 @@ class ZooKeeper:
                 self._zk.create,
                 path=path,
                 ephemeral=ephemeral,
-                value=pickle.dumps(value) or None,
+                value=self._serialize(value),
                 makepath=True
             )
             return True
@@ -0,0 +1,779 @@
+import heapq
+import math
+from bisect import bisect
+from collections import defaultdict
+from operator import attrgetter
+from typing import Dict, List, Optional, Set, Tuple
+
+from ..helpers.metrics import METRICS
+from ..infrastructure.cache import Cache
+from ..infrastructure.codec import device_key
+from .device_table import DEVICE_TABLE, MSG_COUNT_WEIGHT, PROC_TIME_WEIGHT
+from .entities import BalanceReport, Database, Device, Worker
+
+# balance phase of full rebalance includes its cache_fetch
+PHASE_SECONDS = METRICS.histogram(
+    'scheduler_phase_seconds', 'Duration of scheduler cycle phases in seconds',
+    labels=('phase',))
+
+
+class Balancer:
+    """Balancing functions strategies are built from, Scheduler keeps an instance
+
+    Functions reassign devices of given workers in place, previous devices of workers
+    are kept where balance allows
+    """
+
+    DATABASE_LOAD_PER_WORKER = 0.5  # index 1 how much of worker's load can be from one database
+    DATABASE_CANDIDATES = 3  # least loaded workers checked for room per device
+
+    @staticmethod
+    def fetch_cache_data(
+            devices: Set[Device], cache: Cache,
+            batch_size: Optional[int] = None) -> Tuple[Set[Device], int, float]:
+        """Updated Device fields for load index calculation and resets cache
+
+        Returns updated Device set, system msg count and system processing_time
+
+        :param batch_size: keys per cache round trip, cache's BATCH_SIZE if not given
+        """
+
+        ordered_devices = list(devices)
+        keys = [device_key(device.id_) for device in ordered_devices]
+        with PHASE_SECONDS.time(phase='cache_fetch'):
+            try:
+                values = cache.fetch_and_reset_fields(
+                    keys, (cache.COUNT_FIELD, cache.PROC_TIME_FIELD), batch_size)
+            except AttributeError:
+                values = [(device.msg_count, device.proc_time) for device in ordered_devices]
+
+        for device, (msg_count, proc_time) in zip(ordered_devices, values):
+            device.msg_count, device.proc_time = msg_count, proc_time
+            device.load_index = 0
+
+        system_msg_count = sum(device.msg_count for device in devices)
+        interval = sum(device.proc_time for device in devices)
+
+        return devices, system_msg_count, interval
+
+    @classmethod
+    def device_load_index_formula(
+            cls, device: Device, decimal_points: int,
+            interval: float, system_msg_count: int) -> None:
+        """Updates load index for given Device"""
+
+        try:
+            load_index = round(
+                (device.proc_time * PROC_TIME_WEIGHT / interval +
+                 device.msg_count * MSG_COUNT_WEIGHT / system_msg_count) /
+                (PROC_TIME_WEIGHT + MSG_COUNT_WEIGHT), decimal_points
+            )
+        except ZeroDivisionError:
+            load_index = 0
+        device.load_index = load_index
+
+    @classmethod
+    def balance_with_load_indexes(
+            cls, workers: Set[Worker], devices: Set[Device], worker_deviation: float,
+            interval: float, system_msg_count: int, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        """Balances workers with device load indexes
+
+        Devices stay on their worker while it's under deviated load, the rest are assigned
+        heaviest first to the least loaded worker from priority queue
+
+        :param load_smoothing: weight of current interval in smoothed device load index,
+            1 uses only current interval
+        :param migration_cost: index 1 how much % of worker load over deviated load
+            worker can keep, and how much % of average load moving a device has to take
+            off the heavier of its old and new worker
+        """
+
+        # calculate decimal points depending on number of devices
+        decimal_points = len([c for c in str(len(devices))])
+        decimal_points = math.ceil(decimal_points + (decimal_points*5/4))
+
+        # devices share one table, load is computed and ordered on its columns
+        device_by_row = {device.row: device for device in devices}
+        table = next(iter(devices)).table if devices else DEVICE_TABLE
+        table.compute_load_indexes(
+            list(device_by_row), decimal_points, interval, system_msg_count)
+        table.smooth_load_indexes(list(device_by_row), load_smoothing)
+
+        # workers by index, heavier workers win devices listed more than once,
+        # passes below work on table rows and worker indexes instead of objects
+        worker_list = sorted(workers, reverse=True)
+        weights = [worker.capacity.weight for worker in worker_list]
+        identities = [worker.identity for worker in worker_list]
+        max_devices = [
+            math.inf if worker.capacity.max_devices is None else worker.capacity.max_devices
+            for worker in worker_list
+        ]
+
+        # calculate how much load can worker have, smoothed load doesn't sum up to exactly 1,
+        # workers get share of load proportional to their capacity
+        total_load = table.total_load(device_by_row)
+        total_weight = sum(weights)
+        deviation_per_worker_load = []  # type: List[float]
+        for weight in weights:
+            load_per_worker = round(total_load * weight / total_weight, decimal_points)
+
+            # how much 'extra' load worker can get to try to keep it's devices
+            deviation_per_worker_load.append(
+                load_per_worker + load_per_worker * (worker_deviation + migration_cost))
+
+        # rows of devices each worker had, devices of other tables are matched by id,
+        # device set of worker holding only rows of this table can be reused
+        owned_rows = []  # type: List[List[int]]
+        same_table = []  # type: List[bool]
+        row_by_id = None  # type: Optional[Dict[int, int]]
+        for worker in worker_list:
+            rows = [device.row for device in worker.devices if device.table is table]
+            same_table.append(len(rows) == len(worker.devices))
+            if not same_table[-1]:
+                if row_by_id is None:
+                    row_by_id = {device.id_: row for row, device in device_by_row.items()}
+                rows.extend(
+                    row_by_id[device.id_] for device in worker.devices
+                    if device.table is not table and device.id_ in row_by_id)
+            owned_rows.append(rows)
+
+        loads, kept, leftover_rows, leftover_owners = table.keep_on_owners(
+            table.order_by_load(device_by_row, reverse=True), owned_rows,
+            deviation_per_worker_load, max_devices)
+        counts = [len(rows) for rows in kept]
+        # rows taken from each worker and rows it gets
+        taken = [[] for _ in worker_list]  # type: List[List[int]]
+        added = [[] for _ in worker_list]  # type: List[List[int]]
+        device_owner = {}  # type: Dict[int, int]
+        for row, index in zip(leftover_rows, leftover_owners):
+            if index >= 0:
+                taken[index].append(row)
+                device_owner[row] = index
+        load_index = table.load_index
+
+        # priority queue of load relative to capacity, identity breaks ties,
+        # full workers leave the queue until all workers are full
+        def queue_entry(index: int) -> Tuple[float, int, str, int]:
+            return loads[index] / weights[index], counts[index], identities[index], index
+
+        def assign(index: int, row: int) -> None:
+            loads[index] += load_index[row]
+            counts[index] += 1
+            added[index].append(row)
+
+        # load per capacity moving a device has to gain
+        move_gain = migration_cost * total_load / total_weight if total_weight else 0.0
+
+        ignore_capacity = False
+        worker_queue = [queue_entry(index) for index in range(len(worker_list))
+                        if counts[index] < max_devices[index]]
+        heapq.heapify(worker_queue)
+        for row in leftover_rows:
+            # entries of workers that kept a device are out of date
+            while worker_queue and \
+                    worker_queue[0][:2] != queue_entry(worker_queue[0][-1])[:2]:
+                index = worker_queue[0][-1]
+                if ignore_capacity or counts[index] < max_devices[index]:
+                    heapq.heapreplace(worker_queue, queue_entry(index))
+                else:
+                    heapq.heappop(worker_queue)
+            if not worker_queue:
+                # every worker is full, rest of devices is spread ignoring capacity
+                ignore_capacity = True
+                worker_queue = [queue_entry(index) for index in range(len(worker_list))]
+                heapq.heapify(worker_queue)
+            index = worker_queue[0][-1]
+
+            owner = device_owner.get(row)
+            if migration_cost and owner is not None and owner != index and \
+                    counts[owner] < max_devices[owner] and not cls._move_pays_off(
+                        loads[owner], weights[owner], loads[index], weights[index],
+                        load_index[row], move_gain):
+                assign(owner, row)
+                continue
+
+            assign(index, row)
+            if ignore_capacity or counts[index] < max_devices[index]:
+                heapq.heapreplace(worker_queue, queue_entry(index))
+            else:
+                heapq.heappop(worker_queue)
+
+        for index, worker in enumerate(worker_list):
+            if same_table[index] and len(worker.devices) == len(kept[index]) + len(
+                    taken[index]):
+                # set copy keeps hashes, only changed devices are hashed
+                devices_of_worker = worker.devices.difference(
+                    device_by_row[row] for row in taken[index])
+            else:
+                devices_of_worker = {device_by_row[row] for row in kept[index]}
+            devices_of_worker.update(device_by_row[row] for row in added[index])
+            worker.devices = devices_of_worker
+            worker.load_index = loads[index]
+
+        return workers
+
+    @staticmethod
+    def _move_pays_off(source_load: float, source_weight: float, target_load: float,
+                       target_weight: float, load: float, gain: float) -> bool:
+        """Helper for load balancing, whether moving device of given load from source
+        to target lowers load per capacity of the heavier of the two by more than gain
+        """
+        kept = (source_load + load) / source_weight
+        moved = max(source_load / source_weight, (target_load + load) / target_weight)
+        return kept - moved > gain
+
+    @classmethod
+    def balance_with_databases(
+            cls, workers: Set[Worker], devices: Set[Device], worker_deviation: float,
+            interval: float, system_msg_count: int,
+            max_database_load: float = DATABASE_LOAD_PER_WORKER, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        """Worker rebalance method like balance_with_load_indexes, which also keeps devices
+        of same database on as few workers as possible
+
+        Load worker carries from single database is capped, so hot database is split
+        between just enough workers, database too heavy for the cap is split between all
+        workers instead. Leftover devices go to the least loaded worker
+        already reading their database, new worker starts reading it only if none has room.
+        Without load every device counts the same
+
+        :param max_database_load: index 1 how much of worker's load share can come from
+            single database
+        """
+
+        decimal_points = len([c for c in str(len(devices))])
+        decimal_points = math.ceil(decimal_points + (decimal_points*5/4))
+
+        device_by_row = {device.row: device for device in devices}
+        table = next(iter(devices)).table if devices else DEVICE_TABLE
+        table.compute_load_indexes(
+            list(device_by_row), decimal_points, interval, system_msg_count)
+        table.smooth_load_indexes(list(device_by_row), load_smoothing)
+
+        # devices are placed by weight, their load, or same weight for all if there is
+        # no load, device and database rows are shared so they keep the real load
+        weight = {device: device.load_index for device in devices}  # type: Dict[Device, float]
+        total_load = table.total_load(device_by_row)
+        if not total_load:
+            weight = dict.fromkeys(devices, 1 / len(devices))
+            total_load = 1
+
+        total_weight = sum(worker.capacity.weight for worker in workers)
+        worker_limit = {}  # type: Dict[Worker, float]
+        database_limit = {}  # type: Dict[Worker, float]
+        for worker in workers:
+            load_per_worker = total_load * worker.capacity.weight / total_weight
+            worker_limit[worker] = (
+                load_per_worker + load_per_worker * (worker_deviation + migration_cost))
+            database_limit[worker] = load_per_worker * max_database_load
+
+        databases = {}  # type: Dict[str, Database]
+        database_weight = defaultdict(float)  # type: Dict[str, float]
+        device_database = {}  # type: Dict[Device, Optional[str]]
+        for device in devices:
+            device_database[device] = name = device.database
+            if name is not None:
+                database = databases.setdefault(name, Database(name))
+                database.devices.add(device)
+                database.load_index += device.load_index
+                database_weight[name] += weight[device]
+
+        def get_database_limit(worker: Worker, name: str) -> float:
+            # database can always be spread over all workers within worker deviation
+            return max(database_limit[worker], database_weight[name] *
+                       worker.capacity.weight / total_weight * (1 + worker_deviation))
+
+        device_owner = {}  # type: Dict[Device, Worker]
+        for worker in sorted(workers, reverse=True):
+            for device in worker.devices:
+                device_owner.setdefault(device, worker)
+            worker.devices = set()
+            worker.databases = set()
+            worker.load_index = 0
+
+        # weight of workers and of database per worker, workers reading database
+        worker_load = defaultdict(float)  # type: Dict[Worker, float]
+        database_load = defaultdict(float)  # type: Dict[Tuple[Worker, str], float]
+        readers = defaultdict(set)  # type: Dict[str, Set[Worker]]
+
+        def fits(worker: Worker, device: Device) -> bool:
+            name = device_database[device]
+            return (
+                worker_load[worker] + weight[device] < worker_limit[worker] and
+                not worker.capacity.is_full(len(worker)) and (
+                    name is None or database_load[worker, name] + weight[device] <=
+                    get_database_limit(worker, name))
+            )
+
+        def queue_entry(worker: Worker) -> Tuple[float, int, str, Worker]:
+            return (worker_load[worker] / worker.capacity.weight, len(worker), worker.identity,
+                    worker)
+
+        # min heaps of workers by relative load, of all workers and of readers per database,
+        # entries are not removed on assign, out of date ones are skipped or refreshed
+        worker_queue = []  # type: List[Tuple[float, int, str, Worker]]
+        reader_queues = defaultdict(list)  # type: Dict[str, List]
+        # last entry pushed to reader queue, older entries of worker are dropped
+        reader_entries = {}  # type: Dict[Tuple[str, Worker], Tuple[float, int]]
+
+        def push_reader(name: str, worker: Worker) -> None:
+            entry = queue_entry(worker)
+            reader_entries[name, worker] = entry[:2]
+            heapq.heappush(reader_queues[name], entry)
+
+        def assign(worker: Worker, device: Device) -> None:
+            worker.add_device(device)
+            worker.load_index += device.load_index
+            worker_load[worker] += weight[device]
+            name = device_database[device]
+            if name is not None:
+                database_load[worker, name] += weight[device]
+                readers[name].add(worker)
+                worker.databases.add(databases[name])
+                push_reader(name, worker)
+            heapq.heappush(worker_queue, queue_entry(worker))
+
+        def pick(queue: List, device: Device, name: Optional[str] = None) -> Optional[Worker]:
+            """Least loaded of first DATABASE_CANDIDATES workers in queue that device fits,
+            queue of all workers if name is None, else of database readers
+            """
+            checked = []  # type: List[Tuple[float, int, str, Worker]]
+            worker = None
+            while queue and len(checked) < cls.DATABASE_CANDIDATES and worker is None:
+                entry = heapq.heappop(queue)
+                if name is not None and entry[:2] != reader_entries[name, entry[-1]]:
+                    continue
+                if entry[:2] != queue_entry(entry[-1])[:2]:
+                    # reader load changed by device of other database
+                    if name is not None:
+                        push_reader(name, entry[-1])
+                    continue
+                checked.append(entry)
+                if fits(entry[-1], device):
+                    worker = entry[-1]
+            for entry in checked:
+                heapq.heappush(queue, entry)
+            return worker
+
+        leftover_devices = []  # type: List[Device]
+        for row in table.order_by_load(device_by_row, reverse=True):
+            device = device_by_row[row]
+            worker = device_owner.get(device)
+            if worker is not None and fits(worker, device):
+                assign(worker, device)
+            else:
+                leftover_devices.append(device)
+
+        # devices of same database are placed together, heaviest database first
+        leftover_devices.sort(key=lambda device: (
+            device_database[device] is None,
+            -database_weight[device_database[device]],
+            device_database[device] or '', -weight[device], device.id_
+        ))
+
+        worker_queue[:] = [queue_entry(worker) for worker in workers]
+        heapq.heapify(worker_queue)
+        reader_queues.clear()
+        for name, database_readers in readers.items():
+            for worker in database_readers:
+                push_reader(name, worker)
+
+        for device in leftover_devices:
+            name = device_database[device]
+            worker = pick(reader_queues[name], device, name) if name in reader_queues else None
+            if worker is None:
+                worker = pick(worker_queue, device)
+            if worker is None:
+                # least loaded workers have no room, limits are exceeded on the least loaded
+                while worker_queue[0][:2] != queue_entry(worker_queue[0][-1])[:2]:
+                    heapq.heappop(worker_queue)
+                worker = worker_queue[0][-1]
+            assign(worker, device)
+
+        return workers
+
+    @staticmethod
+    def _sort_workers(worker: Worker) -> Tuple[int, int]:
+        """Helper sorting method when we have no load indexes"""
+
+        try:
+            return len(worker), min(device.id_ for device in worker.devices)
+        except ValueError:
+            return len(worker), 0
+
+    @staticmethod
+    def get_devices_per_worker(worker_count: int, devices_count: int) -> List[int]:
+        """Calculates how many devices can be assigned per worker
+
+        Return example: 3 workers, 8 devices: [3, 3, 2]
+        """
+        devices_per_worker = []
+
+        while worker_count:
+            try:
+                per_worker = math.ceil(devices_count/worker_count)
+            except ZeroDivisionError:
+                per_worker = 0
+            devices_per_worker.append(per_worker)
+            devices_count -= per_worker
+            worker_count -= 1
+        return devices_per_worker
+
+    @staticmethod
+    def get_worker_quotas(workers: List[Worker], devices_count: int) -> Dict[Worker, int]:
+        """Calculates how many devices can be assigned per worker, proportional to worker
+        capacity and limited by its max devices, earlier workers get the rounded up quotas
+
+        Workers hold state of their devices in memory, so quotas follow advertised memory
+        once every worker advertises it, cores otherwise
+
+        Return example: 3 workers with same capacity, 8 devices: {w1: 3, w2: 3, w3: 2}
+        """
+        by_memory = bool(workers) and all(worker.capacity.memory for worker in workers)
+
+        def weight(worker: Worker) -> float:
+            return worker.capacity.memory if by_memory else worker.capacity.weight
+
+        # max devices are ignored when all workers together can't hold all devices
+        limited = sum(
+            worker.capacity.max_devices if worker.capacity.max_devices is not None
+            else devices_count for worker in workers
+        ) >= devices_count
+
+        quotas = {}  # type: Dict[Worker, int]
+        open_workers = list(workers)
+        while open_workers:
+            remaining = devices_count - sum(quotas.values())
+            total_weight = sum(weight(worker) for worker in open_workers)
+            shares = [remaining * weight(worker) / total_weight for worker in open_workers]
+
+            # largest remainder, ties in worker order
+            counts = [math.floor(share) for share in shares]
+            order = sorted(range(len(open_workers)), key=lambda i: counts[i] - shares[i])
+            for i in order[:remaining - sum(counts)]:
+                counts[i] += 1
+
+            capped = [
+                (worker, count) for worker, count in zip(open_workers, counts)
+                if limited and worker.capacity.max_devices is not None and
+                count > worker.capacity.max_devices
+            ]
+            if not capped:
+                quotas.update(zip(open_workers, counts))
+                break
+
+            # full workers get their max, rest is split again between the others
+            for worker, _ in capped:
+                quotas[worker] = worker.capacity.max_devices
+                open_workers.remove(worker)
+        return quotas
+
+    @classmethod
+    def balance_with_count_per_worker(
+            cls, workers: Set[Worker], devices: Set[Device]) -> Set[Worker]:
+        """Worker rebalance method which assigns number of devices proportional to worker
+        capacity per worker with minimal changes to worker's assigned devices
+        """
+
+        ordered_workers = sorted(workers, key=cls._sort_workers, reverse=True)
+
+        # quotas are computed once, bigger ones go to workers that already hold more devices
+        worker_quota = cls.get_worker_quotas(ordered_workers, len(devices))
+        device_owner = {}  # type: Dict[Device, Worker]
+        for worker in ordered_workers:
+            for device in worker.devices:
+                device_owner.setdefault(device, worker)
+            worker.devices = set()
+            worker.load_index = 0
+
+        leftover_devices = []  # type: List[Device]
+        for device in sorted(devices, key=attrgetter('id_')):
+            worker = device_owner.get(device)
+            if worker is not None and len(worker) < worker_quota[worker]:
+                worker.add_device(device)
+            else:
+                leftover_devices.append(device)
+
+        # min heap of workers still under their quota, identity breaks ties
+        worker_queue = [(len(worker), worker.identity, worker)
+                        for worker in ordered_workers if len(worker) < worker_quota[worker]]
+        heapq.heapify(worker_queue)
+        for leftover_device in leftover_devices:
+            _, identity, worker = worker_queue[0]
+            worker.add_device(leftover_device)
+            if len(worker) < worker_quota[worker]:
+                heapq.heapreplace(worker_queue, (len(worker), identity, worker))
+            else:
+                heapq.heappop(worker_queue)
+
+        return workers
+
+    @staticmethod
+    def _worker_weight(worker: Worker, by_load: bool) -> float:
+        """Helper for incremental rebalance, worker load or device count per capacity"""
+        return (worker.load_index if by_load else len(worker)) / worker.capacity.weight
+
+    @staticmethod
+    def _pick_device_to_move(worker: Worker, gap: float, by_load: bool) -> Optional[Device]:
+        """Helper for incremental rebalance, picks device which moved reduces weight gap most
+
+        Returns None if no device would make the gap smaller
+        """
+        # device as heavy as the gap only swaps the workers, float noise must not make
+        # it look like progress, or it moves back and forth forever
+        if not by_load:
+            return max(worker.devices, key=attrgetter('id_')) \
+                if gap > 1 and not math.isclose(gap, 1) else None
+
+        candidates = [
+            device for device in worker.devices
+            if 0 < device.load_index < gap and not math.isclose(device.load_index, gap)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda device: (abs(gap / 2 - device.load_index), device.id_))
+
+    @staticmethod
+    def _pick_devices_to_swap(
+            donor: Worker, receiver: Worker, gap: float) -> Optional[Tuple[Device, Device]]:
+        """Helper for move budget balancing, picks donor and receiver device which swapped
+        reduce load gap most
+
+        Returns None if no swap would make the gap smaller
+        """
+        receiver_devices = sorted(receiver.devices, key=attrgetter('load_index', 'id_'))
+        receiver_loads = [device.load_index for device in receiver_devices]
+
+        best_swap, best_distance = None, gap / 2
+        for device in donor.devices:
+            # swap is best when loads differ by half of the gap
+            position = bisect(receiver_loads, device.load_index - gap / 2)
+            for other in receiver_devices[max(position - 1, 0):position + 1]:
+                difference = device.load_index - other.load_index
+                if 0 < difference < gap and abs(gap / 2 - difference) < best_distance:
+                    best_swap, best_distance = (device, other), abs(gap / 2 - difference)
+        return best_swap
+
+    @classmethod
+    def balance_with_move_budget(
+            cls, workers: Set[Worker], devices: Set[Device], interval: float,
+            system_msg_count: int, max_moves: int,
+            load_smoothing: float = 1.0) -> Tuple[Set[Worker], BalanceReport]:
+        """Balances workers with device load indexes, lowering heaviest worker load
+        with at most max_moves devices changing worker
+
+        Devices stay on their worker, new and orphaned devices are packed heaviest first
+        to the least loaded worker, then device moves and swaps between heaviest and
+        lightest worker are applied while they lower the gap and budget allows
+        """
+
+        decimal_points = len([c for c in str(len(devices))])
+        decimal_points = math.ceil(decimal_points + (decimal_points*5/4))
+
+        device_by_row = {device.row: device for device in devices}
+        table = next(iter(devices)).table if devices else DEVICE_TABLE
+        table.compute_load_indexes(
+            list(device_by_row), decimal_points, interval, system_msg_count)
+        table.smooth_load_indexes(list(device_by_row), load_smoothing)
+
+        device_owner = {}  # type: Dict[Device, Worker]
+        for worker in sorted(workers, reverse=True):
+            for device in worker.devices:
+                device_owner.setdefault(device, worker)
+            worker.devices = set()
+            worker.load_index = 0
+
+        unplaced_devices = []  # type: List[Device]
+        for row in table.order_by_load(device_by_row, reverse=True):
+            device = device_by_row[row]
+            worker = device_owner.get(device)
+            if worker is not None:
+                worker.add_device(device)
+                worker.load_index += device.load_index
+            else:
+                unplaced_devices.append(device)
+
+        worker_queue = [(worker.load_index, len(worker), worker.identity, worker)
+                        for worker in workers]
+        heapq.heapify(worker_queue)
+        for device in unplaced_devices:
+            *_, identity, worker = worker_queue[0]
+            worker.add_device(device)
+            worker.load_index += device.load_index
+            heapq.heapreplace(
+                worker_queue, (worker.load_index, len(worker), identity, worker))
+
+        moves = 0
+        worker_order = attrgetter('load_index', 'identity')
+        while moves < max_moves:
+            donor = max(workers, key=worker_order)
+            receiver = min(workers, key=worker_order)
+            gap = donor.load_index - receiver.load_index
+
+            # candidates are (donor device, receiver device), the closer the load they move
+            # is to half of the gap, the lower the heaviest of the two workers gets
+            candidates = []
+            device = cls._pick_device_to_move(donor, gap, by_load=True)
+            if device is not None:
+                candidates.append((device, None))
+            if moves + 2 <= max_moves:
+                swap = cls._pick_devices_to_swap(donor, receiver, gap)
+                if swap is not None:
+                    candidates.append(swap)
+            if not candidates:
+                break
+
+            donor_device, receiver_device = min(candidates, key=lambda candidate: abs(
+                gap / 2 - candidate[0].load_index +
+                (candidate[1].load_index if candidate[1] is not None else 0)))
+
+            donor.devices.discard(donor_device)
+            donor.load_index -= donor_device.load_index
+            receiver.add_device(donor_device)
+            receiver.load_index += donor_device.load_index
+            moves += 1
+            if receiver_device is not None:
+                receiver.devices.discard(receiver_device)
+                receiver.load_index -= receiver_device.load_index
+                donor.add_device(receiver_device)
+                donor.load_index += receiver_device.load_index
+                moves += 1
+
+        average_load = sum(worker.load_index for worker in workers) / len(workers)
+        heaviest_load = max(worker.load_index for worker in workers)
+        imbalance_ratio = round(heaviest_load / average_load, 4) if average_load else 1.0
+
+        return workers, BalanceReport(imbalance_ratio, moves)
+
+    @classmethod
+    def rebalance_incremental(
+            cls, workers: Set[Worker], added_devices: Set[Device],
+            removed_devices: Set[Device], added_workers: Set[Worker],
+            removed_workers: Set[Worker], worker_deviation: float = 0.0) -> Set[Worker]:
+        """Applies device and worker changes to the previous assignment
+
+        Only orphaned and added devices are placed, and devices are moved only until
+        underloaded workers get their share, so cost follows the size of the change
+        """
+
+        workers = set(workers) - removed_workers
+
+        orphan_devices = set(added_devices)
+        for worker in removed_workers:
+            orphan_devices |= worker.devices - removed_devices
+
+        for worker in workers:
+            for device in removed_devices & worker.devices:
+                worker.devices.discard(device)
+                worker.load_index -= device.load_index
+
+        for worker in added_workers:
+            worker.devices = set()
+            worker.load_index = 0
+            workers.add(worker)
+
+        if not workers:
+            return workers
+
+        # balance on load only when last full rebalance had it, new devices get average load
+        by_load = any(worker.load_index for worker in workers)
+        if by_load:
+            assigned_count = sum(len(worker) for worker in workers)
+            average_device_load = (
+                sum(worker.load_index for worker in workers) / assigned_count
+                if assigned_count else 0)
+            for device in added_devices:
+                device.load_index = device.load_index or average_device_load
+
+        def queue_entry(worker: Worker) -> Tuple[float, int, str, Worker]:
+            return cls._worker_weight(worker, by_load), len(worker), worker.identity, worker
+
+        # full workers leave the queue, unless all workers are full
+        ignore_capacity = False
+        worker_queue = [queue_entry(worker) for worker in workers
+                        if not worker.capacity.is_full(len(worker))]
+        heapq.heapify(worker_queue)
+        for device in sorted(orphan_devices, key=attrgetter('load_index', 'id_'), reverse=True):
+            if not worker_queue:
+                ignore_capacity = True
+                worker_queue = [queue_entry(worker) for worker in workers]
+                heapq.heapify(worker_queue)
+            worker = worker_queue[0][-1]
+            worker.add_device(device)
+            worker.load_index += device.load_index
+            if ignore_capacity or not worker.capacity.is_full(len(worker)):
+                heapq.heapreplace(worker_queue, queue_entry(worker))
+            else:
+                heapq.heappop(worker_queue)
+
+        # move devices from heaviest to lightest worker until lightest gets its share
+        average_weight = sum(
+            cls._worker_weight(worker, by_load) * worker.capacity.weight for worker in workers
+        ) / sum(worker.capacity.weight for worker in workers)
+        lower_bound = (
+            average_weight * (1 - worker_deviation) if by_load else math.floor(average_weight))
+        heaviest_queue = [(-weight, -count, identity, worker)
+                          for weight, count, identity, worker in map(queue_entry, workers)]
+        heapq.heapify(heaviest_queue)
+
+        while worker_queue:
+            # entries are not removed on move, skip the ones that are out of date or full
+            receiver_weight, receiver_count, _, receiver = worker_queue[0]
+            if (receiver_weight, receiver_count) != (
+                    cls._worker_weight(receiver, by_load), len(receiver)) or (
+                    not ignore_capacity and receiver.capacity.is_full(len(receiver))):
+                heapq.heappop(worker_queue)
+                continue
+            donor_weight, donor_count, _, donor = heaviest_queue[0]
+            if (-donor_weight, -donor_count) != (cls._worker_weight(donor, by_load), len(donor)):
+                heapq.heappop(heaviest_queue)
+                continue
+
+            if receiver_weight >= lower_bound:
+                break
+
+            # gap in device load or count, moving it between workers of different capacity
+            # changes their relative weights by different amounts
+            donor_capacity, receiver_capacity = donor.capacity.weight, receiver.capacity.weight
+            gap = (-donor_weight - receiver_weight) * 2 * donor_capacity * receiver_capacity / (
+                donor_capacity + receiver_capacity)
+            device = cls._pick_device_to_move(donor, gap, by_load)
+            if device is None:
+                break
+
+            donor.devices.discard(device)
+            donor.load_index -= device.load_index
+            receiver.add_device(device)
+            receiver.load_index += device.load_index
+
+            for worker in (donor, receiver):
+                weight, count, identity, _ = entry = queue_entry(worker)
+                heapq.heappush(worker_queue, entry)
+                heapq.heappush(heaviest_queue, (-weight, -count, identity, worker))
+
+        return workers
+
+    @classmethod
+    def balance_devices_per_worker(
+            cls, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        """Main balancing function that decides how we balance devices
+        which depends on the state of cache
+        """
+
+        if not workers or not devices:
+            return workers
+
+        devices, system_msg_count, interval = cls.fetch_cache_data(devices, cache)
+        workers = set(workers)
+
+        if system_msg_count:
+            workers = cls.balance_with_load_indexes(
+                workers, devices, worker_load_deviation, interval, system_msg_count,
+                load_smoothing, migration_cost)
+        else:
+            workers = cls.balance_with_count_per_worker(workers, devices)
+
+        return workers
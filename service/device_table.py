@@ -0,0 +1,285 @@
+import math
+import threading
+from array import array
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PROC_TIME_WEIGHT = 0.7
+MSG_COUNT_WEIGHT = 0.3
+
+
+class DeviceTable:
+    """Columnar storage of device state, one row per device id
+
+    Device objects are views on a row, so balancers can compute over whole columns
+    instead of per-object attributes. Uses numpy if installed, otherwise plain loops
+    """
+
+    def __init__(self) -> None:
+        self.ids = array('q')
+        self.msg_count = array('q')
+        self.proc_time = array('d')
+        self.load_index = array('d')
+        self.load_history = array('d')  # smoothed load index, nan until first sample
+        self.reprocessing = array('b')
+        self.lag = array('d')  # messages waiting to be processed
+        self.database = array('i')  # index in database_names, -1 if unknown
+        self.database_names = []  # type: List[str]
+        self._database_indexes = {}  # type: Dict[str, int]
+        self._rows = {}  # type: Dict[int, int]
+        # rows of released devices, reused by new devices
+        self._free_rows = []  # type: List[int]
+        # smooth_load_indexes calls, tells callers whether load history was updated
+        self.smooth_count = 0
+        # columns can't grow while numpy views on them exist
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids) - len(self._free_rows)
+
+    def row(self, device_id: int) -> int:
+        """Return row of device, adds new row for unknown device"""
+        try:
+            return self._rows[device_id]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if device_id not in self._rows:
+                if self._free_rows:
+                    row = self._free_rows.pop()
+                    self.ids[row] = device_id
+                else:
+                    row = len(self.ids)
+                    self.ids.append(device_id)
+                    self.msg_count.append(0)
+                    self.proc_time.append(0.0)
+                    self.load_index.append(0.0)
+                    self.load_history.append(math.nan)
+                    self.reprocessing.append(False)
+                    self.lag.append(0.0)
+                    self.database.append(-1)
+                self._rows[device_id] = row
+            return self._rows[device_id]
+
+    def release(self, device_id: int) -> None:
+        """Frees row of device that is gone for good, like partition of merged device
+
+        Row is reset and given to next new device, Device objects of released id
+        must not be used anymore
+        """
+        with self._lock:
+            row = self._rows.pop(device_id, None)
+            if row is None:
+                return
+            self.ids[row] = -1
+            self.msg_count[row] = 0
+            self.proc_time[row] = 0.0
+            self.load_index[row] = 0.0
+            self.load_history[row] = math.nan
+            self.reprocessing[row] = False
+            self.lag[row] = 0.0
+            self.database[row] = -1
+            self._free_rows.append(row)
+
+    def get_database(self, row: int) -> Optional[str]:
+        index = self.database[row]
+        return self.database_names[index] if index >= 0 else None
+
+    def set_database(self, row: int, name: Optional[str]) -> None:
+        """Sets source database of device, names are stored once per table"""
+        if name is None:
+            self.database[row] = -1
+            return
+
+        with self._lock:
+            if name not in self._database_indexes:
+                self._database_indexes[name] = len(self.database_names)
+                self.database_names.append(name)
+        self.database[row] = self._database_indexes[name]
+
+    def compute_load_indexes(
+            self, rows: Sequence[int], decimal_points: int,
+            interval: float, system_msg_count: int) -> None:
+        """Updates load index of given rows, same formula as Balancer.device_load_index_formula"""
+
+        if not interval or not system_msg_count:
+            for row in rows:
+                self.load_index[row] = 0
+            return
+
+        weights = PROC_TIME_WEIGHT + MSG_COUNT_WEIGHT
+        with self._lock:
+            if numpy is not None:
+                rows = numpy.asarray(rows, dtype=numpy.int64)
+                proc_time = numpy.frombuffer(self.proc_time, dtype=numpy.float64)[rows]
+                msg_count = numpy.frombuffer(self.msg_count, dtype=numpy.int64)[rows]
+                load_index = numpy.round(
+                    (proc_time * PROC_TIME_WEIGHT / interval +
+                     msg_count * MSG_COUNT_WEIGHT / system_msg_count) / weights,
+                    decimal_points
+                )
+                numpy.frombuffer(self.load_index, dtype=numpy.float64)[rows] = load_index
+                return
+
+            proc_time, msg_count, load_index = self.proc_time, self.msg_count, self.load_index
+            for row in rows:
+                load_index[row] = round(
+                    (proc_time[row] * PROC_TIME_WEIGHT / interval +
+                     msg_count[row] * MSG_COUNT_WEIGHT / system_msg_count) / weights,
+                    decimal_points
+                )
+
+    def smooth_load_indexes(self, rows: Sequence[int], smoothing: float) -> None:
+        """Folds load index into load history as exponentially weighted moving average
+        and replaces load index with it
+
+        :param smoothing: (float) weight of current load index, 1 disables smoothing
+        """
+        with self._lock:
+            self.smooth_count += 1
+            if numpy is not None:
+                rows = numpy.asarray(rows, dtype=numpy.int64)
+                load_index = numpy.frombuffer(self.load_index, dtype=numpy.float64)
+                load_history = numpy.frombuffer(self.load_history, dtype=numpy.float64)
+                current, history = load_index[rows], load_history[rows]
+                smoothed = numpy.where(
+                    numpy.isnan(history), current,
+                    smoothing * current + (1 - smoothing) * history
+                )
+                load_history[rows] = smoothed
+                load_index[rows] = smoothed
+                return
+
+            load_index, load_history = self.load_index, self.load_history
+            for row in rows:
+                history = load_history[row]
+                if not math.isnan(history):
+                    load_index[row] = smoothing * load_index[row] + (1 - smoothing) * history
+                load_history[row] = load_index[row]
+
+    def total_load(self, rows: Iterable[int]) -> float:
+        if numpy is not None:
+            with self._lock:
+                rows = numpy.fromiter(rows, dtype=numpy.int64)
+                return math.fsum(
+                    numpy.frombuffer(self.load_index, dtype=numpy.float64)[rows].tolist())
+
+        load_index = self.load_index
+        return math.fsum(load_index[row] for row in rows)
+
+    def order_by_load(self, rows: Iterable[int], reverse: bool = False) -> List[int]:
+        """Return rows ordered by load index and device id, same as Device ordering"""
+
+        rows = list(rows)
+        with self._lock:
+            if numpy is not None and rows:
+                rows = numpy.asarray(rows, dtype=numpy.int64)
+                order = numpy.lexsort((
+                    numpy.frombuffer(self.ids, dtype=numpy.int64)[rows],
+                    numpy.frombuffer(self.load_index, dtype=numpy.float64)[rows],
+                ))
+                return rows[order[::-1] if reverse else order].tolist()
+
+            ids, load_index = self.ids, self.load_index
+            return sorted(rows, key=lambda row: (load_index[row], ids[row]), reverse=reverse)
+
+    def keep_on_owners(
+            self, rows: Sequence[int], owned_rows: Sequence[Sequence[int]],
+            limits: Sequence[float], max_counts: Sequence[float]
+    ) -> Tuple[List[float], List[List[int]], List[int], List[int]]:
+        """Keeps rows on their owner in given order, while load of owner stays under its
+        limit and row count under its max count
+
+        :param owned_rows: rows of every owner, earlier owners win rows listed more than once
+
+        Returns kept load and rows of every owner, rows that were not kept in given order
+        and owner index of each of them, -1 for rows without owner
+        """
+        loads = [0] * len(owned_rows)  # type: List[float]
+        kept = [[] for _ in owned_rows]  # type: List[List[int]]
+        with self._lock:
+            if numpy is not None and rows and owned_rows:
+                rows = numpy.asarray(rows, dtype=numpy.int64)
+                all_owned = numpy.fromiter(
+                    chain.from_iterable(owned_rows), dtype=numpy.int64,
+                    count=sum(map(len, owned_rows)))
+                owned_by = numpy.repeat(
+                    numpy.arange(len(owned_rows)), [len(owned) for owned in owned_rows])
+                # earliest owner wins, rows without owner get owner count and sort last
+                owner = numpy.full(len(self.ids), len(owned_rows), dtype=numpy.int64)
+                numpy.minimum.at(owner, all_owned, owned_by)
+
+                owners = owner[rows]
+                row_loads = numpy.frombuffer(self.load_index, dtype=numpy.float64)[rows]
+                # positions of rows grouped by owner, in given order within owner,
+                # stable sort of 16 bit keys is a radix sort
+                keys = owners.astype(numpy.int16) if len(owned_rows) < 2 ** 15 else owners
+                by_owner = numpy.argsort(keys, kind='stable')
+                bounds = numpy.searchsorted(owners[by_owner], numpy.arange(len(owned_rows) + 1))
+                keep = numpy.zeros(len(rows), dtype=bool)
+                for index in range(len(owned_rows)):
+                    positions = by_owner[bounds[index]:bounds[index + 1]]
+                    if not len(positions):
+                        continue
+                    kept_positions, loads[index] = _keep_in_order(
+                        row_loads[positions], limits[index], max_counts[index])
+                    positions = positions[kept_positions]
+                    keep[positions] = True
+                    kept[index] = rows[positions].tolist()
+                left_owners = owners[~keep]
+                left_owners[left_owners == len(owned_rows)] = -1
+                return loads, kept, rows[~keep].tolist(), left_owners.tolist()
+
+            owner_of = {}  # type: Dict[int, int]
+            for index, owned in enumerate(owned_rows):
+                for row in owned:
+                    owner_of.setdefault(row, index)
+            load_index = self.load_index
+            left_rows, left_owners = [], []  # type: List[int], List[int]
+            for row in rows:
+                index = owner_of.get(row, -1)
+                if index >= 0 and len(kept[index]) < max_counts[index] and (
+                        limits[index] > (load_index[row] + loads[index])):
+                    loads[index] += load_index[row]
+                    kept[index].append(row)
+                else:
+                    left_rows.append(row)
+                    left_owners.append(index)
+            return loads, kept, left_rows, left_owners
+
+
+def _keep_in_order(loads: 'numpy.ndarray', limit: float, max_count: float) -> Tuple[
+        'numpy.ndarray', float]:
+    """Rows of one owner keep_on_owners keeps, as runs of rows that fit one after another
+    and runs that don't fit next to load kept so far
+
+    Returns mask of kept rows and their load, summed in order like plain loop does
+    """
+    keep = numpy.zeros(len(loads), dtype=bool)
+    kept_load = 0  # type: float
+    position = count = 0
+    while position < len(loads) and count < max_count:
+        sums = numpy.cumsum(numpy.concatenate(([kept_load], loads[position:])))[1:]
+        fits = limit > sums
+        run = len(fits) if fits.all() else int(numpy.argmin(fits))
+        run = int(min(run, max_count - count))
+        if run:
+            keep[position:position + run] = True
+            kept_load = float(sums[run - 1])
+            position += run
+            count += run
+        if position == len(loads) or count >= max_count:
+            break
+
+        fails = numpy.logical_not(limit > loads[position:] + kept_load)
+        position += len(fails) if fails.all() else int(numpy.argmin(fails))
+    return keep, kept_load
+
+
+DEVICE_TABLE = DeviceTable()  # default table for all devices of the process
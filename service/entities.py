@@ -1,19 +1,26 @@
-from typing import Any, Set, Union
+from typing import Any, Dict, Optional, Set, Union
+
+from .device_table import DEVICE_TABLE, DeviceTable
 
 
 class Device:
-    def __init__(self, id_: int, load_index: float = 0.0) -> None:
+    """View on device row in DeviceTable, devices with same id share state"""
+
+    __slots__ = ('id_', 'table', 'row')
+
+    def __init__(
+            self, id_: int, load_index: Optional[float] = None,
+            table: Optional[DeviceTable] = None) -> None:
         self.id_ = id_
-        self.load_index = load_index
-        # TODO reprocessing will be memory hog, need mechanism for effective dealing with this
+        self.table = table if table is not None else DEVICE_TABLE
+        self.row = self.table.row(id_)
+        if load_index is not None:
+            self.load_index = load_index
+        # reprocessing devices are memory hogs, Scheduler keeps them on reserved workers
         # some out of order data is ok, since scheduler will just reasign properly
-        # good idea would be to increase memory treshold on those workers, and decrease on others with lighter load
-        self.reprocessing = False
-        self._msg_count = 0
-        self._proc_time = 0.0
 
     def __repr__(self) -> str:
-        return '(ID: {id_}, Load index: {load_index})'.format(**self.__dict__)
+        return '(ID: {}, Load index: {})'.format(self.id_, self.load_index)
 
     def __lt__(self, other: Any) -> bool:
         if self.load_index == other.load_index:
@@ -27,21 +34,54 @@ class Device:
     def __hash__(self) -> int:
         return hash(self.id_)
 
+    @property
+    def load_index(self) -> float:
+        return self.table.load_index[self.row]
+
+    @load_index.setter
+    def load_index(self, value: float) -> None:
+        self.table.load_index[self.row] = value
+
+    @property
+    def reprocessing(self) -> bool:
+        return bool(self.table.reprocessing[self.row])
+
+    @reprocessing.setter
+    def reprocessing(self, value: bool) -> None:
+        self.table.reprocessing[self.row] = value
+
+    @property
+    def database(self) -> Optional[str]:
+        """Name of database device data is read from"""
+        return self.table.get_database(self.row)
+
+    @database.setter
+    def database(self, name: Optional[str]) -> None:
+        self.table.set_database(self.row, name)
+
+    @property
+    def lag(self) -> float:
+        return self.table.lag[self.row]
+
+    @lag.setter
+    def lag(self, value: Union[None, str]) -> None:
+        self.table.lag[self.row] = float(value) if value else 0
+
     @property
     def msg_count(self) -> int:
-        return self._msg_count
+        return self.table.msg_count[self.row]
 
     @msg_count.setter
     def msg_count(self, value: Union[None, str]) -> None:
-        self._msg_count = int(value) if value else 0
+        self.table.msg_count[self.row] = int(value) if value else 0
 
     @property
     def proc_time(self) -> float:
-        return self._proc_time
+        return self.table.proc_time[self.row]
 
     @proc_time.setter
     def proc_time(self, value: Union[None, str]) -> None:
-        self._proc_time = float(value) if value else 0
+        self.table.proc_time[self.row] = float(value) if value else 0
 
 
 class Database:
@@ -55,12 +95,59 @@ class Database:
         return 'DB(Name: {name}, Load Index: {load_index})'.format(**self.__dict__)
 
 
+class Capacity:
+    """Resources worker advertises in data of its Zookeeper node"""
+
+    __slots__ = ('cores', 'memory', 'max_devices')
+
+    def __init__(
+            self, cores: int = 1, memory: int = 0, max_devices: Optional[int] = None) -> None:
+        self.cores = cores
+        self.memory = memory  # MB
+        self.max_devices = max_devices
+
+    def __repr__(self) -> str:
+        return 'Capacity(Cores: {}, Memory: {}, Max devices: {})'.format(
+            self.cores, self.memory, self.max_devices)
+
+    @classmethod
+    def from_dict(cls, value: Any) -> 'Capacity':
+        """Capacity from node data, missing or invalid data gives default capacity"""
+        if not isinstance(value, dict):
+            return cls()
+        try:
+            cores = int(value.get('cores', 1))
+            memory = int(value.get('memory', 0))
+            max_devices = value.get('max_devices')
+            if max_devices is not None:
+                max_devices = int(max_devices)
+        except (TypeError, ValueError):
+            return cls()
+        if cores < 1 or memory < 0 or (max_devices is not None and max_devices < 0):
+            return cls()
+        return cls(cores, memory, max_devices)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @property
+    def weight(self) -> float:
+        """Relative share of load worker should get"""
+        return max(self.cores, 1)
+
+    def is_full(self, device_count: int) -> bool:
+        return self.max_devices is not None and device_count >= self.max_devices
+
+
 class Worker:
-    def __init__(self, identity: str) -> None:
+    __slots__ = ('_identity', '_devices', 'databases', 'load_index', 'capacity')
+
+    def __init__(self, identity: str, capacity: Optional[Capacity] = None) -> None:
         self._identity = identity
         self._devices = set()  # type: Set[Device]
         self.databases = set()  # type: Set[Database]
         self.load_index = 0
+        self.capacity = capacity or Capacity()
 
     def __repr__(self) -> str:
         return 'Worker(ID: {} Load index: {}, Devices: {})'.format(
@@ -98,3 +185,13 @@ class Worker:
 
     def add_device(self, device: Device) -> None:
         self._devices.add(device)
+
+
+class BalanceReport:
+    def __init__(self, imbalance_ratio: float, moves: int) -> None:
+        self.imbalance_ratio = imbalance_ratio  # heaviest worker load / average worker load
+        self.moves = moves  # devices that changed worker
+
+    def __repr__(self) -> str:
+        return 'Balance(Imbalance ratio: {imbalance_ratio}, Moves: {moves})'.format(
+            **self.__dict__)
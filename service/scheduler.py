@@ -1,13 +1,37 @@
+import logging
 import math
 import time
-from typing import List, Set, Tuple
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+from ..helpers.metrics import METRICS
+from ..helpers.trigger import Trigger
 from ..infrastructure.cache import Cache
+from ..infrastructure.codec import (
+    MAX_PARTITIONS, PARTITION_FLAG, decode_partition_id, device_key, encode_partition_id
+)
 from ..infrastructure.db import DeviceStorage
 from ..infrastructure.device_mapper import (
     WorkerDeviceMapper
 )
+from .balancing import PHASE_SECONDS, Balancer
+from .device_table import DEVICE_TABLE
 from .entities import Device, Worker
+from .strategies import AdaptiveStrategy, BalancingStrategy
+
+LOG = logging.getLogger(__name__)
+
+WORKER_LOAD_IMBALANCE = METRICS.gauge(
+    'scheduler_worker_load_imbalance',
+    'Heaviest worker load over average worker load after last cycle, device count if no load')
+DEVICES_MOVED = METRICS.gauge(
+    'scheduler_devices_moved', 'Devices that changed worker in last cycle')
+CYCLE_TRIGGER = METRICS.gauge(
+    'scheduler_cycle_trigger', 'Reasons of last cycle, 1 if reason triggered it',
+    labels=('reason',))
+CYCLES = METRICS.counter(
+    'scheduler_cycles_total', 'Scheduler cycles by reason that triggered them',
+    labels=('reason',))
 
 
 class Scheduler:
@@ -15,236 +39,560 @@ class Scheduler:
 
     UPDATE_INTERVAl = 30  # time in seconds
     WORKER_DEVIATION = 0.1  # index 1 how much % more load worker can have to preserve devices
+    LOAD_HALF_LIFE = 120  # seconds after which load has half of its weight in load index
+    MIGRATION_COST = 0.05  # index 1 how much % of worker load moving a device has to gain
+    REPROCESSING_LAG = 10000  # device lag in messages from which it's reprocessing
+    CAUGHT_UP_LAG = 1000  # reprocessing device lag in messages from which it's back to normal
+    REPROCESSING_DEVICES_PER_WORKER = 5  # how many reprocessing devices fit worker's memory
+    MAX_REPROCESSING_WORKERS = 0.2  # index 1 how much % of workers can be reserved
+    DEBOUNCE = 0.5  # seconds without worker changes before we rebalance
+    MAX_DEBOUNCE_DELAY = 5  # max seconds rebalance waits for worker changes to settle
+    HOT_DEVICE_LOAD = 1.0  # index 1 how much of worker's load share device needs to split
+    MERGE_DEVICE_LOAD = 0.5  # index 1 worker's load share under which split device merges
+    SPLIT_HOLD = 120  # seconds split device is kept, first partition stats are incomplete
+
+    WORKERS_TRIGGER = 'workers'
+    DEVICES_TRIGGER = 'devices'
+    TIMER_TRIGGER = 'timer'
+    HANDOFF_TRIGGER = 'handoff'
 
     def __init__(self,
                  identity: str,
                  device_storage: DeviceStorage,
                  worker_mapper: WorkerDeviceMapper,
-                 cache: Cache) -> None:
+                 cache: Cache,
+                 strategy: Optional[BalancingStrategy] = None,
+                 metrics_port: Optional[int] = None,
+                 standby: bool = False) -> None:
+        """
+        :param standby: (bool) only mirror devices, workers and published assignment
+            until `take_over`, for schedulers waiting in election
+        """
 
         self.identity = identity
         self.device_storage = device_storage
         self.worker_mapper = worker_mapper
         self.cache = cache
+        self.strategy = strategy or AdaptiveStrategy()
+        self.balancer = Balancer()
         self.last_update_time = time.monotonic()
+        # time load history was last updated and of last full rebalance
+        self._last_load_time = None  # type: Optional[float]
+        self._last_balance_time = None  # type: Optional[float]
+        self._next_device_sync = self.last_update_time
+        self.trigger = Trigger(debounce=self.DEBOUNCE, max_delay=self.MAX_DEBOUNCE_DELAY)
+        self.worker_mapper.add_listener(partial(self.trigger.notify, self.WORKERS_TRIGGER))
+        # syncs outside of run, like update_devices from other thread, wake it
+        self.device_storage.add_listener(partial(self.trigger.notify, self.DEVICES_TRIGGER))
         self._workers_map = set()  # type: Set[Worker]
         self._devices = set()  # type: Set[Device]
-
-        self._initialize_state()
+        self._device_generation = 0
+        self._reprocessing_workers = set()  # type: Set[Worker]
+        # device id: partitions of hot devices split between workers
+        self._partitions = {}  # type: Dict[int, List[Device]]
+        # partitions of merged devices, their table rows are freed after next full rebalance
+        self._retired_partitions = set()  # type: Set[Device]
+        self._split_times = {}  # type: Dict[int, float]
+
+        if metrics_port is not None:
+            METRICS.serve(metrics_port)
+
+        self.standby = standby
+        if standby:
+            self._initialize_mirror()
+        else:
+            self._initialize_state()
 
     def _initialize_state(self) -> None:
         self._workers_map = self.worker_mapper.workers
-        self.device_storage.update_devices()
+        self._sync_devices(time.monotonic())
         self._devices = set(self.device_storage.devices)
-        self._workers_map = self.balance_devices_per_worker(
-            workers=self._workers_map, devices=self._devices, cache=self.cache,
-            worker_load_deviation=self.WORKER_DEVIATION
-        )
+        self._device_generation = self.device_storage.generation
+        self._workers_map = self._balance(self._workers_map, time.monotonic())
+        self.worker_mapper.update_worker_devices(self._workers_map)
 
-        # print(self._workers_map)
+    def _initialize_mirror(self) -> None:
+        self._sync_devices(time.monotonic())
+        self._devices = set(self.device_storage.devices)
+        self._device_generation = self.device_storage.generation
+        self.worker_mapper.mirror_assignment()
 
-        self.worker_mapper.update_worker_devices(self._workers_map)
+    def refresh_standby(self) -> None:
+        """Keeps device catalogue of standby scheduler up to date,
+        workers and their devices are kept up to date by mapper watches
+        """
+        if not self.standby:
+            return
 
-    def run(self) -> None:
-        """Main Scheduler method that checks for updates in intervals"""
-        devices_changed = False
-        workers_changed = False
+        time_now = time.monotonic()
+        if time_now >= self._next_device_sync:
+            self._sync_devices(time_now)
+        added_devices, removed_devices = self._get_device_changes()
+        self._devices -= removed_devices
+        self._devices |= added_devices
+
+    def take_over(self) -> None:
+        """Makes standby scheduler the leader, continuing from published assignment
+
+        Only devices that changed since the last publish are rebalanced, full rebalance
+        follows after UPDATE_INTERVAl
+        """
+        if not self.standby:
+            return
+
+        time_now = time.monotonic()
+        self._sync_devices(time_now)
+        self.refresh_standby()
+
+        self.worker_mapper.stop_mirroring()
+        self.standby = False
+
+        workers = set(self.worker_mapper.workers)
+        assigned_devices = set()  # type: Set[Device]
+        for worker in workers:
+            assigned_devices |= worker.devices
+        self._partitions = self.get_published_partitions(assigned_devices)
+        self._split_times = dict.fromkeys(self._partitions, time_now)
+        devices = self.get_partitioned_devices(self._devices)
+
+        # published assignment doesn't mark reserved workers, they hold only
+        # reprocessing devices
+        reprocessing_devices = self.update_reprocessing_state(assigned_devices, self.cache)
+        self._reprocessing_workers = {
+            worker for worker in workers
+            if worker.devices and worker.devices <= reprocessing_devices
+        }
+        if self._reprocessing_workers == workers:
+            self._reprocessing_workers = set()
+
+        removed_devices = assigned_devices - devices
+        with PHASE_SECONDS.time(phase='balance'):
+            self._remove_reprocessing_devices(removed_devices)
+            self._workers_map = self.balancer.rebalance_incremental(
+                workers=workers - self._reprocessing_workers,
+                added_devices=devices - assigned_devices,
+                removed_devices=removed_devices, added_workers=set(),
+                removed_workers=set(), worker_deviation=self.WORKER_DEVIATION
+            ) | self._reprocessing_workers
+        self.last_update_time = time_now
+
+        with PHASE_SECONDS.time(phase='publish'):
+            self.worker_mapper.update_worker_devices(self._workers_map)
+        # partitions of removed devices stay in self._partitions
+        self._release_devices(
+            device for device in removed_devices if not device.id_ & PARTITION_FLAG)
 
-        self.device_storage.update_devices()
+    def run(self) -> None:
+        """Main Scheduler method that checks for updates in intervals
 
+        Device and worker changes are applied to current assignment incrementally,
+        full rebalance runs every UPDATE_INTERVAl
+        """
         time_now = time.monotonic()
+        self.worker_mapper.advance_handoffs()
+
+        with PHASE_SECONDS.time(phase='device_fetch'):
+            if time_now >= self._next_device_sync:
+                self._sync_devices(time_now)
+            added_devices, removed_devices = self._get_device_changes()
+
         last_update = time_now - self.last_update_time
         update_time = last_update >= self.UPDATE_INTERVAl
 
-        updated_devices = set(self.device_storage.devices)
         new_worker_state = self.worker_mapper.workers
 
-        if updated_devices != self._devices:
-            self._devices = updated_devices
-            devices_changed = True
-
-        if self._workers_map != new_worker_state:
-            self._workers_map = new_worker_state
-            workers_changed = True
-
-        if devices_changed or workers_changed or update_time:
-            self._workers_map = self.balance_devices_per_worker(
-                workers=self._workers_map, devices=self._devices, cache=self.cache,
-                worker_load_deviation=self.WORKER_DEVIATION
-            )
+        added_workers = new_worker_state - self._workers_map
+        removed_workers = self._workers_map - new_worker_state
+
+        devices_changed = bool(added_devices or removed_devices)
+        workers_changed = bool(added_workers or removed_workers)
+
+        if not (devices_changed or workers_changed or update_time):
+            return
+
+        triggers = {
+            self.DEVICES_TRIGGER: devices_changed,
+            self.WORKERS_TRIGGER: workers_changed,
+            self.TIMER_TRIGGER: update_time,
+        }
+        for reason, triggered in triggers.items():
+            CYCLE_TRIGGER.set(int(triggered), reason=reason)
+            if triggered:
+                CYCLES.inc(reason=reason)
+        # keep existing Device and Worker objects, they carry last known load
+        self._devices -= removed_devices
+        self._devices |= added_devices
+        # workers hold partitions of split devices
+        removed_devices, split_devices = (
+            self.get_partitioned_devices(removed_devices), removed_devices)
+        for device in split_devices:
+            self._retired_partitions.update(self._partitions.pop(device.id_, ()))
+            self._split_times.pop(device.id_, None)
+        remaining_workers = self._workers_map - removed_workers
+
+        normal_workers = remaining_workers - self._reprocessing_workers
+        with PHASE_SECONDS.time(phase='balance'):
+            if (update_time or not normal_workers or not self.strategy.incremental or
+                    removed_workers & self._reprocessing_workers):
+                self._workers_map = self._balance(remaining_workers | added_workers, time_now)
+                self.last_update_time = time_now
+            else:
+                self._remove_reprocessing_devices(removed_devices)
+                self._workers_map = self.balancer.rebalance_incremental(
+                    workers=normal_workers, added_devices=added_devices,
+                    removed_devices=removed_devices, added_workers=added_workers,
+                    removed_workers=removed_workers, worker_deviation=self.WORKER_DEVIATION
+                ) | self._reprocessing_workers
+
+        moves = self.worker_mapper.moves
+        with PHASE_SECONDS.time(phase='publish'):
             self.worker_mapper.update_worker_devices(self._workers_map)
-            self.last_update_time = time_now
+        # workers no longer hold removed devices, their partitions are retired above
+        self._release_devices(split_devices)
 
+        # mapper counts moves from the diff it publishes
+        DEVICES_MOVED.set(self.worker_mapper.moves - moves)
+        WORKER_LOAD_IMBALANCE.set(self.get_imbalance(self._workers_map))
+
+        if LOG.isEnabledFor(logging.DEBUG):
             for worker in self._workers_map:
-                print('\n', worker)
+                LOG.debug('%s', worker)
 
-    @staticmethod
-    def fetch_cache_data(
-            devices: Set[Device], cache: Cache) -> Tuple[Set[Device], int, float]:
-        """Updated Device fields for load index calculation and resets cache
+    def _remove_reprocessing_devices(self, removed_devices: Set[Device]) -> None:
+        """Reprocessing workers only lose removed devices until next full rebalance"""
 
-        Returns updated Device set, system msg count and system processing_time
-        """
+        for worker in self._reprocessing_workers:
+            for device in removed_devices & worker.devices:
+                worker.devices.discard(device)
+                worker.load_index -= device.load_index
+
+    @staticmethod
+    def get_imbalance(workers: Set[Worker]) -> float:
+        """Return heaviest worker load over average worker load, by device count if no load"""
+
+        if not workers:
+            return 1.0
+        weights = [worker.load_index for worker in workers]
+        if not any(weights):
+            weights = [len(worker) for worker in workers]
+        average = sum(weights) / len(weights)
+        return max(weights) / average if average else 1.0
+
+    def _balance(self, workers: Set[Worker], time_now: float) -> Set[Worker]:
+        """Full rebalance, reprocessing devices go to reserved workers, the rest to strategy"""
+
+        self.update_partitions(self._devices, len(workers), time_now)
+        devices = self.get_partitioned_devices(self._devices)
+        # stats workers recorded under whole key before they got partitions would count
+        # once device merges
+        self.reset_device_stats(self._devices - devices, self.cache)
+
+        reprocessing_devices = self.update_reprocessing_state(devices, self.cache)
+        self._reprocessing_workers = self.get_reprocessing_workers(workers, reprocessing_devices)
+        if not self._reprocessing_workers:
+            reprocessing_devices = set()
+
+        table = next(iter(devices)).table if devices else DEVICE_TABLE
+        smooth_count = table.smooth_count
+        normal_workers = set(workers) - self._reprocessing_workers
+        normal_devices = devices - reprocessing_devices
+        if normal_devices:
+            normal_workers = self.strategy.balance(
+                workers=normal_workers, devices=normal_devices, cache=self.cache,
+                worker_load_deviation=self.WORKER_DEVIATION,
+                load_smoothing=self._get_load_smoothing(time_now),
+                migration_cost=self.MIGRATION_COST
+            )
+        else:
+            # strategies leave workers untouched without devices
+            for worker in normal_workers:
+                worker.devices = set()
+                worker.load_index = 0
+
+        if reprocessing_devices:
+            # reprocessing is memory bound, so reserved workers get equal device count
+            reprocessing_devices, *_ = self.balancer.fetch_cache_data(
+                reprocessing_devices, self.cache)
+            self.balancer.balance_with_count_per_worker(
+                self._reprocessing_workers, reprocessing_devices)
+            self.update_reprocessing_load(self._reprocessing_workers, devices)
+
+        # device count balancing doesn't measure load, smoothing window keeps growing
+        if table.smooth_count != smooth_count:
+            self._last_load_time = time_now
+
+        last_balance_time, self._last_balance_time = self._last_balance_time, time_now
+        if last_balance_time is not None and time_now > last_balance_time:
+            # devices carry processing time read since last full rebalance
+            self.worker_mapper.update_domain_state(
+                math.fsum(device.proc_time for device in devices) /
+                (time_now - last_balance_time), len(devices))
+
+        # workers no longer hold retired partitions
+        self._release_retired_partitions()
+        return set(normal_workers) | self._reprocessing_workers
 
+    @staticmethod
+    def _release_devices(devices: Iterable[Device]) -> None:
+        """Frees table rows of devices removed from catalogue, rows go to new devices"""
         for device in devices:
-            _key = 'device:{}'.format(device.id_)
-            try:
-                device.msg_count, device.proc_time = cache.get_field_values(
-                    _key, cache.COUNT_FIELD, cache.PROC_TIME_FIELD)
-                cache.set_field_values(
-                    _key, {cache.COUNT_FIELD: cache.RESET_VALUE,
-                           cache.PROC_TIME_FIELD: cache.RESET_VALUE}
-                )
-            except AttributeError:
-                pass
-            device.load_index = 0
+            device.table.release(device.id_)
 
-        system_msg_count = sum(device.msg_count for device in devices)
-        interval = sum(device.proc_time for device in devices)
+    def _release_retired_partitions(self) -> None:
+        """Frees table rows of retired partitions, unless device was split again to them"""
 
-        return devices, system_msg_count, interval
+        current = {
+            partition for partitions in self._partitions.values() for partition in partitions}
+        for partition in self._retired_partitions - current:
+            partition.table.release(partition.id_)
+        self._retired_partitions = set()
 
-    @classmethod
-    def device_load_index_formula(
-            cls, device: Device, decimal_points: int,
-            interval: float, system_msg_count: int) -> None:
-        """Updates load index for given Device"""
+    def update_partitions(self, devices: Set[Device], worker_count: int,
+                          time_now: float) -> None:
+        """Splits devices over HOT_DEVICE_LOAD of worker's load share to partitions
+        and merges split devices back under MERGE_DEVICE_LOAD
 
-        proc_time_index = 0.7
-        msg_count_index = 0.3
-        try:
-            load_index = round(
-                (device.proc_time * proc_time_index / interval +
-                 device.msg_count * msg_count_index / system_msg_count) /
-                (proc_time_index + msg_count_index), decimal_points
+        Uses smoothed load of last full rebalance, so load has to stay high or low
+        for a while before device splits or merges. Split device whose partition
+        is still hot is split again to more partitions, both after SPLIT_HOLD
+        """
+        loads = {
+            device: self.get_smoothed_load(self._partitions.get(device.id_, (device,)))
+            for device in devices
+        }
+        device_ids = {device.id_ for device in devices}
+        for device_id in self._partitions.keys() - device_ids:
+            self._retired_partitions.update(self._partitions[device_id])
+        self._partitions = {
+            device_id: partitions for device_id, partitions in self._partitions.items()
+            if device_id in device_ids
+        }
+        self._split_times = {
+            device_id: split_time for device_id, split_time in self._split_times.items()
+            if device_id in self._partitions
+        }
+        load_share = math.fsum(loads.values()) / worker_count if worker_count else 0
+        if worker_count < 2 or not load_share:
+            for device in list(self._partitions):
+                self._merge_device(device)
+            return
+
+        for device, load in loads.items():
+            partitions = self._partitions.get(device.id_)
+            if partitions is None and load <= load_share * self.HOT_DEVICE_LOAD:
+                continue
+            if partitions is not None:
+                if time_now < self._split_times.get(device.id_, 0) + self.SPLIT_HOLD:
+                    continue
+                if load < load_share * self.MERGE_DEVICE_LOAD:
+                    self._merge_device(device.id_)
+                    continue
+                if max(self.get_smoothed_load((partition,)) for partition in partitions) <= \
+                        load_share * self.HOT_DEVICE_LOAD:
+                    continue
+
+            count = min(
+                max(math.ceil(load / (load_share * self.MERGE_DEVICE_LOAD)), 2),
+                worker_count, MAX_PARTITIONS
             )
-        except ZeroDivisionError:
-            load_index = 0
-        device.load_index = load_index
+            if partitions is None or count > len(partitions):
+                self._split_device(device, count)
+                self._split_times[device.id_] = time_now
+
+    def _split_device(self, device: Device, count: int) -> None:
+        """Replaces device or its partitions by count partitions sharing its load"""
+
+        if device.id_ in self._partitions:
+            self._merge_device(device.id_)
+        load = self.get_smoothed_load((device,))
+        partitions = [
+            Device(encode_partition_id(device.id_, index, count), table=device.table)
+            for index in range(count)
+        ]
+        for partition in partitions:
+            partition.database = device.database
+            partition.table.load_history[partition.row] = load / count
+        # left from previous split to same count
+        self.reset_device_stats(partitions, self.cache)
+        self._partitions[device.id_] = partitions
+        LOG.info('Device %s split to %s partitions, load index %s', device.id_, count, load)
+
+    def _merge_device(self, device_id: int) -> None:
+        """Replaces partitions of device by whole device carrying their load"""
+
+        partitions = self._partitions.pop(device_id)
+        self._retired_partitions.update(partitions)
+        self._split_times.pop(device_id, None)
+        device = Device(device_id, table=partitions[0].table)
+        load = self.get_smoothed_load(partitions)
+        device.table.load_history[device.row] = load
+        LOG.info('Device %s merged from %s partitions, load index %s',
+                 device_id, len(partitions), load)
 
-    @classmethod
-    def balance_with_load_indexes(
-            cls, workers: Set[Worker], devices: Set[Device], worker_deviation: float,
-            interval: float, system_msg_count: int) -> Set[Worker]:
-        """Balances workers with device load indexes"""
+    @staticmethod
+    def reset_device_stats(devices: Iterable[Device], cache: Cache) -> None:
+        """Drops load stats of devices recorded in cache"""
 
-        # calculate decimal points depending on number of devices
-        decimal_points = len([c for c in str(len(devices))])
-        decimal_points = math.ceil(decimal_points + (decimal_points*5/4))
+        keys = [device_key(device.id_) for device in devices]
+        if not keys:
+            return
+        try:
+            cache.fetch_and_reset_fields(keys, (cache.COUNT_FIELD, cache.PROC_TIME_FIELD))
+        except AttributeError:
+            pass
 
-        # calculate how much load can worker have
-        load_per_worker = round((1/len(workers)), decimal_points)
+    @staticmethod
+    def get_smoothed_load(devices: Iterable[Device]) -> float:
+        """Smoothed load index of devices from last full rebalance, 0 if unknown"""
+        return math.fsum(
+            load for load in (device.table.load_history[device.row] for device in devices)
+            if not math.isnan(load)
+        )
 
-        # how much 'extra' load worker can get to try to keep it's devices
-        deviation_per_worker_load = load_per_worker+(load_per_worker*worker_deviation)
+    def get_partitioned_devices(self, devices: Set[Device]) -> Set[Device]:
+        """Return devices with split devices replaced by their partitions"""
 
-        for device in devices:
-            cls.device_load_index_formula(device, decimal_points, interval, system_msg_count)
-
-        for worker in sorted(workers, reverse=True):
-            worker_new_devices = set()  # type: Set[Device]
-            worker.load_index = 0
-            for device in sorted(devices, reverse=True):
-                if device in worker:
-                    if deviation_per_worker_load > (device.load_index + worker.load_index):
-                        worker_new_devices.add(device)
-                        worker.load_index += device.load_index
-            devices -= worker_new_devices
-            worker.devices = worker_new_devices
-
-        # TODO: This part needs to be smarter, not just random
-        # Heavy workers(like device or two with heavy load) shouldn't get small load devices
-        # One worker should always be elected as 'reprocessing' worker which would just deal with
-        # devices that are in reprocess state
-
-        # TODO: logic that could recognize device as reprocessing
-
-        # existing coord service works great with this! victory!
-        for device in sorted(devices, reverse=True):
-            worker = sorted(workers)[0]
-            worker.devices.add(device)
-            worker.load_index += device.load_index
-
-        return workers
+        split_devices = {device for device in devices if device.id_ in self._partitions}
+        if not split_devices:
+            return set(devices)
+        partitioned_devices = devices - split_devices
+        for device in split_devices:
+            partitioned_devices.update(self._partitions[device.id_])
+        return partitioned_devices
 
     @staticmethod
-    def _sort_workers(worker: Worker) -> Tuple[int, int]:
-        """Helper sorting method when we have no load indexes"""
+    def get_published_partitions(devices: Set[Device]) -> Dict[int, List[Device]]:
+        """Return partitions of split devices found in published devices,
+        partitions of dead workers are missing in published devices, so all are created
+        """
+        counts = {}  # type: Dict[int, int]
+        for device in devices:
+            device_id, _, count = decode_partition_id(device.id_)
+            if count > counts.get(device_id, 1):
+                counts[device_id] = count
+        return {
+            device_id: [
+                Device(encode_partition_id(device_id, index, count))
+                for index in range(count)
+            ]
+            for device_id, count in counts.items()
+        }
+
+    def wait(self) -> Set[str]:
+        """Blocks until workers change, devices sync or full rebalance is due,
+        standby scheduler doesn't rebalance, so it doesn't wait for rebalance or handoffs
+
+        Returns reasons of wakeup
+        """
+        next_rebalance = self.last_update_time + self.UPDATE_INTERVAl
+        # handoffs that time out are published by next run
+        handoff_deadline = self.worker_mapper.handoff_deadline
+        if handoff_deadline is None:
+            handoff_deadline = next_rebalance
+        if self.standby:
+            # standby only syncs devices, workers and assignment follow mapper watches
+            next_rebalance = handoff_deadline = math.inf
+        timeout = min(next_rebalance, self._next_device_sync, handoff_deadline) - time.monotonic()
+        reasons = self.trigger.wait(max(timeout, 0))
 
-        try:
-            return len(worker), min(device.id_ for device in worker.devices)
-        except ValueError:
-            return len(worker), 0
+        time_now = time.monotonic()
+        if time_now >= self._next_device_sync:
+            reasons.add(self.DEVICES_TRIGGER)
+        if time_now >= next_rebalance:
+            reasons.add(self.TIMER_TRIGGER)
+        if time_now >= handoff_deadline:
+            reasons.add(self.HANDOFF_TRIGGER)
+        return reasons
 
-    @staticmethod
-    def get_devices_per_worker(worker_count: int, devices_count: int) -> List[int]:
-        """Calculates how many devices can be assigned per worker
+    def _get_load_smoothing(self, time_now: float) -> float:
+        """Weight of load measured since last full rebalance in smoothed load index"""
 
-        Return example: 3 workers, 8 devices: [3, 3, 2]
-        """
-        devices_per_worker = []
+        if self._last_load_time is None or not self.LOAD_HALF_LIFE:
+            return 1.0
+        return 1 - 0.5 ** ((time_now - self._last_load_time) / self.LOAD_HALF_LIFE)
 
-        while worker_count:
-            try:
-                per_worker = math.ceil(devices_count/worker_count)
-            except ZeroDivisionError:
-                per_worker = 0
-            devices_per_worker.append(per_worker)
-            devices_count -= per_worker
-            worker_count -= 1
-        return devices_per_worker
+    def _sync_devices(self, time_now: float) -> None:
+        self.device_storage.sync_devices()
+        self._next_device_sync = time_now + self.device_storage.UPDATE_INTERVAL
 
-    @classmethod
-    def balance_with_count_per_worker(
-            cls, workers: Set[Worker], devices: Set[Device]) -> Set[Worker]:
-        """Worker rebalance method which assigns 'equal' number of devices per worker
-        with minimal changes to worker's assigned devices
-        """
+    def _get_device_changes(self) -> Tuple[Set[Device], Set[Device]]:
+        """Returns added and removed devices since last run
 
-        devices_per_worker = cls.get_devices_per_worker(len(workers), len(devices))
-        devices = set(devices)
-        ordered_workers = sorted(workers, key=lambda item: cls._sort_workers(item), reverse=True)
-
-        for worker in ordered_workers:
-            worker_device_count = max(devices_per_worker)
-            worker_new_devices = set()  # type: Set[Device]
-            worker.load_index = 0
-            for device in sorted(devices):
-                if worker_device_count == len(worker_new_devices):
-                    break
-                elif device in worker:
-                    worker_new_devices.add(device)
-            devices -= worker_new_devices
-            try:
-                devices_per_worker.remove(len(worker_new_devices))
-            except ValueError:
-                pass
-            worker.devices = worker_new_devices
+        Storage deltas are used unless we missed a sync, then whole device sets are diffed
+        """
+        generation = self.device_storage.generation
+        if generation == self._device_generation:
+            return set(), set()
 
-        for leftover_device in sorted(devices):
-            worker = sorted(workers, key=lambda item: cls._sort_workers(item))[0]
-            worker.add_device(leftover_device)
+        if generation == self._device_generation + 1:
+            added_devices = set(self.device_storage.added)
+            removed_devices = set(self.device_storage.removed)
+        else:
+            updated_devices = set(self.device_storage.devices)
+            added_devices = updated_devices - self._devices
+            removed_devices = self._devices - updated_devices
 
-        return workers
+        self._device_generation = generation
+        return added_devices, removed_devices
 
     @classmethod
-    def balance_devices_per_worker(
-            cls, workers: Set[Worker], devices: Set[Device], cache: Cache,
-            worker_load_deviation: float = 0.0) -> Set[Worker]:
-        """Main balancing function that decides how we balance devices
-        which depends on the state of cache
-        """
+    def update_reprocessing_state(cls, devices: Set[Device], cache: Cache) -> Set[Device]:
+        """Reads device lag from cache and marks devices that are reprocessing
 
-        if not workers or not devices:
-            return workers
+        Device is reprocessing from REPROCESSING_LAG until it catches up to CAUGHT_UP_LAG.
+        Returns reprocessing devices
+        """
+        ordered_devices = list(devices)
+        keys = [device_key(device.id_) for device in ordered_devices]
+        with PHASE_SECONDS.time(phase='cache_fetch'):
+            try:
+                values = cache.get_many_field_values(keys, (cache.LAG_FIELD,))
+            except AttributeError:
+                values = [(device.lag,) for device in ordered_devices]
+
+        reprocessing_devices = set()  # type: Set[Device]
+        for device, (lag,) in zip(ordered_devices, values):
+            device.lag = lag
+            if device.reprocessing:
+                device.reprocessing = device.lag > cls.CAUGHT_UP_LAG
+            else:
+                device.reprocessing = device.lag >= cls.REPROCESSING_LAG
+            if device.reprocessing:
+                reprocessing_devices.add(device)
+
+        return reprocessing_devices
+
+    def update_reprocessing_load(self, workers: Set[Worker], devices: Set[Device]) -> None:
+        """Sets load index of reprocessing workers and their devices, count balancing
+        drops it, load is share of all devices read in this rebalance
+        """
+        system_msg_count = sum(device.msg_count for device in devices)
+        interval = math.fsum(device.proc_time for device in devices)
+        decimal_points = len([c for c in str(len(devices))])
+        decimal_points = math.ceil(decimal_points + (decimal_points*5/4))
+        for worker in workers:
+            for device in worker.devices:
+                self.balancer.device_load_index_formula(
+                    device, decimal_points, interval, system_msg_count)
+            worker.load_index = math.fsum(device.load_index for device in worker.devices)
 
-        devices, system_msg_count, interval = cls.fetch_cache_data(devices, cache)
-        workers = set(workers)
+    @classmethod
+    def get_reprocessing_workers(
+            cls, workers: Set[Worker], reprocessing_devices: Set[Device]) -> Set[Worker]:
+        """Picks workers reserved for reprocessing devices, at least one worker stays normal
 
-        if system_msg_count:
-            workers = cls.balance_with_load_indexes(
-                workers, devices, worker_load_deviation, interval, system_msg_count)
-        else:
-            workers = cls.balance_with_count_per_worker(workers, devices)
+        Workers already holding most reprocessing devices are preferred
+        """
+        if not reprocessing_devices or len(workers) < 2:
+            return set()
 
-        return workers
+        worker_count = min(
+            math.ceil(len(reprocessing_devices) / cls.REPROCESSING_DEVICES_PER_WORKER),
+            max(int(len(workers) * cls.MAX_REPROCESSING_WORKERS), 1),
+            len(workers) - 1
+        )
+        ordered_workers = sorted(
+            workers,
+            key=lambda worker: (-len(worker.devices & reprocessing_devices), worker.identity)
+        )
+        return set(ordered_workers[:worker_count])
@@ -0,0 +1,204 @@
+import math
+from abc import ABC, abstractmethod
+from bisect import bisect
+from collections import defaultdict
+from hashlib import blake2b
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from ..infrastructure.cache import Cache
+from .balancing import Balancer
+from .entities import BalanceReport, Device, Worker
+
+
+class BalancingStrategy(ABC):
+    """Decides which devices each worker processes, Scheduler is configured with one"""
+
+    # whether Scheduler may apply device and worker changes with incremental rebalance
+    # between full rebalances, or has to call balance on every change
+    incremental = True
+
+    @abstractmethod
+    def balance(
+            self, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        """Assigns devices to workers, returns workers"""
+
+
+class AdaptiveStrategy(BalancingStrategy):
+    """Balances on load indexes if devices had traffic since last rebalance,
+    on device count otherwise
+    """
+
+    def balance(
+            self, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        return Balancer.balance_devices_per_worker(
+            workers, devices, cache, worker_load_deviation, load_smoothing, migration_cost)
+
+
+class DatabaseAwareStrategy(BalancingStrategy):
+    """Balances on load indexes, keeping devices of same database on few workers
+
+    Device databases are read only by DeviceStorage created with_databases
+    """
+
+    def __init__(self, max_database_load: float = Balancer.DATABASE_LOAD_PER_WORKER) -> None:
+        self.max_database_load = max_database_load
+
+    def balance(
+            self, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        if not workers or not devices:
+            return workers
+
+        devices, system_msg_count, interval = Balancer.fetch_cache_data(devices, cache)
+        return Balancer.balance_with_databases(
+            set(workers), devices, worker_load_deviation, interval, system_msg_count,
+            self.max_database_load, load_smoothing, migration_cost)
+
+
+class LoadIndexStrategy(BalancingStrategy):
+    """Always balances on load indexes, without traffic devices are spread by count"""
+
+    def balance(
+            self, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        if not workers or not devices:
+            return workers
+
+        devices, system_msg_count, interval = Balancer.fetch_cache_data(devices, cache)
+        return Balancer.balance_with_load_indexes(
+            set(workers), devices, worker_load_deviation, interval, system_msg_count,
+            load_smoothing, migration_cost)
+
+
+class CountPerWorkerStrategy(BalancingStrategy):
+    """Balances equal number of devices per worker, ignores load"""
+
+    def balance(
+            self, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        if not workers or not devices:
+            return workers
+
+        return Balancer.balance_with_count_per_worker(set(workers), devices)
+
+
+class MoveBudgetStrategy(BalancingStrategy):
+    """Balances on load indexes with at most max_moves devices changing worker per rebalance,
+    on device count if there was no traffic
+
+    Report of last rebalance is kept in `last_report`
+    """
+
+    def __init__(self, max_moves: int = 100) -> None:
+        self.max_moves = max_moves
+        self.last_report = None  # type: Optional[BalanceReport]
+
+    def balance(
+            self, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+        if not workers or not devices:
+            return workers
+
+        devices, system_msg_count, interval = Balancer.fetch_cache_data(devices, cache)
+        if not system_msg_count:
+            return Balancer.balance_with_count_per_worker(set(workers), devices)
+
+        workers, self.last_report = Balancer.balance_with_move_budget(
+            set(workers), devices, interval, system_msg_count, self.max_moves, load_smoothing)
+        return workers
+
+
+def stable_hash(key: str) -> int:
+    """64 bit hash that is same in every process, unlike builtin hash"""
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring, every node is placed on ring multiple times for even spread"""
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 100) -> None:
+        points = sorted(
+            (stable_hash('{}#{}'.format(node, replica)), node)
+            for node in set(nodes) for replica in range(replicas)
+        )
+        self._positions = [position for position, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def __len__(self) -> int:
+        return len(set(self._nodes))
+
+    def locate(self, key: str) -> str:
+        """Return node owning key"""
+        return next(self.successors(key))
+
+    def successors(self, key: str) -> Iterator[str]:
+        """Yields distinct nodes clockwise from key position"""
+
+        start = bisect(self._positions, stable_hash(key))
+        seen = set()  # type: Set[str]
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+class ConsistentHashStrategy(BalancingStrategy):
+    """Consistent hashing with bounded loads
+
+    Device goes to first worker clockwise on hash ring that has less than
+    load_factor times average device count. Placement doesn't depend on previous assignment
+    or load, worker joining or leaving moves about 1/W devices, and workers can compute
+    their own devices from worker and device ids with `assign`
+    """
+
+    incremental = False
+
+    def __init__(self, load_factor: float = 1.25, replicas: int = 100) -> None:
+        self.load_factor = load_factor
+        self.replicas = replicas
+
+    def assign(self, worker_ids: Iterable[str], device_ids: Iterable[int]) -> Dict[str, List[int]]:
+        """Return device ids per worker id"""
+
+        ring = HashRing(worker_ids, self.replicas)
+        device_ids = sorted(set(device_ids))
+        assignment = defaultdict(list)  # type: Dict[str, List[int]]
+        if not len(ring):
+            return assignment
+
+        capacity = math.ceil(self.load_factor * len(device_ids) / len(ring))
+        for device_id in device_ids:
+            for worker_id in ring.successors(str(device_id)):
+                if len(assignment[worker_id]) < capacity:
+                    assignment[worker_id].append(device_id)
+                    break
+        return assignment
+
+    def balance(
+            self, workers: Set[Worker], devices: Set[Device], cache: Cache,
+            worker_load_deviation: float = 0.0, load_smoothing: float = 1.0,
+            migration_cost: float = 0.0) -> Set[Worker]:
+
+        # placement ignores load, workers still report it and counters start over
+        devices, system_msg_count, interval = Balancer.fetch_cache_data(devices, cache)
+        decimal_points = len([c for c in str(len(devices))])
+        decimal_points = math.ceil(decimal_points + (decimal_points*5/4))
+        for device in devices:
+            Balancer.device_load_index_formula(
+                device, decimal_points, interval, system_msg_count)
+
+        device_by_id = {device.id_: device for device in devices}
+        assignment = self.assign((worker.identity for worker in workers), device_by_id)
+        for worker in workers:
+            worker.devices = {device_by_id[device_id] for device_id in assignment[worker.identity]}
+            worker.load_index = sum(device.load_index for device in worker.devices)
+        return workers
@@ -0,0 +1,181 @@
+"""Wall time, peak memory, load imbalance and device moves of balancers at scale
+
+Every balancer runs CYCLES rebalance cycles per (devices, workers) grid cell, with
+load generated by DataSimulator into CacheSimulator, same load for every balancer.
+Results are written as JSON, so runs on different commits can be compared
+
+Run as module: python -m <package>.simulators.benchmark --devices 1000 10000 --output out.json
+"""
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set
+
+from ..infrastructure.codec import device_key
+from ..service.balancing import Balancer
+from ..service.device_table import MSG_COUNT_WEIGHT, PROC_TIME_WEIGHT, DeviceTable, numpy
+from ..service.entities import Device, Worker
+from ..service.scheduler import Scheduler
+from .cache_sim import CacheSimulator
+from .data_sim import DataSimulator
+
+DEVICE_COUNTS = (1000, 10000, 100000)
+WORKER_COUNTS = (10, 100, 1000)
+CYCLES = 3
+INTERVAL_TIME = 10  # simulated seconds of load per cycle
+# balance_devices_per_worker reads cache itself, its case measures the read too
+BALANCERS = (
+    'balance_with_load_indexes', 'balance_with_count_per_worker',
+    'balance_devices_per_worker_with_fetch'
+)
+
+
+def _prepare(
+        balancer: str, workers: Set[Worker], devices: Set[Device],
+        cache: CacheSimulator) -> Callable[[], Set[Worker]]:
+    """Returns balancer call, reading cache data for it is not part of the measurement,
+    except for balance_devices_per_worker_with_fetch, which reads cache in the call
+    """
+
+    if balancer == 'balance_devices_per_worker_with_fetch':
+        return lambda: Balancer.balance_devices_per_worker(
+            workers, devices, cache, Scheduler.WORKER_DEVIATION)
+
+    devices, system_msg_count, interval = Balancer.fetch_cache_data(devices, cache)
+    if balancer == 'balance_with_load_indexes':
+        return lambda: Balancer.balance_with_load_indexes(
+            workers, devices, Scheduler.WORKER_DEVIATION, interval, system_msg_count)
+    return lambda: Balancer.balance_with_count_per_worker(workers, devices)
+
+
+def _device_loads(devices: Set[Device], cache: CacheSimulator) -> Dict[int, float]:
+    """Load share of every device in cycle, same formula as balancers use"""
+
+    ordered_devices = list(devices)
+    values = cache.get_many_field_values(
+        [device_key(device.id_) for device in ordered_devices],
+        (cache.COUNT_FIELD, cache.PROC_TIME_FIELD))
+    system_msg_count = sum(msg_count for msg_count, _ in values)
+    interval = sum(proc_time for _, proc_time in values)
+    if not system_msg_count or not interval:
+        return {device.id_: 0.0 for device in ordered_devices}
+
+    return {
+        device.id_: (proc_time * PROC_TIME_WEIGHT / interval +
+                     msg_count * MSG_COUNT_WEIGHT / system_msg_count) /
+                    (PROC_TIME_WEIGHT + MSG_COUNT_WEIGHT)
+        for device, (msg_count, proc_time) in zip(ordered_devices, values)
+    }
+
+
+def benchmark(balancer: str, device_count: int, worker_count: int,
+              cycles: int = CYCLES, interval_time: float = INTERVAL_TIME,
+              skew: float = 0.0) -> List[Dict]:
+    # own table, so smoothing state and rows don't leak between runs
+    table = DeviceTable()
+    devices = {Device(device_id, table=table) for device_id in range(device_count)}
+    workers = {Worker('worker-{}'.format(i)) for i in range(worker_count)}
+    cache = CacheSimulator()
+
+    results = []  # type: List[Dict]
+    previous_owner = {}  # type: Dict[int, str]
+    for cycle in range(cycles):
+        cache.clear()
+        DataSimulator(
+            cache, cycle, worker_count, devices, interval_time, skew=skew).generate_data()
+        device_loads = _device_loads(devices, cache)
+
+        # balancers read and reset cache and reassign devices, second run needs same input
+        cache_state = {key: Counter(fields) for key, fields in cache.cache.items()}
+        assignment = {worker: (set(worker.devices), worker.load_index) for worker in workers}
+
+        balance = _prepare(balancer, workers, devices, cache)
+        start = time.perf_counter()
+        balance()
+        wall_time = time.perf_counter() - start
+
+        balanced_assignment = {worker: set(worker.devices) for worker in workers}
+        for worker, (worker_devices, load_index) in assignment.items():
+            worker.devices, worker.load_index = worker_devices, load_index
+        cache.cache.update((key, Counter(fields)) for key, fields in cache_state.items())
+
+        balance = _prepare(balancer, workers, devices, cache)
+        tracemalloc.start()
+        balance()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        for worker, worker_devices in balanced_assignment.items():
+            worker.devices = worker_devices
+
+        owner = {device.id_: worker.identity for worker in workers for device in worker.devices}
+        worker_loads = [
+            math.fsum(device_loads[device.id_] for device in worker.devices)
+            for worker in workers
+        ]
+        mean_load = sum(worker_loads) / len(worker_loads)
+
+        results.append({
+            'balancer': balancer,
+            'devices': device_count,
+            'workers': worker_count,
+            'cycle': cycle,
+            'wall_time_s': round(wall_time, 6),
+            'peak_memory_bytes': peak_memory,
+            'max_load': round(max(worker_loads), 6),
+            'mean_load': round(mean_load, 6),
+            'imbalance': round(max(worker_loads) / mean_load, 4) if mean_load else None,
+            # first cycle places all devices, moves are counted from second cycle
+            'devices_moved': sum(
+                1 for device_id, worker_id in owner.items()
+                if previous_owner.get(device_id, worker_id) != worker_id
+            ) if previous_owner else None,
+            'devices_assigned': len(owner),
+        })
+        previous_owner = owner
+    return results
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--devices', type=int, nargs='+', default=DEVICE_COUNTS)
+    parser.add_argument('--workers', type=int, nargs='+', default=WORKER_COUNTS)
+    parser.add_argument('--cycles', type=int, default=CYCLES)
+    parser.add_argument('--interval', type=float, default=INTERVAL_TIME,
+                        help='simulated seconds of load per cycle')
+    parser.add_argument('--skew', type=float, default=0.0,
+                        help='Zipf exponent of device popularity, 0 is uniform')
+    parser.add_argument('--balancers', nargs='+', choices=BALANCERS, default=BALANCERS)
+    parser.add_argument('--output', help='JSON file, stdout if not given')
+    args = parser.parse_args(args)
+
+    results = []  # type: List[Dict]
+    for device_count in args.devices:
+        for worker_count in args.workers:
+            for balancer in args.balancers:
+                results.extend(benchmark(
+                    balancer, device_count, worker_count, args.cycles, args.interval,
+                    args.skew))
+                print('{} devices, {} workers, {} done'.format(
+                    device_count, worker_count, balancer), file=sys.stderr)
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': numpy is not None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
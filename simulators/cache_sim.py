@@ -1,5 +1,5 @@
 from collections import Counter, defaultdict
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 
 class CacheSimulator:
@@ -7,6 +7,8 @@ class CacheSimulator:
     PROC_TIME_FIELD = 'proc_time'
     RESET_VALUE = 0
     SYSTEM_FIELD = 'system'
+    LAG_FIELD = 'lag'
+    BATCH_SIZE = 1000
 
     def __init__(self) -> None:
         self.cache = defaultdict(Counter)
@@ -27,9 +29,27 @@ class CacheSimulator:
     def increment_field(self, _key: str, _field: str, amount: float) -> None:
         self.cache[_key][_field] += amount
 
+    def increment_many_fields(self, increments: Iterable[Tuple[str, str, float]]) -> None:
+        for _key, _field, amount in increments:
+            self.increment_field(_key, _field, amount)
+
     def update_field(self, _key: str, _field: str, value: Any) -> None:
         self.cache[_key][_field] = value
 
+    def fetch_and_reset_fields(
+            self, keys: Iterable[str], fields: Sequence[str],
+            batch_size: Optional[int] = None) -> List[Tuple]:
+        values = []  # type: List[Tuple]
+        for _key in keys:
+            values.append(self.get_field_values(_key, *fields))
+            self.set_field_values(_key, {field: self.RESET_VALUE for field in fields})
+        return values
+
+    def get_many_field_values(
+            self, keys: Iterable[str], fields: Sequence[str],
+            batch_size: Optional[int] = None) -> List[Tuple]:
+        return [self.get_field_values(_key, *fields) for _key in keys]
+
     def clear(self) -> None:
         del self.cache
         self.cache = defaultdict(Counter)
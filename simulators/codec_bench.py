@@ -0,0 +1,56 @@
+"""Size and speed of worker device node encodings
+
+Run as module: python -m <package>.simulators.codec_bench
+"""
+import pickle
+import timeit
+from random import sample, seed
+from typing import Callable, Dict, List
+
+from ..infrastructure.codec import decode_device_ids, encode_device_ids
+
+ID_COUNTS = (10000, 100000)
+ID_SPACE = 10  # ids are sampled from ID_SPACE times bigger range, like real DB ids with gaps
+REPEAT = 5
+
+
+def _timed(func: Callable, repeat: int = REPEAT) -> float:
+    """Best run time in milliseconds"""
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+def benchmark(id_count: int) -> List[Dict]:
+    device_ids = sample(range(id_count * ID_SPACE), id_count)
+
+    encoders = {
+        'pickle': (lambda: pickle.dumps(sorted(device_ids)), pickle.loads),
+        'codec': (lambda: encode_device_ids(device_ids, compress=False), decode_device_ids),
+        'codec+zlib': (lambda: encode_device_ids(device_ids), decode_device_ids),
+    }
+
+    results = []
+    for name, (encode, decode) in encoders.items():
+        value = encode()
+        assert sorted(decode(value)) == sorted(device_ids)
+        results.append({
+            'ids': id_count,
+            'encoding': name,
+            'bytes': len(value),
+            'encode_ms': round(_timed(encode), 3),
+            'decode_ms': round(_timed(lambda: decode(value)), 3),
+        })
+    return results
+
+
+def main() -> None:
+    seed(0)
+    print('{:>8} {:>12} {:>10} {:>10} {:>10}'.format(
+        'ids', 'encoding', 'bytes', 'encode_ms', 'decode_ms'))
+    for id_count in ID_COUNTS:
+        for result in benchmark(id_count):
+            print('{ids:>8} {encoding:>12} {bytes:>10} {encode_ms:>10} {decode_ms:>10}'.format(
+                **result))
+
+
+if __name__ == '__main__':
+    main()
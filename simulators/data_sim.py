@@ -1,34 +1,321 @@
-from math import ceil, sqrt
+import random
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+from itertools import accumulate
+from math import ceil, erf, exp, fsum, pi, sin, sqrt
 from random import choice, gauss, seed
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from ..infrastructure.codec import decode_device_ids, device_key, encode_device_ids
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# devices getting factor times more messages from start for duration simulated seconds
+Burst = namedtuple('Burst', ['start', 'duration', 'device_ids', 'factor'])
+# messages aggregated per device in one step of simulated time, device ids are sorted
+Step = namedtuple('Step', ['time', 'device_ids', 'msg_counts', 'proc_times'])
+
+
+class LoadProfile:
+    """Message rate over simulated time, daily ramp up and down and hot device bursts
+
+    :param diurnal_amplitude: (float) index 1 how much rate swings around the average
+    :param period: (float) simulated seconds of one up and down swing
+    :param phase: (float) simulated seconds into the period at time 0
+    :param bursts: (Iterable[Burst]) hot devices with multiplied message rate
+    """
+
+    def __init__(self, diurnal_amplitude: float = 0.0, period: float = 86400,
+                 phase: float = 0.0, bursts: Iterable[Burst] = ()) -> None:
+        self.diurnal_amplitude = diurnal_amplitude
+        self.period = period
+        self.phase = phase
+        self.bursts = list(bursts)
+
+    def rate(self, time_: float) -> float:
+        """Multiplier of average message rate at simulated time"""
+        swing = sin(2 * pi * (time_ + self.phase) / self.period)
+        return max(0.0, 1 + self.diurnal_amplitude * swing)
+
+    def active_bursts(self, start: float, end: float) -> List[Burst]:
+        return [burst for burst in self.bursts
+                if burst.start < end and start < burst.start + burst.duration]
 
 
 class DataSimulator:
-    def __init__(self, cache, seed_num, workers, devices, interval_time):
+    STEP = 1.0  # simulated seconds of messages aggregated into one trace step
+
+    def __init__(self, cache, seed_num, workers, devices, interval_time,
+                 skew: float = 0.0, profile: Optional[LoadProfile] = None,
+                 message_rate: Optional[float] = None) -> None:
+        """
+        :param skew: (float) Zipf exponent of device popularity, 0 is uniform
+        :param message_rate: (float) average messages per simulated second, by default
+            as many as single processor can handle
+        """
         self.cache = cache
         self.seed_num = seed_num
         self.workers = workers
         self.devices = devices
         self.interval_time = interval_time
+        self.skew = skew
+        self.profile = profile or LoadProfile()
+        self.time = 0.0  # simulated seconds generated so far
 
         decimal_points = len([c for c in str(len(self.devices))])
         self.decimal_points = ceil(decimal_points + (decimal_points*5/4))
 
         self.device_load = round((1/len(devices)), self.decimal_points)
         self.gauss_dev = self.device_load * sqrt(len(self.devices))
+        self.message_rate = message_rate or 1 / self._mean_proc_time()
+
+        self._device_list = list(self.devices)
+        self._device_ids = sorted(device.id_ for device in self.devices)
+        self._device_index = {device_id: i for i, device_id in enumerate(self._device_ids)}
+        self._random = random.Random(seed_num)
+        self._rng = numpy.random.default_rng(seed_num) if numpy is not None else None
+        self._popularity = self._zipf_popularity()
+        self._cumulative_popularity = list(accumulate(self._popularity))
+        if numpy is not None:
+            self._device_id_array = numpy.asarray(self._device_ids, dtype=numpy.int64)
+            self._cumulative_popularity = numpy.asarray(self._cumulative_popularity)
+
+    def _mean_proc_time(self) -> float:
+        """Mean of absolute value of processing time normal distribution"""
+        mean, deviation = self.device_load, self.gauss_dev
+        if not deviation:
+            return mean or 1.0
+        return (deviation * sqrt(2 / pi) * exp(-mean ** 2 / (2 * deviation ** 2)) +
+                mean * erf(mean / (deviation * sqrt(2))))
+
+    def _zipf_popularity(self) -> List[float]:
+        """Share of messages per device, popularity ranks are shuffled over device ids"""
+
+        ranks = list(range(1, len(self._device_ids) + 1))
+        random.Random(self.seed_num).shuffle(ranks)
+        weights = [rank ** -self.skew for rank in ranks]
+        total = fsum(weights)
+        return [weight / total for weight in weights]
 
     def load_simulator(self):
-        device = choice(list(self.devices))
+        device = choice(self._device_list)
 
         calc_time = abs(round(gauss(self.device_load, self.gauss_dev), self.decimal_points))
-        _key = 'device:{}'.format(device.id_)
+        _key = device_key(device.id_)
         self.cache.increment_field(_key, self.cache.COUNT_FIELD, 1)
         self.cache.increment_field(_key, self.cache.PROC_TIME_FIELD, calc_time)
         self.cache.increment_field(self.cache.SYSTEM_FIELD, self.cache.COUNT_FIELD, 1)
 
         return calc_time
 
-    def generate_data(self) -> int:
+    def generate_data_per_message(self) -> None:
+        """Writes messages one by one until processing time fills the interval"""
         seed(self.seed_num)
         sleep_time = 0
         while sleep_time < self.interval_time:
             sleep_time += self.load_simulator()
+
+    def generate_data(self, record: Optional['TraceWriter'] = None,
+                      replay: Optional['TraceReader'] = None) -> float:
+        """Writes next interval of messages to cache, aggregated per device
+
+        Messages are simulated, or read from replayed trace, and can be recorded to trace.
+        Returns processing time of all messages
+        """
+        end_time = self.time + self.interval_time
+        if replay is not None:
+            steps = replay.read_until(end_time)
+        else:
+            steps = list(self.simulate(self.interval_time))
+        self.time = end_time
+
+        if record is not None:
+            record.write(steps)
+        return self.write_steps(steps)
+
+    def simulate(self, duration: float) -> Iterator[Step]:
+        """Yields messages aggregated per device for every STEP of simulated time"""
+
+        end_time = self.time + duration
+        time_ = self.time
+        while time_ < end_time:
+            length = min(self.STEP, end_time - time_)
+            cumulative = self._cumulative_popularity
+            expected = self.message_rate * length * self.profile.rate(time_)
+
+            bursts = self.profile.active_bursts(time_, time_ + length)
+            if bursts:
+                popularity = list(self._popularity)
+                for burst in bursts:
+                    for device_id in burst.device_ids:
+                        if device_id in self._device_index:
+                            popularity[self._device_index[device_id]] *= burst.factor
+                cumulative = list(accumulate(popularity))
+                # bursts add messages of hot devices on top of the average rate
+                expected *= cumulative[-1]
+
+            if self._rng is not None:
+                yield self._simulate_step_numpy(time_, expected, cumulative)
+            else:
+                yield self._simulate_step(time_, expected, cumulative)
+            time_ += length
+
+    def _simulate_step_numpy(
+            self, time_: float, expected: float, cumulative: Sequence[float]) -> Step:
+        rng = self._rng
+        message_count = rng.poisson(expected)
+        rows = numpy.searchsorted(cumulative, rng.random(message_count) * cumulative[-1],
+                                  side='right')
+        rows = numpy.minimum(rows, len(cumulative) - 1)
+        proc_times = numpy.abs(numpy.round(
+            rng.normal(self.device_load, self.gauss_dev, message_count), self.decimal_points))
+
+        # only rows that got messages are aggregated, not whole fleet
+        active, inverse = numpy.unique(rows, return_inverse=True)
+        msg_counts = numpy.bincount(inverse, minlength=len(active))
+        proc_time_sums = numpy.bincount(inverse, weights=proc_times, minlength=len(active))
+        return Step(time_, self._device_id_array[active].tolist(),
+                    msg_counts.tolist(), proc_time_sums.tolist())
+
+    def _simulate_step(
+            self, time_: float, expected: float, cumulative: Sequence[float]) -> Step:
+        _random = self._random
+        # normal approximation of poisson, good enough for message counts
+        message_count = max(0, round(_random.gauss(expected, sqrt(expected))))
+        rows = _random.choices(
+            range(len(cumulative)), cum_weights=cumulative, k=message_count)
+
+        aggregated = {}  # type: Dict[int, List]
+        for row in rows:
+            proc_time = abs(round(
+                _random.gauss(self.device_load, self.gauss_dev), self.decimal_points))
+            values = aggregated.setdefault(row, [0, 0.0])
+            values[0] += 1
+            values[1] += proc_time
+
+        active = sorted(aggregated)
+        return Step(time_, [self._device_ids[row] for row in active],
+                    [aggregated[row][0] for row in active],
+                    [aggregated[row][1] for row in active])
+
+    def write_steps(self, steps: Iterable[Step]) -> float:
+        """Writes steps to cache in single transaction, one increment per device and field
+
+        Returns processing time of all messages
+        """
+        msg_counts = {}  # type: Dict[int, int]
+        proc_times = {}  # type: Dict[int, float]
+        for step in steps:
+            for device_id, msg_count, proc_time in zip(
+                    step.device_ids, step.msg_counts, step.proc_times):
+                msg_counts[device_id] = msg_counts.get(device_id, 0) + msg_count
+                proc_times[device_id] = proc_times.get(device_id, 0.0) + proc_time
+
+        self.cache.start_transaction()
+        for device_id, msg_count in msg_counts.items():
+            _key = device_key(device_id)
+            self.cache.increment_field(_key, self.cache.COUNT_FIELD, msg_count)
+            self.cache.increment_field(_key, self.cache.PROC_TIME_FIELD, proc_times[device_id])
+        self.cache.increment_field(
+            self.cache.SYSTEM_FIELD, self.cache.COUNT_FIELD, sum(msg_counts.values()))
+        self.cache.end_transaction()
+
+        return fsum(proc_times.values())
+
+
+# trace file: header, then length prefixed zlib compressed steps
+TRACE_HEADER = struct.Struct('<2sB')
+TRACE_MAGIC = b'DT'
+TRACE_VERSION = 1
+# step: time, device count, length of encoded device ids
+STEP_HEADER = struct.Struct('<dII')
+RECORD_LENGTH = struct.Struct('<I')
+
+
+class TraceWriter:
+    """Records simulated steps to binary file, so load can be replayed offline
+
+    Device ids are stored with device ids codec, message counts and processing times
+    as little endian arrays, every step is zlib compressed
+    """
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+
+    def write(self, steps: Iterable[Step]) -> None:
+        for step in steps:
+            device_ids = encode_device_ids(step.device_ids, compress=False)
+            msg_counts = array('I', step.msg_counts)
+            proc_times = array('d', step.proc_times)
+            if sys.byteorder == 'big':
+                msg_counts.byteswap()
+                proc_times.byteswap()
+
+            record = zlib.compress(b''.join((
+                STEP_HEADER.pack(step.time, len(step.device_ids), len(device_ids)),
+                device_ids, msg_counts.tobytes(), proc_times.tobytes(),
+            )))
+            self.file.write(RECORD_LENGTH.pack(len(record)) + record)
+
+
+class TraceReader:
+    """Reads steps recorded by TraceWriter"""
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        magic, version = TRACE_HEADER.unpack(self.file.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError('Unsupported trace format: {!r} {}'.format(magic, version))
+        self._pending = None  # type: Optional[Step]
+
+    def __iter__(self) -> Iterator[Step]:
+        while True:
+            step = self._read_step()
+            if step is None:
+                return
+            yield step
+
+    def read_until(self, end_time: float) -> List[Step]:
+        """Return next steps that start before end_time"""
+
+        steps = []  # type: List[Step]
+        while True:
+            step = self._read_step()
+            if step is None:
+                return steps
+            if step.time >= end_time:
+                self._pending = step
+                return steps
+            steps.append(step)
+
+    def _read_step(self) -> Optional[Step]:
+        if self._pending is not None:
+            step, self._pending = self._pending, None
+            return step
+
+        length = self.file.read(RECORD_LENGTH.size)
+        if not length:
+            return None
+        record = zlib.decompress(self.file.read(RECORD_LENGTH.unpack(length)[0]))
+
+        time_, count, ids_length = STEP_HEADER.unpack_from(record)
+        offset = STEP_HEADER.size
+        device_ids = decode_device_ids(record[offset:offset + ids_length])
+        offset += ids_length
+
+        msg_counts, proc_times = array('I'), array('d')
+        msg_counts.frombytes(record[offset:offset + count * msg_counts.itemsize])
+        offset += count * msg_counts.itemsize
+        proc_times.frombytes(record[offset:offset + count * proc_times.itemsize])
+        if sys.byteorder == 'big':
+            msg_counts.byteswap()
+            proc_times.byteswap()
+
+        return Step(time_, device_ids, msg_counts.tolist(), proc_times.tolist())
@@ -0,0 +1,50 @@
+import sqlite3
+from datetime import datetime
+from typing import Any, Iterable, List, Optional, Tuple
+
+sqlite3.register_adapter(datetime, datetime.isoformat)
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+
+class DbConnectorSimulator:
+    """SQLite backed stand-in for DbConnector with m_controldata_device table"""
+
+    def __init__(self) -> None:
+        self.connection = sqlite3.connect(
+            ':memory:', detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE m_controldata_device (
+                id INTEGER PRIMARY KEY,
+                enabled BOOLEAN NOT NULL DEFAULT true,
+                processable BOOLEAN NOT NULL DEFAULT true,
+                updated_at TIMESTAMP NOT NULL,
+                source_database TEXT
+            )
+        """)
+        self.connection.execute(
+            'CREATE INDEX device_updated_at ON m_controldata_device (updated_at)')
+        self.query_count = 0
+
+    def execute_sql(self, query: str, params: Tuple = ()) -> List[Tuple]:
+        self.query_count += 1
+        return self.connection.execute(query.replace('%s', '?'), params).fetchall()
+
+    def add_devices(self, device_ids: Iterable[int], database: Optional[str] = None) -> None:
+        self.connection.executemany(
+            'INSERT INTO m_controldata_device (id, updated_at, source_database) VALUES (?, ?, ?)',
+            [(device_id, datetime.now(), database) for device_id in device_ids]
+        )
+
+    def update_devices(self, device_ids: Iterable[int], **fields: Any) -> None:
+        """Updates device fields and touches updated_at like DB trigger would"""
+        assignments = ', '.join('{} = ?'.format(field) for field in fields)
+        self.connection.executemany(
+            'UPDATE m_controldata_device SET {}, updated_at = ? WHERE id = ?'.format(assignments),
+            [(*fields.values(), datetime.now(), device_id) for device_id in device_ids]
+        )
+
+    def delete_devices(self, device_ids: Iterable[int]) -> None:
+        self.connection.executemany(
+            'DELETE FROM m_controldata_device WHERE id = ?',
+            [(device_id,) for device_id in device_ids]
+        )
@@ -0,0 +1,249 @@
+from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from kazoo.exceptions import (
+    BadVersionError, NodeExistsError, NoNodeError, NotEmptyError, RolledBackError
+)
+
+ZnodeStat = namedtuple('ZnodeStat', ['version', 'czxid', 'numChildren'])
+Nodes = Dict[str, Tuple[bytes, int, int]]  # path: (value, version, czxid)
+
+
+class AsyncResultSimulator:
+    """Already resolved stand-in for kazoo IAsyncResult"""
+
+    def __init__(self, func: Callable, *args: Any) -> None:
+        self.value = None  # type: Any
+        self.exception = None  # type: Optional[Exception]
+        try:
+            self.value = func(*args)
+        except Exception as e:
+            self.exception = e
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class TransactionSimulator:
+    """In memory stand-in for kazoo TransactionRequest, commits all operations or none"""
+
+    def __init__(self, client: 'ZooKeeperSimulator') -> None:
+        self.client = client
+        self.operations = []  # type: List[Tuple[str, Tuple]]
+        self.committed = False
+
+    def create(self, path: str, value: bytes = b'', ephemeral: bool = False) -> None:
+        self.operations.append(('create', (path, value, ephemeral)))
+
+    def set_data(self, path: str, value: bytes, version: int = -1) -> None:
+        self.operations.append(('set_data', (path, value, version)))
+
+    def delete(self, path: str, version: int = -1) -> None:
+        self.operations.append(('delete', (path, version)))
+
+    def check(self, path: str, version: int) -> None:
+        self.operations.append(('check', (path, version)))
+
+    def commit(self) -> List[Any]:
+        if self.committed:
+            raise ValueError('Transaction already committed')
+        self.committed = True
+
+        nodes = dict(self.client.nodes)
+        results = []  # type: List[Any]
+        for operation, args in self.operations:
+            try:
+                results.append(getattr(self.client, '_{}'.format(operation))(nodes, *args))
+            except (BadVersionError, NodeExistsError, NoNodeError, NotEmptyError) as e:
+                results.append(e)
+
+        failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+        if failed:
+            return [result if i in failed else RolledBackError()
+                    for i, result in enumerate(results)]
+
+        self.client._apply(nodes)
+        return results
+
+
+class ZooKeeperSimulator:
+    """In memory stand-in for KazooClient with the subset of API our services use"""
+
+    def __init__(self) -> None:
+        self.nodes = {'/': (b'', 0, 0)}  # type: Nodes
+        self.zxid = 0
+        self.children_watches = {}  # type: Dict[str, List[Callable]]
+        self.data_watches = {}  # type: Dict[str, List[Callable]]
+        self.state_listeners = []  # type: List[Callable]
+        self.write_count = 0
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def add_listener(self, listener: Callable) -> None:
+        self.state_listeners.append(listener)
+
+    def remove_listener(self, listener: Callable) -> None:
+        self.state_listeners.remove(listener)
+
+    def set_state(self, state: str) -> None:
+        """Calls connection state listeners, as kazoo does on connection changes"""
+        for listener in list(self.state_listeners):
+            listener(state)
+
+    def retry(self, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        return func(*args, **kwargs)
+
+    def create(self, path: str, value: bytes = b'', ephemeral: bool = False,
+               makepath: bool = False) -> str:
+        nodes = dict(self.nodes)
+        if makepath:
+            parent = self._parent(path)
+            missing = []
+            while parent not in nodes:
+                missing.append(parent)
+                parent = self._parent(parent)
+            for parent in reversed(missing):
+                self.zxid += 1
+                nodes[parent] = (b'', 0, self.zxid)
+        self._create(nodes, path, value, ephemeral)
+        self._apply(nodes)
+        return path
+
+    def set(self, path: str, value: bytes, version: int = -1) -> ZnodeStat:
+        nodes = dict(self.nodes)
+        stat = self._set_data(nodes, path, value, version)
+        self._apply(nodes)
+        return stat
+
+    def get(self, path: str, watch: Optional[Callable] = None) -> Tuple[bytes, ZnodeStat]:
+        if path not in self.nodes:
+            raise NoNodeError(path)
+        value, *_ = self.nodes[path]
+        return value, self._stat(self.nodes, path)
+
+    def exists(self, path: str, watch: Optional[Callable] = None) -> Optional[ZnodeStat]:
+        if path not in self.nodes:
+            return None
+        return self.get(path)[1]
+
+    def get_children(self, path: str, watch: Optional[Callable] = None) -> List[str]:
+        if path not in self.nodes:
+            raise NoNodeError(path)
+        return self._children(self.nodes, path)
+
+    def delete(self, path: str, version: int = -1, recursive: bool = False) -> bool:
+        nodes = dict(self.nodes)
+        if recursive:
+            if path not in nodes:
+                raise NoNodeError(path)
+            for node in [node for node in nodes if node.startswith(path + '/')]:
+                del nodes[node]
+        self._delete(nodes, path, version)
+        self._apply(nodes)
+        return True
+
+    def get_async(self, path: str, watch: Optional[Callable] = None) -> AsyncResultSimulator:
+        return AsyncResultSimulator(self.get, path)
+
+    def exists_async(self, path: str, watch: Optional[Callable] = None) -> AsyncResultSimulator:
+        return AsyncResultSimulator(self.exists, path)
+
+    def transaction(self) -> TransactionSimulator:
+        return TransactionSimulator(self)
+
+    def ChildrenWatch(self, path: str) -> Callable:
+        """Decorator calling function with node children now and on every children change"""
+
+        def decorator(func: Callable) -> Callable:
+            self.children_watches.setdefault(path, []).append(func)
+            func(self._children(self.nodes, path) if path in self.nodes else [])
+            return func
+        return decorator
+
+    def DataWatch(self, path: str) -> Callable:
+        """Decorator calling function with node data and stat now and on every data change,
+        with None, None while node doesn't exist
+        """
+
+        def decorator(func: Callable) -> Callable:
+            self.data_watches.setdefault(path, []).append(func)
+            if func(*self._data(self.nodes, path)) is False:
+                self.data_watches[path].remove(func)
+            return func
+        return decorator
+
+    def _data(self, nodes: Nodes, path: str) -> Tuple[Optional[bytes], Optional[ZnodeStat]]:
+        if path not in nodes:
+            return None, None
+        return nodes[path][0], self._stat(nodes, path)
+
+    def _apply(self, nodes: Nodes) -> None:
+        """Swaps node state and fires children and data watches of changed paths"""
+
+        old_nodes, self.nodes = self.nodes, nodes
+        self.write_count += 1
+        # watches can register new watches
+        for path, watches in list(self.data_watches.items()):
+            if nodes.get(path) != old_nodes.get(path):
+                for func in list(watches):
+                    if func(*self._data(nodes, path)) is False:
+                        watches.remove(func)
+        for path, watches in list(self.children_watches.items()):
+            children = self._children(nodes, path)
+            if children != self._children(old_nodes, path):
+                for func in list(watches):
+                    if func(children) is False:
+                        watches.remove(func)
+
+    @staticmethod
+    def _parent(path: str) -> str:
+        return path.rsplit('/', 1)[0] or '/'
+
+    @staticmethod
+    def _children(nodes: Nodes, path: str) -> List[str]:
+        prefix = path.rstrip('/') + '/'
+        return sorted(
+            node[len(prefix):] for node in nodes
+            if node.startswith(prefix) and '/' not in node[len(prefix):]
+        )
+
+    def _create(self, nodes: Nodes, path: str, value: bytes,
+                ephemeral: bool = False) -> str:
+        if path in nodes:
+            raise NodeExistsError(path)
+        if self._parent(path) not in nodes:
+            raise NoNodeError(path)
+        self.zxid += 1
+        nodes[path] = (value or b'', 0, self.zxid)
+        return path
+
+    def _set_data(self, nodes: Nodes, path: str, value: bytes,
+                  version: int = -1) -> ZnodeStat:
+        self._check(nodes, path, version)
+        _, version, czxid = nodes[path]
+        nodes[path] = (value, version + 1, czxid)
+        return self._stat(nodes, path)
+
+    def _delete(self, nodes: Nodes, path: str, version: int = -1) -> bool:
+        self._check(nodes, path, version)
+        if self._children(nodes, path):
+            raise NotEmptyError(path)
+        del nodes[path]
+        return True
+
+    def _stat(self, nodes: Nodes, path: str) -> ZnodeStat:
+        _, version, czxid = nodes[path]
+        return ZnodeStat(version, czxid, len(self._children(nodes, path)))
+
+    def _check(self, nodes: Nodes, path: str, version: int) -> bool:
+        if path not in nodes:
+            raise NoNodeError(path)
+        if version != -1 and nodes[path][1] != version:
+            raise BadVersionError(path)
+        return True
@@ -0,0 +1,52 @@
+import pickle
+
+from m_dataqualifier.processing_v2.infrastructure.codec import decode_device_ids
+from m_dataqualifier.processing_v2.infrastructure.device_mapper import WorkerDeviceMapper
+from m_dataqualifier.processing_v2.service.device_table import DeviceTable
+from m_dataqualifier.processing_v2.service.entities import Device, Worker
+
+
+def make_workers(loads):
+    """Workers holding devices with given loads, load is share of messages and time
+
+    Returns workers, their devices and total load to pass as interval and message count
+    """
+    table = DeviceTable()
+    workers, devices = set(), set()
+    for identity, device_loads in loads.items():
+        worker = Worker(identity)
+        for load in device_loads:
+            device = Device(len(devices), table=table)
+            device.msg_count, device.proc_time = load, load
+            worker.add_device(device)
+            devices.add(device)
+        workers.add(worker)
+    return workers, devices, sum(sum(device_loads) for device_loads in loads.values())
+
+
+def owners(workers):
+    """Worker identity per device id"""
+    return {device.id_: worker.identity for worker in workers for device in worker.devices}
+
+
+def start_workers(zk, *worker_ids, capacity=None):
+    """Registers workers like they do on start, with advertised capacity"""
+    for worker_id in worker_ids:
+        zk.create('{}/{}'.format(WorkerDeviceMapper.WORKER_PATH, worker_id),
+                  pickle.dumps(capacity.to_dict() if capacity else None), makepath=True)
+
+
+def assign(mapper, assignment):
+    """Publishes device ids per worker identity through mapper"""
+    workers = {Worker(worker_id) for worker_id in assignment}
+    for worker in workers:
+        worker.devices = {Device(device_id) for device_id in assignment[worker.identity]}
+    mapper.update_worker_devices(workers)
+
+
+def published(zk, path=WorkerDeviceMapper.WORKERS_DEVICES_PATH):
+    """Device ids per worker identity as written in Zookeeper"""
+    return {
+        worker_id: set(decode_device_ids(zk.get('{}/{}'.format(path, worker_id))[0]))
+        for worker_id in zk.get_children(path)
+    }
@@ -0,0 +1,172 @@
+import pytest
+
+from m_dataqualifier.processing_v2.service import device_table
+from m_dataqualifier.processing_v2.service.balancing import Balancer
+from m_dataqualifier.processing_v2.service.device_table import DeviceTable
+from m_dataqualifier.processing_v2.service.entities import Capacity, Device, Worker
+from m_dataqualifier.processing_v2.tests.conftest import make_workers, owners
+
+
+def test_load_indexes_spread_heaviest_first():
+    workers, devices, total = make_workers({'a': [40, 30, 20, 10], 'b': [], 'c': []})
+
+    Balancer.balance_with_load_indexes(workers, devices, 0.1, total, total)
+
+    loads = sorted(round(worker.load_index, 6) for worker in workers)
+    assert loads == [0.3, 0.3, 0.4]
+    # heaviest device that fits deviated load share stays with its worker
+    assert owners(workers)[1] == 'a'
+
+
+def test_load_indexes_same_without_numpy(monkeypatch):
+    loads = {'a': [9, 9, 8, 1, 1], 'b': [7, 3], 'c': [6, 6, 6, 6], 'd': []}
+
+    def balance():
+        workers, devices, total = make_workers(loads)
+        # device listed on two workers goes to one of them
+        next(worker for worker in workers if worker.identity == 'd').add_device(
+            next(device for device in devices if device.id_ == 0))
+        Balancer.balance_with_load_indexes(workers, devices, 0.1, total, total)
+        return owners(workers), sorted(worker.load_index for worker in workers)
+
+    assignment = balance()
+    monkeypatch.setattr(device_table, 'numpy', None)
+    assert balance() == assignment
+
+
+def test_count_balancing_keeps_devices_within_quotas():
+    workers, devices, _ = make_workers({'a': [1] * 7, 'b': [1] * 2, 'c': []})
+    previous = owners(workers)
+
+    Balancer.balance_with_count_per_worker(workers, devices)
+
+    assert sorted(len(worker) for worker in workers) == [3, 3, 3]
+    moved = sum(1 for device_id, owner in owners(workers).items() if previous[device_id] != owner)
+    assert moved == 4
+
+
+def test_incremental_rebalance_converges_on_equal_loads():
+    workers, devices, total = make_workers({'a': [1] * 4, 'b': [1] * 3})
+    Balancer.balance_with_load_indexes(workers, devices, 0.1, total, total)
+
+    # b is under deviated share, but the gap equals load of one device,
+    # moving it only swaps the workers
+    Balancer.rebalance_incremental(workers, set(), set(), set(), set(), 0.1)
+
+    assert sorted(len(worker) for worker in workers) == [3, 4]
+
+
+def test_incremental_rebalance_spreads_to_added_worker():
+    workers, devices, total = make_workers({'a': [1] * 6, 'b': [1] * 6})
+    Balancer.balance_with_load_indexes(workers, devices, 0.1, total, total)
+    previous = owners(workers)
+    new_worker = Worker('c')
+
+    Balancer.rebalance_incremental(workers, set(), set(), {new_worker}, set(), 0.1)
+
+    assert sorted(len(worker) for worker in workers | {new_worker}) == [4, 4, 4]
+    # only devices the new worker took moved
+    moved = {device_id for device_id, owner in owners(workers | {new_worker}).items()
+             if previous[device_id] != owner}
+    assert moved == {device.id_ for device in new_worker.devices}
+
+
+def test_move_must_pay_migration_cost():
+    loads = {'a': [25, 20, 5], 'b': [25], 'c': [25]}
+    workers, devices, total = make_workers(loads)
+
+    Balancer.balance_with_load_indexes(workers, devices, 0.0, total, total)
+    # without cost device over deviated load goes to the least loaded worker
+    assert owners(workers)[1] == 'b'
+
+    workers, devices, total = make_workers(loads)
+    Balancer.balance_with_load_indexes(
+        workers, devices, 0.0, total, total, migration_cost=0.2)
+    # moving it lowers a's load less than the cost
+    assert owners(workers)[1] == 'a'
+
+
+def test_move_budget_limits_moves():
+    workers, devices, total = make_workers({'a': [10] * 8, 'b': [], 'c': []})
+    previous = owners(workers)
+
+    _, report = Balancer.balance_with_move_budget(workers, devices, total, total, max_moves=2)
+
+    moved = sum(1 for device_id, owner in owners(workers).items() if previous[device_id] != owner)
+    assert moved == report.moves == 2
+    assert report.imbalance_ratio < 3.0
+
+
+def test_move_budget_balances_with_enough_moves():
+    workers, devices, total = make_workers({'a': [10] * 8, 'b': [], 'c': [], 'd': []})
+
+    _, report = Balancer.balance_with_move_budget(workers, devices, total, total, max_moves=10)
+
+    assert sorted(len(worker) for worker in workers) == [2, 2, 2, 2]
+    assert report.moves == 6
+    assert report.imbalance_ratio == 1.0
+
+
+def test_move_budget_swaps_devices():
+    workers, devices, total = make_workers({'a': [40, 20], 'b': [30, 10]})
+
+    _, report = Balancer.balance_with_move_budget(workers, devices, total, total, max_moves=2)
+
+    # single move can't narrow the gap of 20, swapping 20 for 10 closes it
+    assert report.moves == 2
+    assert [worker.load_index for worker in workers] == pytest.approx([0.5, 0.5])
+
+
+def test_count_quotas_follow_capacity_and_limits():
+    workers = [Worker('a', Capacity(cores=2)), Worker('b'), Worker('c', Capacity(max_devices=1))]
+
+    quotas = Balancer.get_worker_quotas(workers, 9)
+
+    assert [quotas[worker] for worker in workers] == [5, 3, 1]
+
+
+def test_count_quotas_follow_memory_of_all_workers():
+    workers = [Worker('a', Capacity(cores=4, memory=1024)), Worker('b', Capacity(memory=2048))]
+    quotas = Balancer.get_worker_quotas(workers, 9)
+    assert [quotas[worker] for worker in workers] == [3, 6]
+
+    # worker without advertised memory makes cores count
+    workers.append(Worker('c'))
+    quotas = Balancer.get_worker_quotas(workers, 12)
+    assert [quotas[worker] for worker in workers] == [8, 2, 2]
+
+
+def _database_devices(databases):
+    """Devices without load, count per database name"""
+    table = DeviceTable()
+    devices = set()
+    for name, count in databases.items():
+        for _ in range(count):
+            device = Device(len(devices), table=table)
+            device.database = name
+            devices.add(device)
+    return devices
+
+
+def test_databases_stay_on_few_workers():
+    devices = _database_devices({'x': 6, 'y': 6})
+    workers = {Worker(identity) for identity in 'abcd'}
+
+    # worker can take its whole load share from one database
+    Balancer.balance_with_databases(workers, devices, 0.1, 0, 0, max_database_load=1.0)
+
+    assert sorted(len(worker) for worker in workers) == [3, 3, 3, 3]
+    readers = {name: {worker.identity for worker in workers
+                      if any(device.database == name for device in worker.devices)}
+               for name in 'xy'}
+    assert len(readers['x']) == len(readers['y']) == 2
+
+
+def test_databases_without_load_keep_zero_load():
+    devices = _database_devices({'x': 4})
+    workers = {Worker('a'), Worker('b')}
+
+    Balancer.balance_with_databases(workers, devices, 0.0, 0, 0)
+
+    assert all(device.load_index == 0 for device in devices)
+    assert all(worker.load_index == 0 for worker in workers)
@@ -0,0 +1,21 @@
+from m_dataqualifier.processing_v2.service.device_table import DEVICE_TABLE
+from m_dataqualifier.processing_v2.simulators.benchmark import benchmark
+
+MEASURED = ('wall_time_s', 'peak_memory_bytes')
+
+
+def _outcome(results):
+    return [{key: value for key, value in result.items() if key not in MEASURED}
+            for result in results]
+
+
+def test_runs_use_own_device_table():
+    rows = len(DEVICE_TABLE)
+
+    first = benchmark('balance_with_load_indexes', 200, 5, cycles=2)
+    second = benchmark('balance_with_load_indexes', 200, 5, cycles=2)
+
+    assert len(DEVICE_TABLE) == rows
+    # state of first run doesn't leak to second
+    assert _outcome(first) == _outcome(second)
+    assert all(result['devices_assigned'] == 200 for result in first)
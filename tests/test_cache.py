@@ -0,0 +1,152 @@
+import gc
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from m_dataqualifier.processing_v2.infrastructure.cache import AggregatingStatsWriter, Cache
+from m_dataqualifier.processing_v2.infrastructure.codec import device_key
+from m_dataqualifier.processing_v2.service.balancing import Balancer
+from m_dataqualifier.processing_v2.service.device_table import DeviceTable
+from m_dataqualifier.processing_v2.service.entities import Device
+from m_dataqualifier.processing_v2.simulators.cache_sim import CacheSimulator
+
+
+class FailingCache(CacheSimulator):
+    """Cache that is down until `failing` is cleared"""
+
+    failing = True
+
+    def increment_many_fields(self, increments):
+        if self.failing:
+            raise ConnectionError('cache down')
+        super().increment_many_fields(increments)
+
+
+def test_stats_writer_aggregates_per_device():
+    cache = CacheSimulator()
+    with AggregatingStatsWriter(cache, flush_interval=60) as writer:
+        writer.record(1, 0.5)
+        writer.record(1, 0.25, msg_count=2)
+        writer.record(2, 1.0)
+        assert not cache.cache
+
+    assert cache.cache[device_key(1)] == {cache.COUNT_FIELD: 3, cache.PROC_TIME_FIELD: 0.75}
+    assert cache.cache[device_key(2)] == {cache.COUNT_FIELD: 1, cache.PROC_TIME_FIELD: 1.0}
+    assert cache.cache[cache.SYSTEM_FIELD][cache.COUNT_FIELD] == 4
+
+
+def test_stats_writer_keeps_recording_while_cache_is_down():
+    cache = FailingCache()
+    writer = AggregatingStatsWriter(cache, flush_interval=60, max_buffered=2)
+    writer.record(1, 0.1)
+    with pytest.raises(ConnectionError):
+        writer.flush()
+
+    for device_id in (2, 3, 1):
+        writer.record(device_id, 0.1)
+    assert writer.dropped == 1
+
+    cache.failing = False
+    writer.close()
+    assert cache.cache[device_key(1)][cache.COUNT_FIELD] == 2
+    assert cache.cache[device_key(2)][cache.COUNT_FIELD] == 1
+    assert device_key(3) not in cache.cache
+
+
+def test_full_stats_writer_flushes_in_background():
+    cache = CacheSimulator()
+    writer = AggregatingStatsWriter(cache, flush_interval=60, max_pending=2)
+    writer.record(1, 0.1)
+    writer.record(2, 0.1)
+
+    for _ in range(500):
+        if cache.cache:
+            break
+        time.sleep(0.01)
+    assert cache.cache[cache.SYSTEM_FIELD][cache.COUNT_FIELD] == 2
+    writer.close()
+
+
+def test_unclosed_stats_writer_is_collected():
+    threads = set(threading.enumerate())
+    writer = AggregatingStatsWriter(CacheSimulator(), flush_interval=60)
+    thread, = set(threading.enumerate()) - threads
+    del writer
+    gc.collect()
+
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+class FakePipeline:
+    """Redis pipeline over dict of hashes, records executed batches"""
+
+    def __init__(self, redis, transaction):
+        self.redis = redis
+        self.transaction = transaction
+        self.commands = []
+
+    def hmget(self, _key, *fields):
+        self.commands.append(lambda: [self.redis.hashes.get(_key, {}).get(field)
+                                      for field in fields])
+
+    def hmset(self, _key, values):
+        self.commands.append(lambda: self.redis.hashes.setdefault(_key, {}).update(values))
+
+    def execute(self):
+        self.redis.batches.append((self.transaction, len(self.commands)))
+        return [command() for command in self.commands]
+
+
+class FakeRedis:
+    """Redis client over dict of hashes"""
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.batches = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self, transaction)
+
+
+def test_fetch_and_reset_reads_batches_in_transactions(monkeypatch):
+    redis = FakeRedis({'k{}'.format(i): {'f': i} for i in range(5)})
+    monkeypatch.setitem(sys.modules, 'redis', types.SimpleNamespace(StrictRedis=lambda **_: redis))
+    cache = Cache()
+
+    values = cache.fetch_and_reset_fields(['k{}'.format(i) for i in range(5)], ('f',),
+                                          batch_size=2)
+
+    assert values == [(i,) for i in range(5)]
+    assert redis.batches == [(True, 4), (True, 4), (True, 2)]
+    assert all(fields == {'f': 0} for fields in redis.hashes.values())
+
+
+def test_batch_size_is_read_at_call_time(monkeypatch):
+    redis = FakeRedis({'k{}'.format(i): {'f': i} for i in range(3)})
+    monkeypatch.setitem(sys.modules, 'redis', types.SimpleNamespace(StrictRedis=lambda **_: redis))
+    cache = Cache()
+    cache.BATCH_SIZE = 2
+
+    cache.get_many_field_values(['k{}'.format(i) for i in range(3)], ('f',))
+    cache.fetch_and_reset_fields(['k{}'.format(i) for i in range(3)], ('f',))
+
+    assert redis.batches == [(False, 2), (False, 1), (True, 4), (True, 2)]
+
+
+def test_scheduler_fetch_resets_device_stats():
+    cache = CacheSimulator()
+    table = DeviceTable()
+    devices = {Device(device_id, table=table) for device_id in (1, 2)}
+    for device_id, msg_count in ((1, 3), (2, 1)):
+        cache.increment_field(device_key(device_id), cache.COUNT_FIELD, msg_count)
+        cache.increment_field(device_key(device_id), cache.PROC_TIME_FIELD, msg_count / 2)
+
+    _, system_msg_count, interval = Balancer.fetch_cache_data(devices, cache)
+
+    assert (system_msg_count, interval) == (4, 2.0)
+    assert {device.id_: device.msg_count for device in devices} == {1: 3, 2: 1}
+    assert cache.cache[device_key(1)][cache.COUNT_FIELD] == cache.RESET_VALUE
@@ -0,0 +1,72 @@
+import pickle
+
+import pytest
+
+from m_dataqualifier.processing_v2.infrastructure.codec import (
+    FLAG_COMPRESSED, FLAG_WIDE, HEADER, MAGIC, PARTITIONS_VERSION, VERSION, decode_device_ids,
+    encode_device_ids, encode_partition_id
+)
+
+
+def _header(value):
+    _, version, flags = HEADER.unpack_from(value)
+    return version, flags
+
+
+def test_partitions_round_trip_without_wide_deltas():
+    partitions = [encode_partition_id(device_id, index, 3)
+                  for device_id in (7, 1000) for index in range(3)]
+    device_ids = [1, 5, 900] + partitions
+
+    value = encode_device_ids(device_ids, compress=False)
+
+    assert decode_device_ids(value) == sorted(device_ids)
+    version, flags = _header(value)
+    assert version == PARTITIONS_VERSION
+    assert not flags & FLAG_WIDE
+    # 4 byte plain count, 4 byte delta per id, index and count byte per partition
+    assert len(value) == HEADER.size + 4 + 4 * len(device_ids) + 2 * len(partitions)
+
+
+def test_only_partitions_round_trip_compressed():
+    device_ids = [encode_partition_id(device_id, index, 2)
+                  for device_id in range(0, 3000, 3) for index in range(2)]
+
+    assert decode_device_ids(encode_device_ids(device_ids)) == device_ids
+
+
+def test_without_partitions_first_version_is_written():
+    value = encode_device_ids([3, 1, 2])
+
+    assert _header(value)[0] == VERSION
+    assert decode_device_ids(value) == [1, 2, 3]
+
+
+def test_device_ids_round_trip_compressed():
+    device_ids = list(range(1, 20000, 7))
+    value = encode_device_ids(reversed(device_ids))
+
+    assert _header(value)[1] & FLAG_COMPRESSED
+    assert len(value) < 4 * len(device_ids)
+    assert decode_device_ids(value) == device_ids
+
+
+def test_wide_deltas_round_trip():
+    device_ids = [5, 1 << 40, (1 << 40) + 3]
+    value = encode_device_ids(device_ids)
+
+    assert _header(value)[1] & FLAG_WIDE
+    assert decode_device_ids(value) == device_ids
+
+
+def test_legacy_and_empty_values_are_decoded():
+    assert decode_device_ids(pickle.dumps([3, 4])) == [3, 4]
+    assert decode_device_ids(b'') == []
+    assert decode_device_ids(encode_device_ids([])) == []
+
+
+def test_unknown_version_is_rejected():
+    value = HEADER.pack(MAGIC, PARTITIONS_VERSION + 1, 0)
+
+    with pytest.raises(ValueError):
+        decode_device_ids(value)
@@ -0,0 +1,68 @@
+import io
+
+from m_dataqualifier.processing_v2.infrastructure.codec import device_key
+from m_dataqualifier.processing_v2.service.device_table import DeviceTable
+from m_dataqualifier.processing_v2.service.entities import Device
+from m_dataqualifier.processing_v2.simulators.cache_sim import CacheSimulator
+from m_dataqualifier.processing_v2.simulators.data_sim import (
+    Burst, DataSimulator, LoadProfile, TraceReader, TraceWriter
+)
+
+
+def _simulator(cache, device_count=100, **kwargs):
+    table = DeviceTable()
+    devices = {Device(device_id, table=table) for device_id in range(device_count)}
+    return DataSimulator(cache, 1, [], devices, 10, **kwargs)
+
+
+def _msg_counts(cache, device_count=100):
+    return [cache.cache[device_key(device_id)][cache.COUNT_FIELD]
+            for device_id in range(device_count)]
+
+
+def test_same_seed_generates_same_load():
+    caches = [CacheSimulator(), CacheSimulator()]
+    for cache in caches:
+        _simulator(cache, skew=1.0).generate_data()
+
+    assert caches[0].cache == caches[1].cache
+    assert caches[0].cache[CacheSimulator.SYSTEM_FIELD][CacheSimulator.COUNT_FIELD] == \
+        sum(_msg_counts(caches[0]))
+
+
+def test_skew_concentrates_messages():
+    uniform, skewed = CacheSimulator(), CacheSimulator()
+    _simulator(uniform).generate_data()
+    _simulator(skewed, skew=1.5).generate_data()
+
+    def top_share(cache):
+        counts = sorted(_msg_counts(cache), reverse=True)
+        return sum(counts[:10]) / sum(counts)
+
+    assert top_share(skewed) > 2 * top_share(uniform)
+
+
+def test_burst_multiplies_device_messages():
+    profile = LoadProfile(bursts=[Burst(0, 10, [7], 50)])
+    cache = CacheSimulator()
+    _simulator(cache, profile=profile).generate_data()
+
+    counts = _msg_counts(cache)
+    assert counts[7] > 10 * max(counts[:7] + counts[8:])
+
+
+def test_recorded_trace_replays_same_load():
+    recorded, replayed = CacheSimulator(), CacheSimulator()
+    trace = io.BytesIO()
+    simulator = _simulator(recorded, skew=1.0)
+    writer = TraceWriter(trace)
+    for _ in range(3):
+        simulator.generate_data(record=writer)
+
+    trace.seek(0)
+    reader = TraceReader(trace)
+    simulator = _simulator(replayed)
+    for _ in range(3):
+        simulator.generate_data(replay=reader)
+
+    assert replayed.cache == recorded.cache
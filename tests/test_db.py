@@ -0,0 +1,76 @@
+import itertools
+
+from m_dataqualifier.processing_v2.infrastructure import db
+from m_dataqualifier.processing_v2.infrastructure.db import DeviceStorage
+from m_dataqualifier.processing_v2.simulators.db_sim import DbConnectorSimulator
+
+# storage devices share process device table, every test gets unused ids
+_ID_BLOCKS = itertools.count(5000000000, 1000000)
+
+
+def _connector(device_count, database=None):
+    first_id = next(_ID_BLOCKS)
+    connector = DbConnectorSimulator()
+    connector.add_devices(range(first_id, first_id + device_count), database=database)
+    return connector
+
+
+def test_databases_are_read_only_when_asked():
+    connector = _connector(3, database='x')
+
+    assert {device.database for device in DeviceStorage(connector=connector).devices} == {None}
+    storage = DeviceStorage(connector=connector, with_databases=True)
+    assert {device.database for device in storage.devices} == {'x'}
+
+
+def test_missing_database_column_reads_devices_without_databases(monkeypatch):
+    connector = _connector(3, database='x')
+    monkeypatch.setattr(db.settings, 'DEVICE_DATABASE_COLUMN', 'database_name', raising=False)
+
+    storage = DeviceStorage(connector=connector, with_databases=True)
+
+    assert len(list(storage.devices)) == 3
+    assert {device.database for device in storage.devices} == {None}
+
+
+def _ids(devices):
+    return {device.id_ for device in devices}
+
+
+def test_sync_applies_only_changed_rows():
+    connector = _connector(3)
+    storage = DeviceStorage(connector=connector)
+    first_id = min(_ids(storage.devices))
+    generation = storage.generation
+    changes = []
+    storage.add_listener(lambda: changes.append(storage.generation))
+
+    connector.add_devices([first_id + 10])
+    connector.update_devices([first_id], enabled=False)
+    storage.sync_devices()
+
+    assert _ids(storage.added) == {first_id + 10}
+    assert _ids(storage.removed) == {first_id}
+    assert _ids(storage.devices) == {first_id + 1, first_id + 2, first_id + 10}
+    assert storage.generation == generation + 1
+    assert changes == [generation + 1]
+
+    # nothing changed, generation stays
+    storage.sync_devices()
+    assert storage.generation == generation + 1
+    assert changes == [generation + 1]
+
+
+def test_deleted_rows_are_noticed_on_full_sync():
+    connector = _connector(2)
+    storage = DeviceStorage(connector=connector)
+    first_id = min(_ids(storage.devices))
+
+    connector.delete_devices([first_id])
+    storage.sync_devices()
+    assert first_id in _ids(storage.devices)
+
+    storage.FULL_SYNC_INTERVAL = 0
+    storage.sync_devices()
+    assert _ids(storage.devices) == {first_id + 1}
+    assert _ids(storage.removed) == {first_id}
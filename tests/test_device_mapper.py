@@ -0,0 +1,177 @@
+import pickle
+
+import pytest
+
+from m_dataqualifier.processing_v2.infrastructure import device_mapper
+from m_dataqualifier.processing_v2.infrastructure.codec import decode_device_ids, encode_device_ids
+from m_dataqualifier.processing_v2.infrastructure.device_mapper import WorkerDeviceMapper
+from m_dataqualifier.processing_v2.service.entities import Capacity
+from m_dataqualifier.processing_v2.simulators.zookeeper_sim import ZooKeeperSimulator
+from m_dataqualifier.processing_v2.tests.conftest import assign, published, start_workers
+
+
+def test_publish_syncs_with_diverged_zookeeper():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    mapper = WorkerDeviceMapper(client=zk)
+    assign(mapper, {'a': {1, 2}, 'b': {3}})
+
+    # node written behind our back, so set_data of cached version is stale
+    zk.delete('{}/a'.format(WorkerDeviceMapper.WORKERS_DEVICES_PATH))
+    zk.create('{}/c'.format(WorkerDeviceMapper.WORKERS_DEVICES_PATH), encode_device_ids({4}))
+    assign(mapper, {'a': {1}, 'b': {2, 3}})
+
+    assert published(zk) == {'a': {1}, 'b': {2, 3}}
+
+
+def test_publish_gives_up_after_rollbacks(monkeypatch):
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    mapper = WorkerDeviceMapper(client=zk)
+    assign(mapper, {'a': {1, 2}, 'b': set()})
+    monkeypatch.setattr(mapper, '_commit_assignment', lambda: False)
+
+    with pytest.raises(RuntimeError):
+        assign(mapper, {'a': {1}, 'b': {2}})
+
+    # failed publish doesn't block next ones, nor activation of handed off devices
+    monkeypatch.undo()
+    assign(mapper, {'a': {1}, 'b': {2}})
+    _ack(zk, 2)
+    assert published(zk) == {'a': {1}, 'b': {2}}
+
+
+def test_unchanged_worker_nodes_are_not_read_again(monkeypatch):
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    mapper = WorkerDeviceMapper(client=zk)
+    assign(mapper, {'a': {1}, 'b': {2}})
+    start_workers(zk, 'c')
+
+    reads = []
+    monkeypatch.setattr(device_mapper, 'decode_device_ids',
+                        lambda value: reads.append(set(decode_device_ids(value))) or reads[-1])
+    # only nodes written by publish are read, once each
+    assign(mapper, {'a': {1, 3}, 'b': {2}, 'c': set()})
+    assert sorted(reads, key=len) == [set(), {1, 3}]
+
+    # worker change reads nothing
+    reads.clear()
+    zk.delete('{}/c'.format(WorkerDeviceMapper.WORKER_PATH))
+
+    assert reads == []
+    assert {worker.identity: {device.id_ for device in worker.devices}
+            for worker in mapper.workers} == {'a': {1, 3}, 'b': {2}}
+
+
+def test_capacity_is_read_again_on_register():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', capacity=Capacity(cores=2))
+    mapper = WorkerDeviceMapper(client=zk)
+    assert {worker.identity: worker.capacity.cores for worker in mapper.workers} == {'a': 2}
+
+    # worker registered again within one children watch, node is new
+    path = '{}/a'.format(WorkerDeviceMapper.WORKER_PATH)
+    transaction = zk.transaction()
+    transaction.delete(path)
+    transaction.create(path, pickle.dumps(Capacity(cores=4).to_dict()))
+    transaction.commit()
+    start_workers(zk, 'b')
+
+    assert {worker.identity: worker.capacity.cores for worker in mapper.workers} == \
+        {'a': 4, 'b': 1}
+
+
+def test_moves_count_published_diff():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b', 'c')
+    mapper = WorkerDeviceMapper(client=zk)
+    assign(mapper, {'a': {1, 2}, 'b': {3, 4}, 'c': set()})
+    assert mapper.moves == 0
+
+    # moves between live workers start handoffs, devices of removed worker move at once
+    assign(mapper, {'a': {1}, 'b': {3, 4}, 'c': {2}})
+    assert mapper.moves == 1
+    zk.delete('{}/b'.format(WorkerDeviceMapper.WORKER_PATH))
+    assign(mapper, {'a': {1, 3}, 'c': {2, 4}})
+    assert mapper.moves == 3
+
+
+def _handoffs(zk):
+    return {int(device_id) for device_id in zk.get_children(WorkerDeviceMapper.HANDOFF_PATH)}
+
+
+def _ack(zk, device_id):
+    zk.delete('{}/{}'.format(WorkerDeviceMapper.HANDOFF_PATH, device_id))
+
+
+def test_moved_device_reaches_target_after_ack():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    mapper = WorkerDeviceMapper(client=zk)
+    assign(mapper, {'a': {1, 2}, 'b': set()})
+
+    assign(mapper, {'a': {1}, 'b': {2}})
+    # source stops processing device before target starts
+    assert published(zk) == {'a': {1}, 'b': set()}
+    assert _handoffs(zk) == {2}
+
+    _ack(zk, 2)
+    assert published(zk) == {'a': {1}, 'b': {2}}
+    assert not _handoffs(zk)
+
+
+def test_unacknowledged_handoff_times_out():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    mapper = WorkerDeviceMapper(client=zk)
+    mapper.HANDOFF_TIMEOUT = 0
+    assign(mapper, {'a': {1}, 'b': set()})
+    assign(mapper, {'a': set(), 'b': {1}})
+    assert published(zk) == {'a': set(), 'b': set()}
+
+    mapper.advance_handoffs()
+    assert published(zk) == {'a': set(), 'b': {1}}
+    assert not _handoffs(zk)
+
+
+def test_handoffs_start_in_waves():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    mapper = WorkerDeviceMapper(client=zk)
+    mapper.HANDOFF_WAVE_SIZE = 1
+    assign(mapper, {'a': {1, 2}, 'b': set()})
+
+    assign(mapper, {'a': set(), 'b': {1, 2}})
+    first, = _handoffs(zk)
+    # device waiting for next wave stays on source
+    assert published(zk) == {'a': {1, 2} - {first}, 'b': set()}
+
+    _ack(zk, first)
+    second, = _handoffs(zk)
+    assert second != first
+    assert published(zk) == {'a': set(), 'b': {first}}
+    _ack(zk, second)
+    assert published(zk) == {'a': set(), 'b': {1, 2}}
+
+
+def _devices(mapper):
+    return {worker.identity: {device.id_ for device in worker.devices}
+            for worker in mapper.workers}
+
+
+def test_stopped_mirror_ignores_later_publishes():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    leader = WorkerDeviceMapper(client=zk)
+    assign(leader, {'a': {1}, 'b': {2}})
+    mapper = WorkerDeviceMapper(client=zk)
+    mapper.mirror_assignment()
+    assign(leader, {'a': {1, 3}, 'b': {2}})
+    assert _devices(mapper) == {'a': {1, 3}, 'b': {2}}
+
+    mapper.stop_mirroring()
+    assign(leader, {'a': {1, 3, 4}, 'b': {2}})
+
+    assert _devices(mapper) == {'a': {1, 3}, 'b': {2}}
+    assert not zk.data_watches[WorkerDeviceMapper.WORKERS_DEVICES_PATH]
@@ -0,0 +1,69 @@
+import pickle
+
+from m_dataqualifier.processing_v2.infrastructure.device_mapper import WorkerDeviceMapper
+from m_dataqualifier.processing_v2.infrastructure.domains import DomainCoordinator
+from m_dataqualifier.processing_v2.simulators.zookeeper_sim import ZooKeeperSimulator
+from m_dataqualifier.processing_v2.tests.conftest import start_workers
+
+
+def _domain_workers(zk, domain):
+    value, _ = zk.get('{}/{}'.format(DomainCoordinator.DOMAINS_PATH, domain))
+    return set(pickle.loads(value) or ())
+
+
+def test_new_workers_join_busiest_domain():
+    workers = {'a': 1.0, 'b': 1.0, 'c': 1.0}
+    domains = DomainCoordinator.balance_domains(
+        workers, {0: ['a'], 1: ['b']}, {0: 1.0, 1: 3.0}, max_moves=0)
+
+    assert domains == {0: {'a'}, 1: {'b', 'c'}}
+
+
+def test_worker_moves_to_domain_with_more_load():
+    workers = dict.fromkeys('abcd', 1.0)
+    domains = DomainCoordinator.balance_domains(
+        workers, {0: ['a', 'b', 'c'], 1: ['d']}, {0: 1.0, 1: 3.0}, max_moves=2)
+
+    # both domains end with load 1.0 per worker
+    assert len(domains[0]) == 1 and len(domains[1]) == 3
+    assert domains[0] | domains[1] == set(workers)
+
+
+def test_mappers_see_workers_of_their_domain():
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b', 'c', 'd')
+    coordinator = DomainCoordinator(2, client=zk)
+    coordinator.run()
+
+    mappers = {domain: WorkerDeviceMapper(client=zk, domain=domain) for domain in (0, 1)}
+    for domain, mapper in mappers.items():
+        assert {worker.identity for worker in mapper.workers} == _domain_workers(zk, domain)
+    assert sorted(len(_domain_workers(zk, domain)) for domain in (0, 1)) == [2, 2]
+
+    # domain state the mapper publishes is what coordinator balances by
+    mappers[1].update_domain_state(4.0, 10)
+    value, _ = zk.get('{}/1/state'.format(DomainCoordinator.DOMAINS_PATH))
+    assert pickle.loads(value) == {'load': 4.0, 'devices': 10}
+
+
+def test_rolled_back_pass_is_repeated(monkeypatch):
+    zk = ZooKeeperSimulator()
+    start_workers(zk, 'a', 'b')
+    coordinator = DomainCoordinator(2, client=zk)
+    coordinator.last_update_time -= coordinator.UPDATE_INTERVAl
+    last_update_time = coordinator.last_update_time
+    get = zk.get
+
+    def read_then_overwrite(path, *args, **kwargs):
+        result = get(path, *args, **kwargs)
+        if path.startswith(DomainCoordinator.DOMAINS_PATH) and not path.endswith('state'):
+            # other coordinator writes domain after we read it
+            zk.set(path, pickle.dumps(['x']))
+        return result
+
+    monkeypatch.setattr(zk, 'get', read_then_overwrite)
+    coordinator.run()
+    monkeypatch.undo()
+
+    assert coordinator.last_update_time == last_update_time
+    assert _domain_workers(zk, 0) == _domain_workers(zk, 1) == {'x'}
@@ -0,0 +1,30 @@
+from m_dataqualifier.processing_v2.service.device_table import DEVICE_TABLE, DeviceTable
+from m_dataqualifier.processing_v2.service.entities import Capacity, Device
+
+
+def test_device_keeps_empty_table():
+    table = DeviceTable()
+    device = Device(1, load_index=2.0, table=table)
+
+    assert device.table is table
+    assert len(table) == 1
+    assert table.load_index[device.row] == 2.0
+
+
+def test_device_defaults_to_process_table():
+    assert Device(1).table is DEVICE_TABLE
+
+
+def test_capacity_from_node_data():
+    capacity = Capacity.from_dict({'cores': '8', 'max_devices': 100.0, 'memory': '4096'})
+
+    assert (capacity.cores, capacity.memory, capacity.max_devices) == (8, 4096, 100)
+    assert capacity.weight == 8
+    assert capacity.is_full(100) and not capacity.is_full(99)
+
+
+def test_invalid_capacity_gives_default():
+    for value in (None, [], {'cores': 'eight'}, {'cores': 0}, {'max_devices': -1},
+                  {'memory': -1}, {'cores': None}):
+        capacity = Capacity.from_dict(value)
+        assert (capacity.cores, capacity.memory, capacity.max_devices) == (1, 0, None)
@@ -0,0 +1,43 @@
+import pytest
+
+from m_dataqualifier.processing_v2.helpers.metrics import MetricsRegistry
+
+
+def test_render_in_prometheus_format():
+    registry = MetricsRegistry()
+    cycles = registry.counter('cycles_total', 'Cycles', labels=('reason',))
+    phase = registry.histogram('phase_seconds', 'Phases', buckets=(0.1, 1))
+    cycles.inc(reason='timer')
+    cycles.inc(2, reason='timer')
+    phase.observe(0.5)
+    phase.observe(2)
+
+    lines = registry.render().splitlines()
+
+    assert 'cycles_total{reason="timer"} 3' in lines
+    assert 'phase_seconds_bucket{le="0.1"} 0' in lines
+    assert 'phase_seconds_bucket{le="1"} 1' in lines
+    assert 'phase_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'phase_seconds_sum 2.5' in lines
+    assert 'phase_seconds_count 2' in lines
+
+
+def test_same_name_returns_registered_metric():
+    registry = MetricsRegistry()
+    gauge = registry.gauge('moved', 'Moved devices')
+
+    assert registry.gauge('moved', 'Moved devices') is gauge
+    with pytest.raises(ValueError):
+        registry.counter('moved', 'Moved devices')
+    with pytest.raises(ValueError):
+        registry.gauge('moved', 'Moved devices', labels=('reason',))
+
+
+def test_sinks_get_recorded_values():
+    registry = MetricsRegistry()
+    values = []
+    registry.add_sink(lambda *value: values.append(value))
+
+    registry.gauge('load', 'Load', labels=('worker',)).set(0.5, worker='a')
+
+    assert values == [('gauge', 'load', 0.5, {'worker': 'a'})]
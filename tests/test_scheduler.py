@@ -0,0 +1,227 @@
+import itertools
+
+import pytest
+
+from m_dataqualifier.processing_v2.infrastructure.codec import (
+    PARTITION_FLAG, decode_partition_id, device_key
+)
+from m_dataqualifier.processing_v2.infrastructure.db import DeviceStorage
+from m_dataqualifier.processing_v2.infrastructure.device_mapper import WorkerDeviceMapper
+from m_dataqualifier.processing_v2.service.scheduler import Scheduler
+from m_dataqualifier.processing_v2.service.strategies import AdaptiveStrategy
+from m_dataqualifier.processing_v2.simulators.cache_sim import CacheSimulator
+from m_dataqualifier.processing_v2.simulators.db_sim import DbConnectorSimulator
+from m_dataqualifier.processing_v2.simulators.zookeeper_sim import ZooKeeperSimulator
+from m_dataqualifier.processing_v2.tests.conftest import published, start_workers
+
+# storage devices share process device table, every scheduler gets unused ids
+_ID_BLOCKS = itertools.count(1000000, 1000000)
+
+
+def _make_scheduler(device_count, worker_ids, **kwargs):
+    """Returns scheduler, Zookeeper it publishes to and its device catalogue"""
+    first_id = next(_ID_BLOCKS)
+    connector = DbConnectorSimulator()
+    connector.add_devices(range(first_id, first_id + device_count))
+    zk = ZooKeeperSimulator()
+    start_workers(zk, *worker_ids)
+    scheduler = Scheduler('scheduler', DeviceStorage(connector=connector),
+                          WorkerDeviceMapper(client=zk), CacheSimulator(), **kwargs)
+    return scheduler, zk, connector
+
+
+def _device_ids(scheduler):
+    return sorted(device.id_ for device in scheduler.device_storage.devices)
+
+
+def _record_load(cache, device_ids, msg_count=10, proc_time=1.0):
+    for device_id in device_ids:
+        cache.increment_field(device_key(device_id), cache.COUNT_FIELD, msg_count)
+        cache.increment_field(device_key(device_id), cache.PROC_TIME_FIELD, proc_time)
+
+
+def _full_rebalance(scheduler):
+    scheduler.last_update_time -= scheduler.UPDATE_INTERVAl
+    scheduler.run()
+
+
+def _ack_handoffs(zk):
+    """Source workers acknowledge drain of every moved device"""
+    for device_id in zk.get_children(WorkerDeviceMapper.HANDOFF_PATH):
+        zk.delete('{}/{}'.format(WorkerDeviceMapper.HANDOFF_PATH, device_id))
+
+
+class RecordingStrategy(AdaptiveStrategy):
+    """Adaptive strategy remembering load smoothing of every full rebalance"""
+
+    def __init__(self):
+        self.smoothing = []
+
+    def balance(self, *args, load_smoothing=1.0, **kwargs):
+        self.smoothing.append(load_smoothing)
+        return super().balance(*args, load_smoothing=load_smoothing, **kwargs)
+
+
+def test_load_smoothing_window_starts_at_first_load():
+    strategy = RecordingStrategy()
+    scheduler, _, _ = _make_scheduler(20, ['a', 'b'], strategy=strategy)
+    # no traffic yet, devices are balanced by count
+    _full_rebalance(scheduler)
+
+    _record_load(scheduler.cache, _device_ids(scheduler))
+    _full_rebalance(scheduler)
+    _record_load(scheduler.cache, _device_ids(scheduler))
+    _full_rebalance(scheduler)
+
+    # first load has whole weight, only later loads are smoothed with it
+    assert strategy.smoothing[:3] == [1.0, 1.0, 1.0]
+    assert strategy.smoothing[3] < 1.0
+
+
+def _record_lag(cache, device_ids, lag):
+    for device_id in device_ids:
+        cache.update_field(device_key(device_id), cache.LAG_FIELD, lag)
+
+
+def test_all_reprocessing_devices_leave_normal_workers():
+    scheduler, zk, _ = _make_scheduler(10, ['a', 'b', 'c'])
+    _record_lag(scheduler.cache, _device_ids(scheduler), Scheduler.REPROCESSING_LAG)
+
+    _full_rebalance(scheduler)
+    _ack_handoffs(zk)
+
+    # one worker is reserved, the others have nothing to process
+    assert sorted(map(sorted, published(zk).values())) == [[], [], _device_ids(scheduler)]
+
+
+def test_removed_device_lowers_reprocessing_worker_load(monkeypatch):
+    scheduler, zk, connector = _make_scheduler(10, ['a', 'b', 'c'])
+    reprocessing_ids = set(_device_ids(scheduler)[:3])
+    _record_lag(scheduler.cache, reprocessing_ids, Scheduler.REPROCESSING_LAG)
+    _record_load(scheduler.cache, _device_ids(scheduler))
+
+    # worker loads as scheduler hands them to mapper
+    loads = {}
+    update_worker_devices = scheduler.worker_mapper.update_worker_devices
+
+    def record_loads(workers):
+        loads.update((worker.identity, worker.load_index) for worker in workers)
+        update_worker_devices(workers)
+
+    monkeypatch.setattr(scheduler.worker_mapper, 'update_worker_devices', record_loads)
+    _full_rebalance(scheduler)
+    _ack_handoffs(zk)
+
+    reprocessing_worker, = (
+        worker_id for worker_id, device_ids in published(zk).items()
+        if device_ids == reprocessing_ids)
+    assert loads[reprocessing_worker] == pytest.approx(0.3)
+
+    removed_id = min(reprocessing_ids)
+    connector.update_devices([removed_id], enabled=False)
+    scheduler.device_storage.sync_devices()
+    scheduler.run()
+
+    assert published(zk)[reprocessing_worker] == reprocessing_ids - {removed_id}
+    assert loads[reprocessing_worker] == pytest.approx(0.2)
+
+
+def test_replaced_devices_reuse_rows():
+    scheduler, zk, connector = _make_scheduler(10, ['a', 'b'])
+    table = next(iter(scheduler.device_storage.devices)).table
+    row_counts = []
+    for _ in range(3):
+        device_ids = _device_ids(scheduler)
+        connector.update_devices(device_ids[:2], enabled=False)
+        connector.add_devices([device_ids[-1] + 1, device_ids[-1] + 2])
+        scheduler.device_storage.sync_devices()
+        scheduler.run()
+        _ack_handoffs(zk)
+        row_counts.append(len(table.ids))
+
+    assert set().union(*published(zk).values()) == set(_device_ids(scheduler))
+    # new devices of first sync get new rows, later ones take rows of removed devices
+    assert row_counts[1:] == row_counts[:1] * 2
+
+
+def test_standby_takes_over_reprocessing_workers():
+    leader, zk, connector = _make_scheduler(10, ['a', 'b', 'c'])
+    reprocessing_ids = set(_device_ids(leader)[:2])
+    _record_lag(leader.cache, reprocessing_ids, Scheduler.REPROCESSING_LAG)
+    _full_rebalance(leader)
+    _ack_handoffs(zk)
+    assignment = published(zk)
+
+    standby = Scheduler(
+        'standby', DeviceStorage(connector=connector),
+        WorkerDeviceMapper(client=zk), leader.cache, standby=True)
+    standby.take_over()
+    _ack_handoffs(zk)
+    assert published(zk) == assignment
+
+    # reserved worker holds fewest devices, it still doesn't get new ones
+    new_id = max(_device_ids(leader)) + 1
+    connector.add_devices([new_id])
+    standby.device_storage.sync_devices()
+    standby.run()
+    _ack_handoffs(zk)
+
+    assert reprocessing_ids in published(zk).values()
+    assert any(new_id in device_ids for device_ids in published(zk).values())
+
+
+def test_standby_wait_ignores_due_rebalance():
+    leader, zk, connector = _make_scheduler(4, ['a', 'b'])
+    standby = Scheduler(
+        'standby', DeviceStorage(connector=connector),
+        WorkerDeviceMapper(client=zk), leader.cache, standby=True)
+    standby.last_update_time -= Scheduler.UPDATE_INTERVAl
+    standby.trigger.debounce = 0
+
+    # elector wakes standby once it is elected
+    standby.trigger.notify('elected')
+    assert standby.wait() == {'elected'}
+
+
+def _partition_ids(assignment):
+    return {device_id for device_ids in assignment.values() for device_id in device_ids
+            if device_id & PARTITION_FLAG}
+
+
+def test_hot_device_splits_and_merged_partitions_free_rows():
+    scheduler, zk, _ = _make_scheduler(4, ['a', 'b'])
+    hot_device = min(scheduler.device_storage.devices, key=lambda device: device.id_)
+    cold_ids = set(_device_ids(scheduler)) - {hot_device.id_}
+    table = hot_device.table
+    rows = len(table)
+    _record_load(scheduler.cache, cold_ids, 1, 0.1)
+    _record_load(scheduler.cache, {hot_device.id_}, 100, 10.0)
+    _full_rebalance(scheduler)
+    _record_load(scheduler.cache, cold_ids, 1, 0.1)
+    _full_rebalance(scheduler)
+    _ack_handoffs(zk)
+
+    assignment = published(zk)
+    assert {decode_partition_id(device_id)[0] for device_id in _partition_ids(assignment)} == {
+        hot_device.id_}
+    # every worker processes a partition
+    assert all(_partition_ids({worker_id: device_ids})
+               for worker_id, device_ids in assignment.items())
+    assert len(table) == rows + 2
+    row_count = len(table.ids)
+
+    # single worker can't share device, partitions merge
+    zk.delete('{}/b'.format(WorkerDeviceMapper.WORKER_PATH))
+    _full_rebalance(scheduler)
+    _ack_handoffs(zk)
+    assert published(zk) == {'a': set(_device_ids(scheduler))}
+    assert len(table) == rows
+
+    # rows of merged partitions are reused by next split
+    start_workers(zk, 'b')
+    _record_load(scheduler.cache, {hot_device.id_}, 100, 10.0)
+    _record_load(scheduler.cache, cold_ids, 1, 0.1)
+    _full_rebalance(scheduler)
+    _ack_handoffs(zk)
+    assert _partition_ids(published(zk))
+    assert len(table.ids) == row_count
@@ -0,0 +1,42 @@
+import pytest
+
+from m_dataqualifier.processing_v2.infrastructure.codec import device_key
+from m_dataqualifier.processing_v2.service.device_table import DeviceTable
+from m_dataqualifier.processing_v2.service.entities import Device, Worker
+from m_dataqualifier.processing_v2.service.strategies import (
+    BalancingStrategy, ConsistentHashStrategy, HashRing
+)
+from m_dataqualifier.processing_v2.simulators.cache_sim import CacheSimulator
+
+
+def test_strategy_has_to_implement_balance():
+    with pytest.raises(TypeError):
+        BalancingStrategy()
+
+
+def test_hash_ring_spreads_and_keeps_keys():
+    ring = HashRing(['a', 'b', 'c'])
+    owners = {key: ring.locate(str(key)) for key in range(3000)}
+    assert set(owners.values()) == {'a', 'b', 'c'}
+
+    # removed node only gives away its own keys
+    smaller = HashRing(['a', 'b'])
+    assert all(smaller.locate(str(key)) == owner
+               for key, owner in owners.items() if owner != 'c')
+
+
+def test_consistent_hash_reports_load_and_resets_counters():
+    table = DeviceTable()
+    devices = {Device(device_id, table=table) for device_id in range(100)}
+    workers = {Worker('a'), Worker('b')}
+    cache = CacheSimulator()
+    for device in devices:
+        cache.increment_field(device_key(device.id_), cache.COUNT_FIELD, 10)
+        cache.increment_field(device_key(device.id_), cache.PROC_TIME_FIELD, 1.0)
+
+    ConsistentHashStrategy().balance(workers, devices, cache)
+
+    assert sum(len(worker) for worker in workers) == 100
+    assert sum(worker.load_index for worker in workers) == pytest.approx(1.0)
+    assert all(cache.get_field_values(device_key(device.id_), cache.COUNT_FIELD) == (0,)
+               for device in devices)
@@ -0,0 +1,34 @@
+import threading
+import time
+
+from m_dataqualifier.processing_v2.helpers.trigger import Trigger
+
+
+def test_burst_of_events_wakes_once():
+    trigger = Trigger(debounce=0.05, max_delay=1.0)
+    trigger.notify('workers')
+    trigger.notify('devices')
+    trigger.notify('workers')
+
+    assert trigger.wait(1.0) == {'workers', 'devices'}
+    assert trigger.wait(0) == set()
+
+
+def test_steady_events_wake_after_max_delay():
+    trigger = Trigger(debounce=0.05, max_delay=0.2)
+    stop = threading.Event()
+
+    def notify_steadily():
+        while not stop.wait(0.01):
+            trigger.notify('workers')
+
+    thread = threading.Thread(target=notify_steadily, daemon=True)
+    thread.start()
+    time.sleep(0.02)
+    start = time.monotonic()
+    try:
+        assert trigger.wait(5.0) == {'workers'}
+    finally:
+        stop.set()
+        thread.join()
+    assert time.monotonic() - start < 1.0
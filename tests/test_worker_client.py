@@ -0,0 +1,90 @@
+import pickle
+
+import pytest
+
+from m_dataqualifier.processing_v2.infrastructure.device_mapper import WorkerDeviceMapper
+from m_dataqualifier.processing_v2.infrastructure.worker_client import WorkerAssignmentClient
+from m_dataqualifier.processing_v2.simulators.zookeeper_sim import ZooKeeperSimulator
+from m_dataqualifier.processing_v2.tests.conftest import assign
+
+
+class Callbacks:
+    """Records device changes worker client reports"""
+
+    def __init__(self):
+        self.changes = []
+        self.fail = False
+
+    def on_added(self, device_ids):
+        if self.fail:
+            raise RuntimeError('worker busy')
+        self.changes.append(('added', set(device_ids)))
+
+    def on_removed(self, device_ids):
+        self.changes.append(('removed', set(device_ids)))
+
+
+def _client(zk, identity, **kwargs):
+    callbacks = Callbacks()
+    client = WorkerAssignmentClient(
+        identity, callbacks.on_added, callbacks.on_removed, client=zk, **kwargs)
+    return client, callbacks
+
+
+def _set_domain(zk, domain, worker_ids):
+    zk.set('{}/{}'.format(WorkerDeviceMapper.DOMAINS_PATH, domain), pickle.dumps(worker_ids))
+
+
+def test_callbacks_get_changes_and_removal_is_acknowledged():
+    zk = ZooKeeperSimulator()
+    client_a, callbacks_a = _client(zk, 'a')
+    client_b, callbacks_b = _client(zk, 'b')
+    mapper = WorkerDeviceMapper(client=zk)
+    assign(mapper, {'a': {1, 2}, 'b': set()})
+    assert callbacks_a.changes == [('added', {1, 2})]
+
+    assign(mapper, {'a': {1}, 'b': {2}})
+
+    # a drained device 2 and acknowledged it, so b got it
+    assert callbacks_a.changes[1:] == [('removed', {2})]
+    assert callbacks_b.changes == [('added', {2})]
+    assert client_a.devices == {1} and client_b.devices == {2}
+
+
+def test_failed_callback_is_applied_again():
+    zk = ZooKeeperSimulator()
+    client, callbacks = _client(zk, 'a')
+    mapper = WorkerDeviceMapper(client=zk)
+    callbacks.fail = True
+    with pytest.raises(RuntimeError):
+        assign(mapper, {'a': {1}})
+    assert not client.devices
+
+    callbacks.fail = False
+    assign(mapper, {'a': {1, 2}})
+    assert callbacks.changes == [('added', {1, 2})]
+    assert client.devices == {1, 2}
+
+
+def test_worker_keeps_devices_of_previous_domain_until_moved_away():
+    zk = ZooKeeperSimulator()
+    client, callbacks = _client(zk, 'a', domains=True)
+    _client(zk, 'b', domains=True)
+    mappers = {domain: WorkerDeviceMapper(client=zk, domain=domain) for domain in (0, 1)}
+    _set_domain(zk, 0, ['a', 'b'])
+    assign(mappers[0], {'a': {2, 4}, 'b': set()})
+    assert client.devices == {2, 4}
+
+    # coordinator moves a, its node in new domain doesn't exist yet
+    _set_domain(zk, 1, ['a'])
+    _set_domain(zk, 0, ['b'])
+    assert client.devices == {2, 4}
+    assign(mappers[1], {'a': {1}})
+    assert client.devices == {1, 2, 4}
+
+    # devices of previous domain are drained and acknowledged there
+    assign(mappers[0], {'b': {2, 4}})
+    assert callbacks.changes == [('added', {2, 4}), ('added', {1}), ('removed', {2, 4})]
+    assert client.devices == {1}
+    assert not zk.get_children('{}/0'.format(WorkerDeviceMapper.HANDOFF_PATH))
+    assert len(zk.data_watches['{}/0/a'.format(WorkerDeviceMapper.WORKERS_DEVICES_PATH)]) == 0